@@ -0,0 +1,215 @@
+"""Admission control for the expensive routes.
+
+Each expensive route belongs to a pool (``ROUTE_POOLS``) that admits at most
+``concurrency`` requests at a time and queues up to ``queue`` more. A request
+that finds the queue full gets 429 straight away; one that waits longer than
+``ADMISSION_QUEUE_TIMEOUT_MS`` gets 503. Both carry ``Retry-After``. The
+permit is held until the response is fully sent, so streamed histories count
+for as long as their cursor is open. Cheap routes are never queued behind
+these.
+
+Pool sizes default to ``POOLS`` and can be overridden with
+``ADMISSION_<POOL>_CONCURRENCY`` and ``ADMISSION_<POOL>_QUEUE``;
+``ADMISSION_CONTROL=false`` turns the pools off. Request bodies are also
+capped per route (``BODY_LIMITS``, ``SIMPLIFY_MAX_BODY_BYTES``) with 413.
+"""
+import asyncio
+import contextlib
+import math
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette import status
+
+from app.config import env_flag
+from app.metrics import REGISTRY, Counter, Gauge, Histogram, route_template
+
+ADMISSION_ACTIVE = REGISTRY.register(Gauge(
+    "admission_active_requests", "Requests holding an admission permit.", ["pool"]
+))
+ADMISSION_QUEUED = REGISTRY.register(Gauge(
+    "admission_queued_requests", "Requests waiting for an admission permit.", ["pool"]
+))
+ADMISSION_WAIT = REGISTRY.register(Histogram(
+    "admission_wait_seconds", "Time admitted requests waited for a permit.", ["pool"]
+))
+ADMISSION_REJECTED = REGISTRY.register(Counter(
+    "admission_rejected_total", "Requests turned away by admission control.", ["pool", "reason"]
+))
+
+# pool: (concurrency, queue)
+POOLS: Dict[str, Tuple[int, int]] = {
+    "simplify": (4, 16),
+    "history": (32, 128),
+    "bulk": (2, 4),
+    "batch": (4, 16),
+}
+
+ROUTE_POOLS: Dict[Tuple[str, str], str] = {
+    ("POST", "/expenses/simplify"): "simplify",
+    ("GET", "/expenses/simplify/user/{user_id}"): "simplify",
+    ("GET", "/groups/{group_id}/simplify"): "simplify",
+    ("GET", "/expenses/user/{user_id}"): "history",
+    ("GET", "/groups/{group_id}/expenses"): "history",
+    ("POST", "/expenses/bulk"): "bulk",
+    ("POST", "/users/balances"): "batch",
+}
+
+
+def body_limits() -> Dict[Tuple[str, str], int]:
+    return {
+        ("POST", "/expenses/simplify"): int(os.environ.get("SIMPLIFY_MAX_BODY_BYTES", 1024 * 1024)),
+        ("POST", "/users/balances"): int(os.environ.get("BALANCES_MAX_BODY_BYTES", 512 * 1024)),
+    }
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, status_code: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionPool:
+
+    def __init__(self, name: str, concurrency: int, queue: int, timeout: float = 1.0):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _reject(self, status_code: int, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        ADMISSION_REJECTED.inc(pool=self.name, reason=reason)
+        return AdmissionRejected(status_code, reason, retry_after=self.timeout)
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        if self.active >= self.concurrency and self.waiting >= self.queue:
+            raise self._reject(status.HTTP_429_TOO_MANY_REQUESTS, "queue_full")
+        self.waiting += 1
+        ADMISSION_QUEUED.inc(pool=self.name)
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(self.timeout):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            raise self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, "queue_timeout")
+        finally:
+            self.waiting -= 1
+            ADMISSION_QUEUED.dec(pool=self.name)
+        ADMISSION_WAIT.observe(time.perf_counter() - started, pool=self.name)
+        self.active += 1
+        ADMISSION_ACTIVE.inc(pool=self.name)
+        try:
+            yield
+        finally:
+            self.active -= 1
+            ADMISSION_ACTIVE.dec(pool=self.name)
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue": self.queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+        }
+
+
+_pools: Optional[Dict[str, AdmissionPool]] = None
+
+
+def get_admission_pools() -> Dict[str, AdmissionPool]:
+    global _pools
+    if _pools is None:
+        _pools = {}
+        if env_flag("ADMISSION_CONTROL", default=True):
+            timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", 1000)) / 1000
+            for name, (concurrency, queue) in POOLS.items():
+                _pools[name] = AdmissionPool(
+                    name,
+                    concurrency=int(os.environ.get(f"ADMISSION_{name.upper()}_CONCURRENCY", concurrency)),
+                    queue=int(os.environ.get(f"ADMISSION_{name.upper()}_QUEUE", queue)),
+                    timeout=timeout
+                )
+    return _pools
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying ``ROUTE_POOLS`` and the body limits by route template."""
+
+    def __init__(self, app):
+        self.app = app
+        self.body_limits = body_limits()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        key = (scope["method"], route_template(scope))
+        limit = self.body_limits.get(key)
+        if limit is not None:
+            response = self._check_content_length(scope, key, limit)
+            if response is not None:
+                await response(scope, receive, send)
+                return
+            receive = self._limit_receive(receive, key, limit)
+
+        pool = get_admission_pools().get(ROUTE_POOLS.get(key))
+        if pool is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            async with pool.admit():
+                await self.app(scope, receive, send)
+        except AdmissionRejected as err:
+            response = JSONResponse(
+                {"detail": "Server is busy, retry later."},
+                status_code=err.status_code,
+                headers={"Retry-After": str(math.ceil(err.retry_after))}
+            )
+            await response(scope, receive, send)
+
+    @staticmethod
+    def _too_large(key: Tuple[str, str], limit: int) -> str:
+        ADMISSION_REJECTED.inc(pool=ROUTE_POOLS.get(key, key[1]), reason="body_too_large")
+        return f"Request body is larger than {limit} bytes."
+
+    def _check_content_length(self, scope, key: Tuple[str, str], limit: int) -> Optional[JSONResponse]:
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                return JSONResponse(
+                    {"detail": self._too_large(key, limit)},
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                )
+        return None
+
+    def _limit_receive(self, receive, key: Tuple[str, str], limit: int):
+        # For chunked bodies without a Content-Length; FastAPI passes HTTPExceptions
+        # raised while reading the body straight through as the response.
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=self._too_large(key, limit)
+                    )
+            return message
+
+        return limited_receive
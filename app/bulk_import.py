@@ -0,0 +1,109 @@
+"""Parsing and validation for ``POST /expenses/bulk``.
+
+Rows are read from the request body line by line, so an import never has to
+fit in memory. Two formats are accepted:
+
+* NDJSON: one ``AddExpensePayload`` object per line.
+* CSV: a header row naming the ``AddExpensePayload`` fields, with
+  ``participants`` written as ``user_id:contribution;user_id:contribution``
+  (the contribution may be left empty for EQUAL splits). Quoted fields may
+  not span lines.
+"""
+import csv
+from typing import AsyncIterator, List, Optional, Tuple, Union
+
+import orjson
+from pydantic import ValidationError
+
+from app.crud import expense_adapter, get_group_membership_error, get_participants_batch
+from app.models import DbExpense
+from app.offload import run_cpu
+from app.schema import AddExpensePayload
+from app.storage import Storage
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+CSV_CONTENT_TYPES = ("text/csv", "application/csv")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8", errors="replace").rstrip("\r")
+    if buffer:
+        yield buffer.decode("utf-8", errors="replace").rstrip("\r")
+
+
+def parse_csv_participants(value: str) -> List[dict]:
+    participants = []
+    for item in filter(None, (part.strip() for part in value.split(";"))):
+        user_id, _, contribution = item.partition(":")
+        participants.append({"user_id": user_id.strip(), "contribution": contribution.strip() or None})
+    return participants
+
+
+async def iter_records(lines: AsyncIterator[str], fmt: str) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    """Yield ``(row, record, error)`` for every non-blank data row, numbered from 1."""
+    header = None
+    row = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        if fmt == "csv" and header is None:
+            header = [column.strip() for column in next(csv.reader([line]))]
+            continue
+        row += 1
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if len(values) != len(header):
+                yield row, None, f"Expected {len(header)} columns, got {len(values)}."
+                continue
+            record = {column: value or None for column, value in zip(header, values)}
+            record["participants"] = parse_csv_participants(record.get("participants") or "")
+        else:
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError as err:
+                yield row, None, f"Invalid JSON: {err}"
+                continue
+            if not isinstance(record, dict):
+                yield row, None, "Expected a JSON object."
+                continue
+        yield row, record, None
+
+
+def format_validation_error(err: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(str(loc) for loc in e['loc'])}: {e['msg']}" for e in err.errors())
+
+
+def parse_payload(record: dict) -> AddExpensePayload:
+    if isinstance(record.get("expense_type"), str):
+        record["expense_type"] = record["expense_type"].upper()
+    return AddExpensePayload(**record)
+
+
+async def build_expenses(storage: Storage, payloads: List[AddExpensePayload]) -> List[Union[DbExpense, str]]:
+    """Split a chunk of payloads in one batched call; errors are returned in place.
+
+    Each group the chunk refers to is read once to check its membership.
+    """
+    expenses = []
+    group_ids = {payload.group_id for payload in payloads if payload.group_id is not None}
+    groups = {group_id: await storage.get_group(group_id) for group_id in group_ids}
+    batch = await run_cpu(get_participants_batch, payloads, size=sum(len(p.participants) for p in payloads))
+    for payload, participants in zip(payloads, batch):
+        if participants is None:
+            expenses.append("Invalid total contribution.")
+            continue
+        if payload.group_id is not None:
+            error = get_group_membership_error(groups[payload.group_id], payload)
+            if error is not None:
+                expenses.append(error)
+                continue
+        try:
+            expenses.append(await expense_adapter(payload, participants))
+        except ValidationError as err:
+            expenses.append(format_validation_error(err))
+    return expenses
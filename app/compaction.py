@@ -0,0 +1,201 @@
+"""Checkpoint compaction of the ``transactions`` collection.
+
+Transactions older than a watermark are rolled into one checkpoint document
+per (group, payer, payee), kept in ``transactions`` itself with
+``checkpoint: true``. Every ``$group`` over the collection therefore reads
+the checkpoint plus the recent deltas and gets the same totals as before.
+Between the applying and deleting phases a pair's amounts are in both its
+checkpoint and its tagged rows; the ledger verify/rebuild in ``app.ledger``
+reads the run state and counts them once.
+
+A run goes through three phases, recorded in the ``maintenance`` collection
+so a crashed run resumes where it stopped:
+
+1. ``tagging``: up to ``max_documents`` old transactions are stamped with the
+   run id. Re-tagging after a crash only picks up untagged documents.
+2. ``applying``: the tagged documents are summed per pair and group and ``$inc``-ed into
+   the checkpoints. Each checkpoint remembers the runs applied to it, so
+   replaying this phase skips pairs that were already done.
+3. ``deleting``: the tagged documents are removed.
+
+Usage:
+    python -m app.compaction [retention_days]
+"""
+import asyncio
+import datetime
+import logging
+import os
+import sys
+from typing import Optional
+
+import bson
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.config import id_factory
+from app.database import DatabaseConnectionManager, get_db
+
+logger = logging.getLogger(__name__)
+
+STATE_ID = "transactions_compaction"
+TAG_BATCH_SIZE = 5000
+APPLY_BATCH_SIZE = 1000
+DUPLICATE_KEY = 11000
+
+
+async def _tag(db: AsyncIOMotorDatabase, state: dict, max_documents: int):
+    query = {
+        "checkpoint": {"$ne": True},
+        "compaction_run": {"$exists": False},
+        "$or": [{"date": {"$lt": state["watermark"]}}, {"date": {"$exists": False}}]
+    }
+    tagged = await db["transactions"].count_documents({"compaction_run": state["run_id"]})
+    while tagged < max_documents:
+        limit = min(TAG_BATCH_SIZE, max_documents - tagged)
+        ids = [doc["_id"] async for doc in db["transactions"].find(query, {"_id": 1}).limit(limit)]
+        if not ids:
+            break
+        result = await db["transactions"].update_many(
+            {"_id": {"$in": ids}, "compaction_run": {"$exists": False}},
+            {"$set": {"compaction_run": state["run_id"]}}
+        )
+        tagged += result.modified_count
+
+
+async def _has_run(db: AsyncIOMotorDatabase, key: dict, run_id: str) -> bool:
+    return await db["transactions"].count_documents(dict(key, checkpoint=True, applied_runs=run_id), limit=1) > 0
+
+
+async def _apply(db: AsyncIOMotorDatabase, state: dict) -> dict:
+    run_id = state["run_id"]
+    pipeline = [
+        {"$match": {"compaction_run": run_id}},
+        {"$group": {
+            # Transactions written before groups have no group_id; count them with the
+            # ungrouped (null) ones so each checkpoint gets exactly one row.
+            "_id": {
+                "group_id": {"$ifNull": ["$group_id", None]},
+                "payer_id": "$payer_id",
+                "payee_id": "$payee_id"
+            },
+            "amount": {"$sum": "$amount"},
+            "documents": {"$sum": 1},
+            "bytes": {"$sum": {"$bsonSize": "$$ROOT"}}
+        }}
+    ]
+    documents = size = created = 0
+    updates = []
+    keys = []
+
+    async def flush():
+        nonlocal created
+        try:
+            result = await db["transactions"].bulk_write(updates, ordered=False)
+            created += result.upserted_count
+        except BulkWriteError as err:
+            # A duplicate key is expected when the checkpoint already has this run
+            # (a replay after a crash); anything else would drop the row's amount.
+            for error in err.details["writeErrors"]:
+                if error["code"] != DUPLICATE_KEY or not await _has_run(db, keys[error["index"]], run_id):
+                    raise
+            created += err.details["nUpserted"]
+        updates.clear()
+        keys.clear()
+
+    async for row in db["transactions"].aggregate(pipeline, allowDiskUse=True):
+        documents += row["documents"]
+        size += row["bytes"]
+        # {"group_id": None} also matches checkpoints written before groups, which have none.
+        key = {
+            "group_id": row["_id"].get("group_id"),
+            "payer_id": row["_id"]["payer_id"],
+            "payee_id": row["_id"]["payee_id"]
+        }
+        keys.append(key)
+        updates.append(UpdateOne(
+            dict(key, checkpoint=True, applied_runs={"$ne": run_id}),
+            {
+                "$inc": {"amount": row["amount"]},
+                "$max": {"date": state["watermark"]},
+                "$push": {"applied_runs": {"$each": [run_id], "$slice": -10}}
+            },
+            upsert=True
+        ))
+        if len(updates) >= APPLY_BATCH_SIZE:
+            await flush()
+    if updates:
+        await flush()
+
+    checkpoint_size = len(bson.encode({
+        "_id": bson.ObjectId(), "group_id": None, "payer_id": id_factory(), "payee_id": id_factory(),
+        "checkpoint": True, "amount": 0.0, "date": state["watermark"], "applied_runs": [run_id]
+    }))
+    return {"documents": documents, "bytes": max(size - created * checkpoint_size, 0), "checkpoints_created": created}
+
+
+async def compact_transactions(db: AsyncIOMotorDatabase,
+                               retention: datetime.timedelta,
+                               max_documents: int = 1_000_000) -> dict:
+    """Run (or resume) one compaction pass and return what it reclaimed."""
+    maintenance = db["maintenance"]
+    state = await maintenance.find_one({"_id": STATE_ID})
+    if state is None or state["phase"] == "done":
+        state = {
+            "_id": STATE_ID,
+            "run_id": id_factory(),
+            "watermark": datetime.datetime.utcnow() - retention,
+            "phase": "tagging",
+            "started": datetime.datetime.utcnow()
+        }
+        await maintenance.replace_one({"_id": STATE_ID}, state, upsert=True)
+    else:
+        logger.info("Resuming compaction run %s in phase %s", state["run_id"], state["phase"])
+
+    if state["phase"] == "tagging":
+        await _tag(db, state, max_documents)
+        state["phase"] = "applying"
+        await maintenance.update_one({"_id": STATE_ID}, {"$set": {"phase": "applying"}})
+
+    if state["phase"] == "applying":
+        state["report"] = await _apply(db, state)
+        state["phase"] = "deleting"
+        await maintenance.update_one({"_id": STATE_ID}, {"$set": {"phase": "deleting", "report": state["report"]}})
+
+    if state["phase"] == "deleting":
+        await db["transactions"].delete_many({"compaction_run": state["run_id"]})
+        state["phase"] = "done"
+        await maintenance.update_one(
+            {"_id": STATE_ID},
+            {"$set": {"phase": "done", "finished": datetime.datetime.utcnow()}}
+        )
+
+    report = dict(state.get("report", {}), run_id=state["run_id"], watermark=state["watermark"])
+    logger.info("Compacted transactions: %s", report)
+    return report
+
+
+async def run_transactions_compaction(retention_days: Optional[int] = None):
+    if retention_days is None:
+        retention_days = int(os.environ.get("COMPACTION_RETENTION_DAYS", 90))
+    return await compact_transactions(
+        get_db(),
+        retention=datetime.timedelta(days=retention_days),
+        max_documents=int(os.environ.get("COMPACTION_MAX_DOCUMENTS", 1_000_000))
+    )
+
+
+async def main(retention_days: Optional[int]):
+    try:
+        report = await run_transactions_compaction(retention_days)
+        print(f"Compacted {report.get('documents', 0)} transaction(s) into "
+              f"{report.get('checkpoints_created', 0)} new checkpoint(s), "
+              f"reclaiming about {report.get('bytes', 0)} bytes.")
+    finally:
+        DatabaseConnectionManager().close_conn()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else None))
@@ -1,5 +1,7 @@
+import os
 import uuid
 from enum import unique, Enum
+from typing import Optional
 
 
 def float_scale(x: float) -> str:
@@ -16,3 +18,10 @@ class ExpenseSplitType(str, Enum):
 
 def id_factory():
     return str(uuid.uuid4())
+
+
+def env_flag(name: str, default: Optional[bool] = False) -> Optional[bool]:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -1,83 +1,58 @@
-from typing import List
+import base64
+import binascii
+import collections
+import datetime
+import logging
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
+import orjson
 from fastapi import HTTPException
-from motor.motor_asyncio import AsyncIOMotorDatabase
 from starlette import status
 
-from app.config import ExpenseSplitType
-from app.database import get_db
+from app.config import ExpenseSplitType, id_factory
+from app.metrics import timed
 from app.models import DbExpense
-from app.schema import AddExpensePayload
+from app.offload import run_cpu
+from app.rollups import get_rollup_deltas, merge_rollup_deltas
+from app.schema import AddExpensePayload, UpdateExpensePayload
+from app.split import from_minor, split, split_batch, to_minor
+from app.storage import Storage, get_storage
+from app.user_cache import get_user_directory
+from app.write_coalescer import get_write_coalescer
 
+logger = logging.getLogger(__name__)
+
+# How long the intents of a bulk import stay unclaimed if the import never releases them.
+IMPORT_NOTIFICATION_HOLD = datetime.timedelta(minutes=10)
 
-def split_amount(total_amount: float, num_people: int) -> List[float]:
-    equal_share = total_amount / num_people
-    remainder = total_amount - (equal_share * num_people)
 
-    # Distribute equal share among all participants
-    amounts = [round(equal_share, 2) for _ in range(num_people)]
+def split_amount(total_amount: float, num_people: int) -> List[float]:
+    shares = split(ExpenseSplitType.EQUAL, to_minor(total_amount), [None] * num_people)
+    return [from_minor(share) for share in shares]
 
-    # Distribute remainder fairly among participants
-    for i in range(int(remainder * 100)):  # Multiply by 100 to avoid floating-point precision issues
-        amounts[i % num_people] += 0.01
 
-    return amounts
+def _split_participants(split_type: ExpenseSplitType, total_amount, participants) -> List[dict]:
+    shares = split(split_type, to_minor(total_amount), [p.contribution for p in participants])
+    return [
+        {"user_id": participant.user_id, "amount": from_minor(share)}
+        for participant, share in zip(participants, shares)
+    ]
 
 
 def get_participants_by_splitting_amount_equally(total_amount, participants) -> List[dict]:
-    db_participants = []
-    amounts = split_amount(total_amount=total_amount, num_people=len(participants))
-    for index, participant in enumerate(participants):
-        db_participant = {
-            "user_id": participant.user_id,
-            "amount": amounts[index]
-        }
-        db_participants.append(db_participant)
-    return db_participants
+    return _split_participants(ExpenseSplitType.EQUAL, total_amount, participants)
 
 
 def get_participants_by_splitting_amount_exactly(total_amount, participants) -> List[dict]:
-    spent = total_amount
-    db_participants = []
-    for participant in participants:
-        spent -= participant.contribution
-        db_participant = {
-            "user_id": participant.user_id,
-            "amount": participant.contribution
-        }
-        db_participants.append(db_participant)
-    if spent != 0:
-        raise ValueError
-    return db_participants
+    return _split_participants(ExpenseSplitType.EXACT, total_amount, participants)
 
 
 def get_participants_by_splitting_amount_by_percentage(total_amount, participants) -> List[dict]:
-    total_perc = 0
-    db_participants = []
-    for participant in participants:
-        total_perc += participant.contribution
-        amount_owed = total_amount * participant.contribution / 100
-        db_participant = {
-            "user_id": participant.user_id,
-            "amount": amount_owed
-        }
-        db_participants.append(db_participant)
-    if total_perc > 100:
-        raise ValueError
-    return db_participants
+    return _split_participants(ExpenseSplitType.PERCENT, total_amount, participants)
 
 
 def get_participants_by_splitting_amount_by_weight(total_amount, participants) -> List[dict]:
-    total_weight = sum([p.contribution for p in participants])
-    db_participants = []
-    for participant in participants:
-        amount_owed = total_amount * participant.contribution / total_weight
-        db_participant = {
-            "user_id": participant.user_id,
-            "amount": amount_owed
-        }
-        db_participants.append(db_participant)
-    return db_participants
+    return _split_participants(ExpenseSplitType.WEIGHT, total_amount, participants)
 
 
 def get_participants(payload: AddExpensePayload):
@@ -95,19 +70,45 @@ def get_participants(payload: AddExpensePayload):
     return db_participants
 
 
-async def expense_adapter(payload: AddExpensePayload) -> DbExpense:
+def get_participants_batch(payloads: List[AddExpensePayload]) -> List[Optional[List[dict]]]:
+    """Split many payloads in one vectorised pass; ``None`` marks an invalid split."""
+    all_shares = split_batch(
+        [ExpenseSplitType(payload.expense_type.upper()) for payload in payloads],
+        [to_minor(payload.amount) for payload in payloads],
+        [[p.contribution for p in payload.participants] for payload in payloads]
+    )
+    result = []
+    for payload, shares in zip(payloads, all_shares):
+        if shares is None:
+            result.append(None)
+        else:
+            result.append([
+                {"user_id": participant.user_id, "amount": from_minor(share)}
+                for participant, share in zip(payload.participants, shares)
+            ])
+    return result
+
+
+async def expense_adapter(payload: AddExpensePayload, participants: Optional[List[dict]] = None) -> DbExpense:
+    if participants is None:
+        try:
+            participants = await run_cpu(get_participants, payload, size=len(payload.participants))
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     db_expense = DbExpense(
         payee_id=payload.payee_id,
-        amount=payload.amount,
+        amount=from_minor(to_minor(payload.amount)),
         name=payload.name,
         notes=payload.notes,
         images=None,
-        participants=get_participants(payload)
+        participants=participants,
+        group_id=payload.group_id,
+        category=payload.category
     )
     return db_expense
 
 
-async def update_transactions(db: AsyncIOMotorDatabase, expense: DbExpense):
+def get_transaction_docs(expense: DbExpense) -> List[dict]:
     payee = expense.payee_id
     docs = []
     for participant in expense.participants:
@@ -116,22 +117,178 @@ async def update_transactions(db: AsyncIOMotorDatabase, expense: DbExpense):
                 {
                     "payee_id": payee,
                     "payer_id": participant.user_id,
-                    "amount": participant.amount
+                    "amount": participant.amount,
+                    "expense_id": expense.id,
+                    "group_id": expense.group_id,
+                    "date": expense.date
                 },
                 {
                     "payee_id": participant.user_id,
                     "payer_id": payee,
-                    "amount": -participant.amount
+                    "amount": -participant.amount,
+                    "expense_id": expense.id,
+                    "group_id": expense.group_id,
+                    "date": expense.date
                 }
             ])
-    await db["transactions"].insert_many(docs)
+    return docs
+
+
+def get_balance_deltas(expenses: List[DbExpense]) -> Dict[Tuple[str, str], int]:
+    # Mirrors the transaction pairs from get_transaction_docs, folded into
+    # one running total per (user, counterparty), in cents.
+    deltas = collections.defaultdict(int)
+    for expense in expenses:
+        payee = expense.payee_id
+        for participant in expense.participants:
+            if payee != participant.user_id:
+                amount = to_minor(participant.amount)
+                deltas[(participant.user_id, payee)] += amount
+                deltas[(payee, participant.user_id)] -= amount
+    return deltas
+
+
+def get_group_balance_deltas(expenses: List[DbExpense]) -> Dict[Tuple[str, str, str], int]:
+    """``get_balance_deltas`` of the grouped expenses, keyed by ``(group_id, user_id, counterparty_id)``."""
+    deltas = collections.defaultdict(int)
+    for expense in expenses:
+        if expense.group_id is None:
+            continue
+        for (user_id, counterparty_id), amount in get_balance_deltas([expense]).items():
+            deltas[(expense.group_id, user_id, counterparty_id)] += amount
+    return deltas
+
+
+async def update_balances(storage: Storage, expenses: List[DbExpense]):
+    # Grouped expenses count towards the global balances as well as their group's.
+    await storage.apply_balance_deltas(get_balance_deltas(expenses))
+    await storage.apply_group_balance_deltas(get_group_balance_deltas(expenses))
+
+
+def subtract_deltas(new: dict, old: dict) -> dict:
+    """``new - old`` per key, leaving out the keys that did not change."""
+    result = {}
+    for key in dict.fromkeys([*old, *new]):
+        amount = new.get(key, 0) - old.get(key, 0)
+        if amount:
+            result[key] = amount
+    return result
+
+
+def get_adjustment_docs(expense: DbExpense, deltas: Dict[Tuple[str, str], int]) -> List[dict]:
+    """One transaction per changed ``(user, counterparty)`` pair of an edited or deleted expense."""
+    now = datetime.datetime.utcnow()
+    return [
+        {
+            "payee_id": counterparty_id,
+            "payer_id": user_id,
+            "amount": from_minor(amount),
+            "expense_id": expense.id,
+            "group_id": expense.group_id,
+            "date": now,
+            "adjustment": True
+        }
+        for (user_id, counterparty_id), amount in deltas.items()
+    ]
+
+
+async def apply_expense_change(storage: Storage, old: DbExpense, new: Optional[DbExpense]):
+    """Write to the ledger only what changed between ``old`` and ``new`` (``None`` once deleted).
+
+    The log gets one adjustment per pair whose balance moved and the running
+    balances are ``$inc``-ed by the same amounts; nothing else is recomputed.
+    """
+    changed = [new] if new is not None else []
+    deltas = subtract_deltas(get_balance_deltas(changed), get_balance_deltas([old]))
+    group_deltas = subtract_deltas(get_group_balance_deltas(changed), get_group_balance_deltas([old]))
+    await storage.insert_transactions(get_adjustment_docs(old, deltas))
+    await storage.apply_balance_deltas(deltas)
+    await storage.apply_group_balance_deltas(group_deltas)
+    await storage.apply_rollup_deltas(
+        merge_rollup_deltas(get_rollup_deltas([old], sign=-1), get_rollup_deltas(changed))
+    )
+    # Bumped even when no balance moved, since the history shows names and notes too.
+    await storage.bump_ledger_versions(get_expense_members([old, *changed]))
+
+
+def get_group_membership_error(group: Optional[dict], payload: AddExpensePayload) -> Optional[str]:
+    """Why ``payload`` cannot be added to ``group``, or ``None`` if it can."""
+    if group is None:
+        return "Group not found."
+    members = set(group["member_ids"])
+    outsiders = [
+        user_id for user_id in dict.fromkeys([payload.payee_id, *(p.user_id for p in payload.participants)])
+        if user_id not in members
+    ]
+    if outsiders:
+        return f"Not members of the group: {', '.join(outsiders)}."
+    return None
+
+
+async def check_group_expense(storage: Storage, payload: AddExpensePayload):
+    if payload.group_id is None:
+        return
+    group = await storage.get_group(payload.group_id)
+    error = get_group_membership_error(group, payload)
+    if error is not None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND if group is None else status.HTTP_400_BAD_REQUEST,
+            detail=error
+        )
+
+
+def get_expense_members(expenses: List[DbExpense]) -> List[str]:
+    """Everyone whose balances or expense history ``expenses`` touch."""
+    members = {}
+    for expense in expenses:
+        members[expense.payee_id] = None
+        members.update(dict.fromkeys(p.user_id for p in expense.participants))
+    return list(members)
+
+
+def get_outbox_docs(expense: DbExpense, import_id: Optional[str] = None) -> List[dict]:
+    """Notification intents for everyone on ``expense``, picked up by ``app.outbox``.
+
+    Intents of a bulk import carry its ``import_id`` and are held until the
+    import releases them, so each recipient gets one digest for the import.
+    """
+    now = datetime.datetime.utcnow()
+    lease_until = now + IMPORT_NOTIFICATION_HOLD if import_id else now
+    docs = []
+    for participant in expense.participants:
+        is_payee = participant.user_id == expense.payee_id
+        docs.append({
+            "_id": id_factory(),
+            "recipient_id": participant.user_id,
+            "expense_id": expense.id,
+            "expense_name": expense.name,
+            "role": "payee" if is_payee else "participant",
+            "amount": expense.amount if is_payee else participant.amount,
+            "import_id": import_id,
+            "status": "pending",
+            "attempts": 0,
+            "lease_until": lease_until,
+            "created": now
+        })
+    return docs
 
 
-async def add_expense_to_db(db: AsyncIOMotorDatabase, expenses: DbExpense):
+@timed
+async def add_expense_to_db(storage: Storage, expenses: DbExpense):
     try:
-        print(expenses.dict(by_alias=True))
-        await db["expenses"].insert_one(expenses.dict(by_alias=True))
-        await update_transactions(db, expenses)
+        logger.debug("Adding expense %s", expenses.id)
+        coalescer = get_write_coalescer()
+        if coalescer is not None:
+            return await coalescer.submit(expenses)
+        errors = await storage.insert_expenses([expenses.dict(by_alias=True)])
+        if errors:
+            raise RuntimeError(errors[0])
+        await storage.insert_transactions(get_transaction_docs(expenses))
+        await update_balances(storage, [expenses])
+        await storage.apply_rollup_deltas(get_rollup_deltas([expenses]))
+        # Bumped last, so a reader that sees the new version also sees the new data.
+        await storage.bump_ledger_versions(get_expense_members([expenses]))
+        await storage.enqueue_notifications(get_outbox_docs(expenses))
         return expenses.id
     except ValueError:
         raise HTTPException(
@@ -145,42 +302,182 @@ async def add_expense_to_db(db: AsyncIOMotorDatabase, expenses: DbExpense):
         )
 
 
-async def get_user_balance(db: AsyncIOMotorDatabase, user_id: str):
-    pipeline = [
-        {"$match": {"payer_id": user_id}},
-        {"$group": {"_id": "$payee_id", "amount_owed": {"$sum": "$amount"}}},
-        {"$sort": {"amount_owed": 1}}
-    ]
-    result = [txn async for txn in db["transactions"].aggregate(pipeline)]
-    user_name_map = await get_username([txn["_id"] for txn in result])
-    print(user_name_map)
-    balance = [{"user": user_name_map[txn["_id"]], "amount_owed": txn["amount_owed"]} for txn in result]
-    return balance
+async def get_expense_at_version(storage: Storage, expense_id: str, version: int) -> DbExpense:
+    stored = await storage.get_expense(expense_id)
+    if stored is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+    expense = DbExpense(**stored)
+    if expense.version != version:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Expense is at version {expense.version}, not {version}."
+        )
+    return expense
+
+
+def version_conflict() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Expense was changed concurrently; read it again and retry."
+    )
+
+
+@timed
+async def update_expense_in_db(storage: Storage, expense_id: str, payload: UpdateExpensePayload) -> DbExpense:
+    """Replace an expense with a new split, if the client edited the latest version.
+
+    The group, date and receipts of the expense are kept.
+    """
+    old = await get_expense_at_version(storage, expense_id, payload.version)
+    new_payload = AddExpensePayload(
+        amount=payload.amount,
+        payee_id=payload.payee_id,
+        expense_type=payload.expense_type,
+        name=payload.name,
+        notes=payload.notes,
+        participants=payload.participants,
+        group_id=old.group_id,
+        category=payload.category
+    )
+    await check_group_expense(storage, new_payload)
+    new = await expense_adapter(new_payload)
+    new = new.model_copy(update={"id": old.id, "date": old.date, "images": old.images, "version": old.version + 1})
+    if not await storage.replace_expense(new.dict(by_alias=True), old.version):
+        raise version_conflict()
+    await apply_expense_change(storage, old, new)
+    return new
+
+
+@timed
+async def delete_expense_from_db(storage: Storage, expense_id: str, version: int):
+    old = await get_expense_at_version(storage, expense_id, version)
+    if not await storage.delete_expense(expense_id, version):
+        raise version_conflict()
+    await apply_expense_change(storage, old, None)
+
+
+@timed
+async def add_expenses_to_db_bulk(storage: Storage,
+                                  expenses: List[DbExpense],
+                                  notify: bool = True,
+                                  import_id: Optional[str] = None) -> Dict[int, str]:
+    """Write a batch of expenses with one unordered write per collection.
+
+    Returns the errors keyed by position in ``expenses``; transactions,
+    balances and notification intents are only written for the expenses that
+    were inserted. Intents tagged with ``import_id`` wait for
+    ``Storage.release_notifications``.
+    """
+    if not expenses:
+        return {}
+    errors = await storage.insert_expenses([e.dict(by_alias=True) for e in expenses])
+    inserted = [e for index, e in enumerate(expenses) if index not in errors]
+    await storage.insert_transactions([doc for e in inserted for doc in get_transaction_docs(e)])
+    await update_balances(storage, inserted)
+    await storage.apply_rollup_deltas(get_rollup_deltas(inserted))
+    await storage.bump_ledger_versions(get_expense_members(inserted))
+    if notify:
+        await storage.enqueue_notifications([doc for e in inserted for doc in get_outbox_docs(e, import_id)])
+    return errors
+
+
+def format_balance(row: dict, user_name_map: Dict[str, str]) -> dict:
+    # Expense writes don't check that participants exist, so a counterparty may have no users document.
+    counterparty_id = row["counterparty_id"]
+    return {"user": user_name_map.get(counterparty_id, counterparty_id), "amount_owed": row["amount_owed"]}
+
+
+async def name_balances(rows: List[dict]) -> List[dict]:
+    user_name_map = await get_username([row["counterparty_id"] for row in rows])
+    return [format_balance(row, user_name_map) for row in rows]
+
+
+@timed
+async def get_user_balance(storage: Storage, user_id: str):
+    return await name_balances(await storage.get_balances(user_id))
+
+
+@timed
+async def get_users_balances(storage: Storage, user_ids: List[str]) -> Dict[str, List[dict]]:
+    """Named balances of many users: one balances read and one name lookup for all of them."""
+    rows = await storage.get_balances_of_users(user_ids)
+    counterparty_ids = {row["counterparty_id"] for user_rows in rows.values() for row in user_rows}
+    user_name_map = await get_username(list(counterparty_ids))
+    return {user_id: [format_balance(row, user_name_map) for row in user_rows] for user_id, user_rows in rows.items()}
+
+
+@timed
+async def get_group_user_balance(storage: Storage, group_id: str, user_id: str):
+    return await name_balances(await storage.get_group_balances(group_id, user_id))
+
+
+def encode_expense_cursor(expense: dict) -> str:
+    raw = orjson.dumps({"date": expense["date"].isoformat(), "id": expense["_id"]})
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_expense_cursor(cursor: str) -> Tuple[datetime.datetime, str]:
+    try:
+        raw = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(raw["date"]), raw["id"]
+    except (binascii.Error, orjson.JSONDecodeError, KeyError, TypeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor."
+        )
+
+
+def get_expenses_of_user_cursor(storage: Storage,
+                                user_id: str,
+                                after: Optional[str] = None,
+                                limit: Optional[int] = None) -> AsyncIterator[dict]:
+    # Newest first, keyed on (date, _id) so pages stay stable while new
+    # expenses are added.
+    return storage.find_expenses_of_user(
+        user_id,
+        after=decode_expense_cursor(after) if after is not None else None,
+        limit=limit
+    )
+
+
+def get_expenses_of_group_cursor(storage: Storage,
+                                 group_id: str,
+                                 user_id: Optional[str] = None,
+                                 after: Optional[str] = None,
+                                 limit: Optional[int] = None) -> AsyncIterator[dict]:
+    return storage.find_expenses_of_group(
+        group_id,
+        user_id=user_id,
+        after=decode_expense_cursor(after) if after is not None else None,
+        limit=limit
+    )
+
+
+@timed
+async def get_debt_edges(storage: Storage, user_id: str) -> List[Tuple[str, str, float]]:
+    """Outstanding debts among ``user_id`` and everyone they share a balance with.
+
+    Each pair is stored twice in the ledger; only the side that owes is kept,
+    as a ``(borrower, lender, amount)`` edge.
+    """
+    return await storage.get_debt_edges(user_id)
 
 
 async def get_username(user_idx: List[str] = None):
-    db = get_db()
-    col = db.get_collection("users")
-    if user_idx:
-        query = {"_id": {"$in": user_idx}}
-    else:
-        query = {}
-    projection = {"_id": 1, "name": 1}
+    if user_idx is not None:
+        users = await get_user_directory().lookup(get_storage(), user_idx)
+        return {user_id: user["name"] for user_id, user in users.items()}
     user_email_map = {}
-    async for doc in col.find(query, projection):
+    for doc in await get_storage().get_users():
         user_email_map[doc["_id"]] = doc["name"]
     return user_email_map
 
 
 async def get_emails(user_idx: List[str] = None):
-    db = get_db()
-    col = db.get_collection("users")
-    if user_idx:
-        query = {"_id": {"$in": user_idx}}
-    else:
-        query = {}
-    projection = {"_id": 1, "email": 1}
+    if user_idx is not None:
+        users = await get_user_directory().lookup(get_storage(), user_idx)
+        return {user_id: user["email"] for user_id, user in users.items()}
     user_email_map = {}
-    async for doc in col.find(query, projection):
+    for doc in await get_storage().get_users():
         user_email_map[doc["_id"]] = doc["email"]
     return user_email_map
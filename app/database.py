@@ -1,31 +1,167 @@
 import os
+import threading
+import time
 
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ReadPreference, monitoring
+
+from app.config import env_flag
+from app.metrics import CommandMetricsListener
+
+# Pool settings read from the environment, as (variable, MongoClient option, type).
+POOL_OPTIONS = [
+    ("DB_MAX_POOL_SIZE", "maxPoolSize", int),
+    ("DB_MIN_POOL_SIZE", "minPoolSize", int),
+    ("DB_MAX_IDLE_TIME_MS", "maxIdleTimeMS", int),
+    ("DB_WAIT_QUEUE_TIMEOUT_MS", "waitQueueTimeoutMS", int),
+    ("DB_CONNECT_TIMEOUT_MS", "connectTimeoutMS", int),
+    ("DB_SOCKET_TIMEOUT_MS", "socketTimeoutMS", int),
+    ("DB_SERVER_SELECTION_TIMEOUT_MS", "serverSelectionTimeoutMS", int),
+    ("DB_COMPRESSORS", "compressors", str),
+]
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts pool checkouts and how long callers waited for a connection.
+
+    pymongo emits the check-out started/finished events on the thread doing
+    the check-out, so the start time is kept in a thread-local.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.connections = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _end_wait(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return 0.0 if started is None else time.perf_counter() - started
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waited = self._end_wait()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+    def connection_check_out_failed(self, event):
+        self._end_wait()
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections -= 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "connections": self.connections,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "wait_time_total_s": self.wait_time_total,
+                "wait_time_avg_s": self.wait_time_total / self.checkouts if self.checkouts else 0.0,
+                "wait_time_max_s": self.wait_time_max,
+            }
 
 
 class DatabaseConnectionManager:
+    """Owns the single ``AsyncIOMotorClient`` of this process.
+
+    ``connect`` is called once from the app lifespan; scripts that skip the
+    lifespan get a client on first use of ``get_db``.
+    """
 
     _instance = None
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            # cls._instance.client = AsyncIOMotorClient(os.environ.get("DB_URI"))
-            # cls._instance.db = cls._instance.client[os.environ.get("DB_NAME")]
+            cls._instance.client = None
+            cls._instance.db = None
+            cls._instance.read_db = None
+            cls._instance.pool_stats = PoolStatsListener()
+            cls._instance.command_metrics = CommandMetricsListener()
         return cls._instance
 
-    def __init__(self):
-        self.client = AsyncIOMotorClient(os.environ.get("DB_URI"), uuidRepresentation="standard")
+    def connect(self):
+        if self.client is not None:
+            return
+        options = {}
+        for variable, option, cast in POOL_OPTIONS:
+            value = os.environ.get(variable)
+            if value:
+                options[option] = cast(value)
+        self.client = AsyncIOMotorClient(
+            os.environ.get("DB_URI"),
+            uuidRepresentation="standard",
+            event_listeners=[self.pool_stats, self.command_metrics],
+            **options
+        )
         self.db = self.client[os.environ.get("DB_NAME")]
+        # Read-only paths that tolerate replication lag can opt in to secondaries.
+        if env_flag("DB_SECONDARY_READS"):
+            self.read_db = self.db.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        else:
+            self.read_db = self.db
 
     @property
     def get_db(self):
+        self.connect()
         return self.db
 
+    @property
+    def get_read_db(self):
+        self.connect()
+        return self.read_db
+
     def close_conn(self):
-        self.client.close()
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+            self.db = None
+            self.read_db = None
 
 
 def get_db() -> AsyncIOMotorDatabase:
     db_manager = DatabaseConnectionManager()
     return db_manager.get_db
+
+
+def get_read_db() -> AsyncIOMotorDatabase:
+    db_manager = DatabaseConnectionManager()
+    return db_manager.get_read_db
@@ -1,14 +1,124 @@
+"""Content-addressed storage for receipt images.
+
+Uploads are streamed to disk in ``CHUNK_SIZE`` pieces and hashed on the way,
+then stored as ``<receipts dir>/<sha256[:2]>/<sha256>``; a receipt that is
+uploaded twice is kept once. Nothing is ever held in memory in full.
+"""
+import asyncio
+import hashlib
 import os
+import re
+from typing import AsyncIterator, List, Optional, Tuple
 
 import aiofiles
+import aiofiles.os
+from fastapi import HTTPException
+from starlette import status
+
+from app.config import id_factory
+
+CHUNK_SIZE = 1024 * 1024
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Leading bytes of the formats we expect receipts in.
+MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+]
+
+
+def receipts_dir() -> str:
+    return os.environ.get("RECEIPTS_DIR") or os.path.join(os.getcwd(), "resources", "receipts")
+
+
+def receipt_path(digest: str) -> Optional[str]:
+    if not DIGEST_PATTERN.match(digest):
+        return None
+    return os.path.join(receipts_dir(), digest[:2], digest)
+
+
+async def store_file(image, max_bytes: int) -> str:
+    tmp_dir = os.path.join(receipts_dir(), "tmp")
+    await aiofiles.os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, id_factory())
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as out_file:
+            while chunk := await image.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"{image.filename} is larger than {max_bytes} bytes."
+                    )
+                sha256.update(chunk)
+                await out_file.write(chunk)
+        digest = sha256.hexdigest()
+        out_file_path = receipt_path(digest)
+        if await aiofiles.os.path.exists(out_file_path):
+            await aiofiles.os.remove(tmp_path)
+        else:
+            await aiofiles.os.makedirs(os.path.dirname(out_file_path), exist_ok=True)
+            await aiofiles.os.replace(tmp_path, out_file_path)
+    except BaseException:
+        if await aiofiles.os.path.exists(tmp_path):
+            await aiofiles.os.remove(tmp_path)
+        raise
+    return digest
+
+
+async def store_files(images) -> List[str]:
+    max_bytes = int(os.environ.get("RECEIPT_MAX_BYTES", 10 * 1024 * 1024))
+    results = await asyncio.gather(*(store_file(image, max_bytes) for image in images), return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def sniff_content_type(path: str) -> str:
+    async with aiofiles.open(path, "rb") as in_file:
+        head = await in_file.read(16)
+    for magic, content_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return content_type
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single ``bytes=`` range into an inclusive ``(start, end)``.
+
+    Returns ``None`` when the range cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
 
 
-async def store_files(images):
-    paths = []
-    for image in images:
-        out_file_path = os.path.join(os.getcwd(), "resources", image.filename)
-        async with aiofiles.open(out_file_path, 'wb') as out_file:
-            content = await image.read()
-            await out_file.write(content)
-        paths.append(out_file_path)
-    return ",".join(paths)
+async def iter_file(path: str, start: int, length: int) -> AsyncIterator[bytes]:
+    async with aiofiles.open(path, "rb") as in_file:
+        await in_file.seek(start)
+        while length > 0:
+            chunk = await in_file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
@@ -0,0 +1,205 @@
+"""Leader election for scheduled jobs.
+
+Every worker process starts a ``LeaderScheduler`` from the app lifespan, but
+only the one holding the ``scheduler`` lease in the ``locks`` collection runs
+jobs. The lease is taken with a conditional upsert (free, expired, or already
+ours) and renewed by a heartbeat every third of its TTL; if the leader dies,
+another process takes over once the lease expires.
+
+Job schedules live in the ``job_runs`` collection rather than in each
+process's timers: every process polls, and the leader claims a due run by
+advancing the job's ``next_due`` with a conditional update, so each run is
+claimed once even if two processes briefly both think they lead. A new
+leader after a failover or redeploy carries on from the persisted
+``next_due``, and a run that fell due while nobody held the lease happens as
+soon as someone does. The outcome of every run is recorded there too.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import time
+from typing import Awaitable, Callable, Dict, Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import DuplicateKeyError
+
+from app.config import id_factory
+from app.metrics import JOB_DURATION
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLock:
+
+    def __init__(self, db: AsyncIOMotorDatabase, name: str, ttl: float = 30, owner: Optional[str] = None):
+        self.db = db
+        self.name = name
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{id_factory()[:8]}"
+        self.is_leader = False
+
+    async def try_acquire(self) -> bool:
+        """Take or renew the lease; returns whether this process holds it."""
+        now = datetime.datetime.utcnow()
+        update = {"owner": self.owner, "expires_at": now + self.ttl, "renewed_at": now}
+        if not self.is_leader:
+            update["acquired_at"] = now
+        try:
+            await self.db["locks"].update_one(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": update},
+                upsert=True
+            )
+            acquired = True
+        except DuplicateKeyError:
+            # Someone else holds a live lease, so the filter missed and the
+            # upsert collided with their document.
+            acquired = False
+        if acquired != self.is_leader:
+            logger.info("%s %s lease %s", self.owner, "acquired" if acquired else "lost", self.name)
+        self.is_leader = acquired
+        return acquired
+
+    async def release(self):
+        if self.is_leader:
+            await self.db["locks"].delete_one({"_id": self.name, "owner": self.owner})
+            self.is_leader = False
+
+
+class LeaderScheduler:
+
+    def __init__(self, db: AsyncIOMotorDatabase, ttl: float = 30, poll_interval: float = 10):
+        self.db = db
+        self.lock = LeaseLock(db, "scheduler", ttl=ttl)
+        self.poll_interval = poll_interval
+        self.scheduler = AsyncIOScheduler()
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+
+    def add_job(self, func: Callable[[], Awaitable], every: datetime.timedelta):
+        """Run ``func`` once per ``every`` across all processes sharing the database."""
+        name = func.__name__
+
+        async def poll():
+            if not self.lock.is_leader or name in self._running:
+                return
+            if await self._claim(name, every):
+                task = asyncio.create_task(self._run(name, func), name=f"job-{name}")
+                self._running[name] = task
+                task.add_done_callback(lambda _: self._running.pop(name, None))
+
+        self.scheduler.add_job(poll, "interval", seconds=self.poll_interval, id=name)
+
+    async def _claim(self, name: str, every: datetime.timedelta) -> bool:
+        """Advance the job's ``next_due`` past now if it is due; returns whether this call did."""
+        now = datetime.datetime.utcnow()
+        runs = self.db["job_runs"]
+        doc = await runs.find_one({"_id": name}, {"next_due": 1, "last_started": 1})
+        if doc is None or "next_due" not in doc:
+            # First sighting: due one period after the last run, if any was recorded
+            # before schedules were persisted, or else one period from now.
+            last_started = (doc or {}).get("last_started")
+            try:
+                await runs.update_one(
+                    {"_id": name, "next_due": {"$exists": False}},
+                    {"$set": {"next_due": (last_started or now) + every}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass
+            return False
+        due = doc["next_due"]
+        if due > now:
+            return False
+        # Skip the runs missed while nobody led; one catch-up run is enough.
+        next_due = due + every * ((now - due) // every + 1)
+        result = await runs.update_one({"_id": name, "next_due": due}, {"$set": {"next_due": next_due}})
+        return result.modified_count == 1
+
+    async def _run(self, name: str, func: Callable[[], Awaitable]):
+        started = datetime.datetime.utcnow()
+        timer = time.perf_counter()
+        status, error = "ok", None
+        try:
+            await func()
+        except Exception as err:
+            logger.exception("Scheduled job %s failed", name)
+            status, error = "error", str(err)
+        duration = time.perf_counter() - timer
+        JOB_DURATION.observe(duration, job=name, status=status)
+        await self.db["job_runs"].update_one(
+            {"_id": name},
+            {"$set": {
+                "owner": self.lock.owner,
+                "last_started": started,
+                "last_duration_s": duration,
+                "last_status": status,
+                "last_error": error
+            }, "$inc": {"runs": 1}},
+            upsert=True
+        )
+
+    async def _beat(self):
+        interval = self.lock.ttl.total_seconds() / 3
+        while True:
+            try:
+                await self.lock.try_acquire()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Scheduler lease heartbeat failed")
+                self.lock.is_leader = False
+            await asyncio.sleep(interval)
+
+    async def start(self):
+        await self.lock.try_acquire()
+        self._heartbeat = asyncio.create_task(self._beat())
+        self.scheduler.start()
+
+    async def stop(self):
+        self.scheduler.shutdown(wait=False)
+        for task in list(self._running.values()):
+            task.cancel()
+        await asyncio.gather(*self._running.values(), return_exceptions=True)
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+        await self.lock.release()
+
+    async def status(self) -> dict:
+        return {
+            "owner": self.lock.owner,
+            "is_leader": self.lock.is_leader,
+            "lease": await self.db["locks"].find_one({"_id": self.lock.name}),
+            "jobs": [job async for job in self.db["job_runs"].find()]
+        }
+
+
+_scheduler: Optional[LeaderScheduler] = None
+
+
+def create_scheduler(db: AsyncIOMotorDatabase) -> LeaderScheduler:
+    global _scheduler
+    _scheduler = LeaderScheduler(
+        db,
+        ttl=float(os.environ.get("SCHEDULER_LEASE_SECONDS", 30)),
+        poll_interval=float(os.environ.get("SCHEDULER_POLL_SECONDS", 10))
+    )
+    return _scheduler
+
+
+def get_scheduler() -> Optional[LeaderScheduler]:
+    return _scheduler
+
+
+async def stop_scheduler():
+    global _scheduler
+    if _scheduler is not None:
+        await _scheduler.stop()
+        _scheduler = None
@@ -0,0 +1,243 @@
+"""Maintenance for the materialized ``balances`` and ``group_balances`` ledgers.
+
+``balances`` holds one running total per (user, counterparty) pair and
+``group_balances`` one per (group, user, counterparty), both in integer cents
+(``amount_owed_minor``). Expense writes append to ``transactions`` first and
+``$inc`` the ledgers in separate writes right after, so a crash in between
+leaves the ledgers behind the log. The ``transactions`` log stays the source
+of truth; this module recomputes the ledgers from it and reports or repairs
+any pairs that have drifted. While a compaction run (``app.compaction``) is
+unfinished, its tagged transactions are counted only for the pairs whose
+checkpoint does not hold them yet.
+
+Ledgers written before balances were kept in cents (a float ``amount_owed``),
+or before they existed at all, are migrated by the same rebuild. ``main``
+runs it once per deployment on startup (``migrate_ledger``), under a lease in
+``maintenance`` so only one process rebuilds at a time; ``rebuild`` below
+takes the same lease.
+
+Usage:
+    python -m app.ledger verify
+    python -m app.ledger rebuild
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app.compaction import STATE_ID as COMPACTION_STATE_ID
+from app.config import id_factory
+from app.database import DatabaseConnectionManager
+from app.split import MINOR_UNITS, from_minor
+
+logger = logging.getLogger(__name__)
+
+# Key fields of each ledger, and the transaction field each one is read from.
+LEDGERS: Dict[str, Dict[str, str]] = {
+    "balances": {"user_id": "$payer_id", "counterparty_id": "$payee_id"},
+    "group_balances": {"group_id": "$group_id", "user_id": "$payer_id", "counterparty_id": "$payee_id"},
+}
+REBUILD_BATCH_SIZE = 1000
+MIGRATION_ID = "ledger_minor_units"
+
+
+def migration_lease() -> datetime.timedelta:
+    return datetime.timedelta(seconds=float(os.environ.get("LEDGER_MIGRATION_LEASE_SECONDS", 300)))
+
+
+async def expected_balances(db: AsyncIOMotorDatabase, ledger: str = "balances") -> Dict[Tuple[str, ...], int]:
+    fields = LEDGERS[ledger]
+    # Rounded per transaction, like the $inc-ed deltas.
+    amount = {"$sum": {"$round": [{"$multiply": ["$amount", MINOR_UNITS]}, 0]}}
+    match = {"group_id": {"$ne": None}} if "group_id" in fields else {}
+    compaction = await db["maintenance"].find_one({"_id": COMPACTION_STATE_ID}, {"run_id": 1, "phase": 1})
+    run_id = compaction["run_id"] if compaction and compaction["phase"] != "done" else None
+    expected = collections.defaultdict(int)
+    pipeline = [
+        {"$match": dict(match, compaction_run={"$ne": run_id}) if run_id else match},
+        {"$group": {"_id": fields, "amount_owed_minor": amount}}
+    ]
+    async for row in db["transactions"].aggregate(pipeline, allowDiskUse=True):
+        expected[tuple(row["_id"][field] for field in fields)] += int(row["amount_owed_minor"])
+
+    if run_id:
+        # Rows tagged by the unfinished run stay in the log until its delete phase, while
+        # the checkpoints they were added to already hold them: count each pair once.
+        applied = {
+            (doc.get("group_id"), doc["payer_id"], doc["payee_id"])
+            async for doc in db["transactions"].find(
+                {"checkpoint": True, "applied_runs": run_id}, {"_id": 0, "group_id": 1, "payer_id": 1, "payee_id": 1}
+            )
+        }
+        pipeline = [
+            {"$match": dict(match, compaction_run=run_id)},
+            {"$group": {
+                "_id": {"group_id": {"$ifNull": ["$group_id", None]}, "payer_id": "$payer_id", "payee_id": "$payee_id"},
+                "amount_owed_minor": amount
+            }}
+        ]
+        async for row in db["transactions"].aggregate(pipeline, allowDiskUse=True):
+            pair = row["_id"]
+            if (pair["group_id"], pair["payer_id"], pair["payee_id"]) in applied:
+                continue
+            expected[tuple(pair[source[1:]] for source in fields.values())] += int(row["amount_owed_minor"])
+    return dict(expected)
+
+
+async def find_drift(db: AsyncIOMotorDatabase, ledger: str = "balances") -> List[dict]:
+    """Pairs whose running total differs from the log, in cents.
+
+    Rows still holding a float ``amount_owed`` always count as drifted.
+    """
+    fields = list(LEDGERS[ledger])
+    expected = await expected_balances(db, ledger)
+    drift = []
+    projection = {"_id": 0, "amount_owed_minor": 1, **{field: 1 for field in fields}}
+    async for row in db[ledger].find({}, projection):
+        key = tuple(row[field] for field in fields)
+        want = expected.pop(key, 0)
+        if row.get("amount_owed_minor") != want:
+            drift.append(dict(zip(fields, key), ledger=row.get("amount_owed_minor"), expected=want))
+    # Pairs present in the log but missing from the ledger altogether.
+    for key, want in expected.items():
+        if want:
+            drift.append(dict(zip(fields, key), ledger=None, expected=want))
+    return drift
+
+
+async def rebuild_balances(db: AsyncIOMotorDatabase, ledger: str = "balances") -> List[dict]:
+    """``$inc`` every drifted pair by its difference from the total recomputed from ``transactions``.
+
+    Writes that land after the scan keep their own ``$inc``, so this is safe
+    while the app is running; only a write caught halfway through the scan
+    itself (its transaction read but not yet its ``$inc``, or the reverse)
+    can still be miscounted, which a later ``verify`` shows.
+    """
+    fields = list(LEDGERS[ledger])
+    drift = await find_drift(db, ledger)
+    for start in range(0, len(drift), REBUILD_BATCH_SIZE):
+        updates = [
+            UpdateOne(
+                {field: row[field] for field in fields},
+                # A float amount_owed left from before cents counts as nothing; the log has it all.
+                {"$inc": {"amount_owed_minor": row["expected"] - (row["ledger"] or 0)}, "$unset": {"amount_owed": ""}},
+                upsert=True
+            )
+            for row in drift[start:start + REBUILD_BATCH_SIZE]
+        ]
+        await db[ledger].bulk_write(updates, ordered=False)
+    # Invalidate the cached responses and client ETags of everyone affected.
+    users = {user_id for row in drift for user_id in (row["user_id"], row["counterparty_id"])}
+    if users:
+        await db["ledger_versions"].bulk_write(
+            [UpdateOne({"_id": user_id}, {"$inc": {"version": 1}}, upsert=True) for user_id in users],
+            ordered=False
+        )
+    return drift
+
+
+async def _claim_migration(db: AsyncIOMotorDatabase, owner: str, rerun: bool) -> bool:
+    now = datetime.datetime.utcnow()
+    query = {"_id": MIGRATION_ID, "$or": [{"lease_until": {"$lt": now}}, {"lease_until": {"$exists": False}}]}
+    if not rerun:
+        query["phase"] = {"$ne": "done"}
+    try:
+        await db["maintenance"].update_one(
+            query,
+            {
+                "$set": {"phase": "rebuilding", "owner": owner, "lease_until": now + migration_lease()},
+                "$setOnInsert": {"started": now}
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # Done already, or another process holds a live lease.
+        return False
+    return True
+
+
+async def _renew_migration(db: AsyncIOMotorDatabase, owner: str):
+    lease = migration_lease()
+    while True:
+        await asyncio.sleep(lease.total_seconds() / 3)
+        result = await db["maintenance"].update_one(
+            {"_id": MIGRATION_ID, "owner": owner},
+            {"$set": {"lease_until": datetime.datetime.utcnow() + lease}}
+        )
+        if not result.modified_count:
+            return
+
+
+async def migrate_ledger(db: AsyncIOMotorDatabase, rerun: bool = False) -> Optional[Dict[str, List[dict]]]:
+    """Rebuild both ledgers in cents, once per deployment; returns the drift fixed, or None if another process did.
+
+    The first process to start after an upgrade claims the migration in
+    ``maintenance``; the others carry on without waiting, their writes being
+    kept by the ``$inc``-based rebuild. The claim is a lease renewed while the
+    rebuild runs, so if its holder dies the next process to start (or
+    ``python -m app.ledger rebuild``) picks the migration up once it expires.
+    ``rerun`` rebuilds even when the migration is already done.
+    """
+    owner = id_factory()
+    if not await _claim_migration(db, owner, rerun):
+        return None
+    heartbeat = asyncio.create_task(_renew_migration(db, owner))
+    drift = {}
+    try:
+        for ledger in LEDGERS:
+            if heartbeat.done():
+                logger.error("Lost the ledger migration lease, leaving the rest to its new holder")
+                return None
+            drift[ledger] = await rebuild_balances(db, ledger)
+            logger.info("Rebuilt %d %s row(s) in cents", len(drift[ledger]), ledger)
+    finally:
+        heartbeat.cancel()
+    await db["maintenance"].update_one(
+        {"_id": MIGRATION_ID, "owner": owner},
+        {"$set": {"phase": "done", "finished": datetime.datetime.utcnow()}, "$unset": {"owner": "", "lease_until": ""}}
+    )
+    return drift
+
+
+def format_drift(row: dict) -> str:
+    ledger = from_minor(row["ledger"]) if row["ledger"] is not None else "missing"
+    group = f"[{row['group_id']}] " if "group_id" in row else ""
+    expected = from_minor(row["expected"])
+    return f"  {group}{row['user_id']} -> {row['counterparty_id']}: ledger={ledger} expected={expected}"
+
+
+async def main(command: str):
+    db = DatabaseConnectionManager().get_db
+    try:
+        if command == "rebuild":
+            rebuilt = await migrate_ledger(db, rerun=True)
+            if rebuilt is None:
+                print("Another process is rebuilding the ledgers; try again once it is done.")
+                return
+        for ledger in LEDGERS:
+            if command == "rebuild":
+                drift = rebuilt[ledger]
+                print(f"Rebuilt {len(drift)} drifted {ledger} row(s).")
+            else:
+                drift = await find_drift(db, ledger)
+                print(f"Found {len(drift)} drifted {ledger} row(s).")
+            for row in drift:
+                print(format_drift(row))
+    finally:
+        DatabaseConnectionManager().close_conn()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Verify or rebuild the balances ledgers.")
+    parser.add_argument("command", choices=["verify", "rebuild"])
+    args = parser.parse_args()
+    asyncio.run(main(args.command))
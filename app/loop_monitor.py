@@ -0,0 +1,150 @@
+"""Event-loop lag monitoring.
+
+A heartbeat task on the loop sleeps for ``interval`` and records how late it
+woke up; that lag is how long something else held the loop. A watchdog
+thread checks the heartbeat from outside: when the loop has not beaten for
+``threshold``, it logs the task that is running and the loop thread's
+current stack, once per stall, so the blocking code shows up in the logs
+while it is still blocking.
+
+Configured with ``LOOP_MONITOR`` (on by default), ``LOOP_LAG_INTERVAL_MS``
+(100) and ``LOOP_LAG_WARN_MS`` (250).
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from app.config import env_flag
+from app.metrics import REGISTRY, Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = REGISTRY.register(Histogram(
+    "event_loop_lag_seconds", "How late the event loop heartbeat woke up.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+))
+LOOP_BLOCKS = REGISTRY.register(Counter(
+    "event_loop_blocked_total", "Times the event loop was blocked for longer than the warning threshold."
+))
+LOOP_BLOCKED_SECONDS = REGISTRY.register(Counter(
+    "event_loop_blocked_seconds_total", "Time the event loop spent blocked beyond the heartbeat interval."
+))
+
+
+class LoopMonitor:
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25, stack_depth: int = 15):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.beats = 0
+        self.blocks = 0
+        self.blocked_total = 0.0
+        self.lag_max = 0.0
+        self._last_beat = time.monotonic()
+        self._reported_beat = -1
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._last_beat = now
+            self.beats += 1
+            self.lag_max = max(self.lag_max, lag)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                self.blocks += 1
+                self.blocked_total += lag
+                LOOP_BLOCKS.inc()
+                LOOP_BLOCKED_SECONDS.inc(lag)
+
+    def _describe_running_task(self) -> str:
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            task = None
+        if task is None:
+            return "no task (a callback or the loop itself)"
+        return f"{task.get_name()} {task.get_coro()!r}"
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            stalled = time.monotonic() - self._last_beat - self.interval
+            if stalled < self.threshold or self._reported_beat == self.beats:
+                continue
+            self._reported_beat = self.beats
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit=self.stack_depth)) if frame is not None else ""
+            logger.warning(
+                "Event loop blocked for %.0f ms so far, running %s\n%s",
+                stalled * 1000, self._describe_running_task(), stack
+            )
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._heartbeat(), name="loop-monitor")
+        self._watchdog = threading.Thread(target=self._watch, name="loop-monitor-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def stats(self) -> dict:
+        return {
+            "interval_s": self.interval,
+            "threshold_s": self.threshold,
+            "beats": self.beats,
+            "lag_max_s": self.lag_max,
+            "blocks": self.blocks,
+            "blocked_total_s": self.blocked_total,
+        }
+
+
+_monitor: Optional[LoopMonitor] = None
+
+
+def start_loop_monitor() -> Optional[LoopMonitor]:
+    global _monitor
+    if env_flag("LOOP_MONITOR", default=True):
+        _monitor = LoopMonitor(
+            interval=float(os.environ.get("LOOP_LAG_INTERVAL_MS", 100)) / 1000,
+            threshold=float(os.environ.get("LOOP_LAG_WARN_MS", 250)) / 1000
+        )
+        _monitor.start()
+    return _monitor
+
+
+def get_loop_monitor() -> Optional[LoopMonitor]:
+    return _monitor
+
+
+async def stop_loop_monitor():
+    global _monitor
+    if _monitor is not None:
+        await _monitor.stop()
+        _monitor = None
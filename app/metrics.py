@@ -0,0 +1,254 @@
+"""In-process metrics exported in the Prometheus text format at ``/metrics``.
+
+Only what this app needs: counters, gauges and histograms with labels, all
+safe to update from the threads pymongo runs its monitoring callbacks on.
+"""
+import functools
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Sequence, Tuple, TypeVar
+
+from pymongo import monitoring
+from starlette.routing import Match
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}" for key, value in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(series)) for key, series in self._values.items()]
+        lines = self.header()
+        names = self.labels + ("le",)
+        for key, series in values:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (repr(float(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {series[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {series[-2]}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Run ``collector`` before every render, to refresh gauges sampled from elsewhere."""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ["method", "route", "status"]
+))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served.", ["method", "route"]
+))
+DB_COMMAND_DURATION = REGISTRY.register(Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command latency by collection and command.",
+    ["collection", "command"], buckets=DB_BUCKETS
+))
+DB_COMMAND_FAILURES = REGISTRY.register(Counter(
+    "mongodb_command_failures_total", "Failed MongoDB commands by collection and command.", ["collection", "command"]
+))
+JOB_DURATION = REGISTRY.register(Histogram(
+    "scheduler_job_duration_seconds", "Scheduled job run time.", ["job", "status"],
+    buckets=(0.1, 1, 5, 15, 60, 300, 900, 3600)
+))
+NOTIFICATIONS = REGISTRY.register(Counter(
+    "notifications_total", "Email delivery attempts by outcome.", ["outcome"]
+))
+OPERATION_DURATION = REGISTRY.register(Histogram(
+    "app_operation_duration_seconds", "Latency of instrumented data-access functions.", ["operation", "status"]
+))
+
+T = TypeVar("T")
+
+
+def timed(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+    """Record the run time of an async function in ``app_operation_duration_seconds``."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await func(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            OPERATION_DURATION.observe(time.perf_counter() - started, operation=name, status=outcome)
+
+    return wrapper
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Times every MongoDB command, labelled with its collection and command name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[int, int], Tuple[str, str]] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = "-"
+        with self._lock:
+            self._pending[(event.request_id, event.operation_id)] = (collection, event.command_name)
+
+    def _finish(self, event):
+        with self._lock:
+            return self._pending.pop((event.request_id, event.operation_id), None)
+
+    def succeeded(self, event):
+        labels = self._finish(event)
+        if labels is not None:
+            DB_COMMAND_DURATION.observe(event.duration_micros / 1e6, collection=labels[0], command=labels[1])
+
+    def failed(self, event):
+        labels = self._finish(event)
+        if labels is not None:
+            DB_COMMAND_DURATION.observe(event.duration_micros / 1e6, collection=labels[0], command=labels[1])
+            DB_COMMAND_FAILURES.inc(collection=labels[0], command=labels[1])
+
+
+def route_template(scope) -> str:
+    """The path template of the route serving ``scope``, matched once per request."""
+    template = scope.get("route_template")
+    if template is None:
+        template = "unmatched"
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                template = route.path
+                break
+        scope["route_template"] = template
+    return template
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and in-flight requests per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method, route = scope["method"], route_template(scope)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(method=method, route=route)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec(method=method, route=route)
+            REQUEST_DURATION.observe(
+                time.perf_counter() - started, method=method, route=route, status=str(status_code)
+            )
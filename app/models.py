@@ -1,7 +1,7 @@
 import datetime
 from typing import Optional, List
 
-from pydantic import BaseModel, ConfigDict, Field, NonNegativeFloat, EmailStr, FilePath
+from pydantic import BaseModel, ConfigDict, Field, NonNegativeFloat, EmailStr, field_validator
 
 from app.config import id_factory
 
@@ -29,5 +29,26 @@ class DbExpense(BaseModel):
     date: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
     name: Optional[str] = Field(max_length=128)
     notes: Optional[str] = Field(max_length=500)
-    images: Optional[List[FilePath]]
+    images: Optional[List[str]]  # SHA-256 digests of the stored receipts
     participants: List[DbParticipant]
+    group_id: Optional[str] = None
+    category: Optional[str] = None
+    # Bumped on every edit; expenses stored before edits existed have none and count as 1.
+    version: int = 1
+
+    @field_validator("images", mode="before")
+    @classmethod
+    def split_legacy_images(cls, value):
+        # Receipts uploaded before content addressing were stored as one comma-joined string of file paths.
+        if isinstance(value, str):
+            return [path for path in value.split(",") if path]
+        return value
+
+
+class DbGroup(BaseModel):
+    model_config = ConfigDict(populate_by_name=False)
+
+    id: str = Field(default_factory=id_factory, alias="_id")
+    name: str = Field(max_length=128)
+    member_ids: List[str]
+    created: datetime.datetime = Field(default_factory=datetime.datetime.utcnow)
@@ -1,36 +1,205 @@
 import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from email.message import EmailMessage
+from typing import Iterable, List, Optional
 
 from fastapi import FastAPI
-from aiosmtplib import SMTP
-from email.message import EmailMessage
+from aiosmtplib import SMTP, SMTPException, SMTPRecipientsRefused, SMTPResponseException
 
-from app.models import DbExpense
-from app.crud import get_emails
+from app.config import env_flag
+from app.metrics import NOTIFICATIONS
 app = FastAPI()
 
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DeliveryStats:
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+
+    def add(self, other: "DeliveryStats"):
+        self.sent += other.sent
+        self.failed += other.failed
+        self.retried += other.retried
+
+
+class _Session:
+
+    def __init__(self, smtp: SMTP):
+        self.smtp = smtp
+        self.messages_sent = 0
+
+
+def _is_permanent(err: Exception) -> bool:
+    # 5xx replies will not change on retry; connection drops and 4xx replies might.
+    if isinstance(err, SMTPRecipientsRefused):
+        return all(r.code >= 500 for r in err.recipients)
+    if isinstance(err, SMTPResponseException):
+        return err.code >= 500
+    return False
+
+
+class MailTransport:
+    """A small pool of long-lived SMTP sessions shared by all outgoing mail.
+
+    At most ``pool_size`` sessions are open at once and at most
+    ``max_concurrency`` messages are in flight (including retry back-off).
+    Sessions are reused until ``messages_per_session`` messages have gone
+    through them or they fail, and transient failures are retried with
+    exponential back-off.
+    """
+
+    def __init__(self,
+                 hostname: str,
+                 port: int,
+                 sender: str,
+                 username: Optional[str] = None,
+                 password: Optional[str] = None,
+                 use_tls: bool = False,
+                 start_tls: Optional[bool] = None,
+                 timeout: float = 30,
+                 pool_size: int = 4,
+                 max_concurrency: int = 16,
+                 max_retries: int = 3,
+                 backoff: float = 0.5,
+                 messages_per_session: int = 100):
+        self.hostname = hostname
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.messages_per_session = messages_per_session
+        self.stats = DeliveryStats()
+        self._idle: List[_Session] = []
+        self._slots = asyncio.Semaphore(pool_size)
+        self._in_flight = asyncio.Semaphore(max_concurrency)
+
+    @classmethod
+    def from_env(cls) -> "MailTransport":
+        return cls(
+            hostname=os.environ.get("SMTP_HOST", "smtp.example.com"),
+            port=int(os.environ.get("SMTP_PORT", 587)),
+            sender=os.environ.get("SMTP_SENDER", "your@example.com"),
+            username=os.environ.get("SMTP_USERNAME") or None,
+            password=os.environ.get("SMTP_PASSWORD") or None,
+            use_tls=env_flag("SMTP_USE_TLS"),
+            start_tls=env_flag("SMTP_START_TLS", default=None),
+            timeout=float(os.environ.get("SMTP_TIMEOUT", 30)),
+            pool_size=int(os.environ.get("SMTP_POOL_SIZE", 4)),
+            max_concurrency=int(os.environ.get("SMTP_MAX_CONCURRENCY", 16)),
+            max_retries=int(os.environ.get("SMTP_MAX_RETRIES", 3)),
+            backoff=float(os.environ.get("SMTP_RETRY_BACKOFF", 0.5)),
+            messages_per_session=int(os.environ.get("SMTP_MESSAGES_PER_SESSION", 100)),
+        )
+
+    def build_message(self, to_email: str, subject: str, body: str) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = to_email
+        message["Subject"] = subject
+        message.set_content(body)
+        return message
+
+    async def _open_session(self) -> _Session:
+        smtp = SMTP(
+            hostname=self.hostname,
+            port=self.port,
+            username=self.username,
+            password=self.password,
+            use_tls=self.use_tls,
+            start_tls=self.start_tls,
+            timeout=self.timeout,
+        )
+        await smtp.connect()
+        return _Session(smtp)
+
+    @staticmethod
+    async def _close_session(session: _Session):
+        try:
+            await session.smtp.quit()
+        except SMTPException:
+            session.smtp.close()
+
+    async def _send_once(self, message: EmailMessage):
+        async with self._slots:
+            session = self._idle.pop() if self._idle else None
+            if session is None or not session.smtp.is_connected:
+                session = await self._open_session()
+            try:
+                await session.smtp.send_message(message)
+            except BaseException:
+                session.smtp.close()
+                raise
+            session.messages_sent += 1
+            if session.messages_sent >= self.messages_per_session:
+                await self._close_session(session)
+            else:
+                self._idle.append(session)
+
+    async def _deliver(self, message: EmailMessage) -> DeliveryStats:
+        stats = DeliveryStats()
+        async with self._in_flight:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    await self._send_once(message)
+                    stats.sent += 1
+                    NOTIFICATIONS.inc(outcome="sent")
+                    return stats
+                except (SMTPException, OSError) as err:
+                    if _is_permanent(err) or attempt == self.max_retries:
+                        logger.warning("Failed to send email to %s: %s", message["To"], err)
+                        stats.failed += 1
+                        NOTIFICATIONS.inc(outcome="failed")
+                        return stats
+                    stats.retried += 1
+                    NOTIFICATIONS.inc(outcome="retried")
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+        return stats
+
+    async def send(self, message: EmailMessage) -> bool:
+        stats = await self._deliver(message)
+        self.stats.add(stats)
+        return stats.sent == 1
+
+    async def send_many(self, messages: Iterable[EmailMessage]) -> DeliveryStats:
+        stats = DeliveryStats()
+        for result in await asyncio.gather(*(self._deliver(message) for message in messages)):
+            stats.add(result)
+        self.stats.add(stats)
+        return stats
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for session in idle:
+            await self._close_session(session)
+
+
+_transport: Optional[MailTransport] = None
+
+
+def get_transport() -> MailTransport:
+    global _transport
+    if _transport is None:
+        _transport = MailTransport.from_env()
+    return _transport
+
+
+async def close_transport():
+    global _transport
+    if _transport is not None:
+        await _transport.close()
+        _transport = None
+
 
-async def send_email_async(to_email: str, subject: str, body: str):
-    try:
-        async with SMTP(hostname="smtp.example.com", port=587, use_tls=True) as smtp:
-            message = EmailMessage()
-            message["From"] = "your@example.com"
-            message["To"] = to_email
-            message["Subject"] = subject
-            message.set_content(body)
-            await smtp.send_message(message)
-    except:
-        pass
-
-
-async def send_expense_notification(expense: DbExpense):
-    subject = "New Expense Added"
-    users = [expense.payee_id] + list(set(p.user_id for p in expense.participants))
-    user_email_map = await get_emails(users)
-    tasks = []
-    for participant in expense.participants:
-        if participant.user_id == expense.payee_id:
-            body = f"You created a new expense. Amount paid = {expense.amount}"
-        else:
-            body = f"You have been added to a new expense. Total amount owed: {participant.amount}"
-        tasks.append(asyncio.create_task(send_email_async(user_email_map[participant.user_id], subject, body)))
-    await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+async def send_email_async(to_email: str, subject: str, body: str) -> bool:
+    transport = get_transport()
+    return await transport.send(transport.build_message(to_email, subject, body))
@@ -0,0 +1,92 @@
+"""Run CPU-bound steps off the event loop.
+
+``run_cpu`` calls the function inline for small inputs and hands it to a pool
+once ``size`` reaches ``CPU_OFFLOAD_MIN_SIZE``, so a large simplify or split
+no longer stalls every other request on the worker. ``CPU_OFFLOAD_EXECUTOR``
+picks the pool:
+
+- ``thread`` (default): no pickling; keeps the loop responsive, although
+  pure-Python work still competes for the GIL.
+- ``process``: true parallelism; functions and arguments must be picklable.
+  Workers are started with ``forkserver`` so they never inherit the Motor
+  client's threads.
+- ``none``: always inline.
+
+``CPU_OFFLOAD_WORKERS`` sizes the pool (default: the executor's own default).
+"""
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+from typing import Callable, Optional, TypeVar
+
+from app.metrics import REGISTRY, Counter
+
+EXECUTORS = ("thread", "process", "none")
+
+OFFLOADED = REGISTRY.register(Counter(
+    "cpu_offload_calls_total", "CPU-bound calls by where they ran.", ["function", "where"]
+))
+
+T = TypeVar("T")
+
+_executor: Optional[concurrent.futures.Executor] = None
+_kind: Optional[str] = None
+
+
+def executor_kind() -> str:
+    kind = os.environ.get("CPU_OFFLOAD_EXECUTOR", "thread").strip().lower()
+    if kind not in EXECUTORS:
+        raise ValueError(f"Unknown CPU_OFFLOAD_EXECUTOR {kind!r}, expected one of {', '.join(EXECUTORS)}.")
+    return kind
+
+
+def offload_threshold() -> int:
+    return int(os.environ.get("CPU_OFFLOAD_MIN_SIZE", 1000))
+
+
+def get_executor() -> Optional[concurrent.futures.Executor]:
+    global _executor, _kind
+    if _kind is None:
+        _kind = executor_kind()
+        workers = int(os.environ.get("CPU_OFFLOAD_WORKERS", 0)) or None
+        if _kind == "thread":
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cpu-offload")
+        elif _kind == "process":
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("forkserver")
+            )
+    return _executor
+
+
+async def run_cpu(func: Callable[..., T], *args, size: int, **kwargs) -> T:
+    """``func(*args, **kwargs)``, in the pool when ``size`` reaches the threshold."""
+    name = getattr(func, "__name__", "call")
+    executor = get_executor() if size >= offload_threshold() else None
+    if executor is None:
+        OFFLOADED.inc(function=name, where="inline")
+        return func(*args, **kwargs)
+    OFFLOADED.inc(function=name, where=_kind)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def _noop():
+    return None
+
+
+async def start_offload():
+    """Create the pool, and start process workers now rather than on the first request."""
+    executor = get_executor()
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        loop = asyncio.get_running_loop()
+        workers = int(os.environ.get("CPU_OFFLOAD_WORKERS", 0)) or os.cpu_count()
+        await asyncio.gather(*(loop.run_in_executor(executor, _noop) for _ in range(workers)))
+
+
+def stop_offload():
+    global _executor, _kind
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+    _executor, _kind = None, None
@@ -0,0 +1,206 @@
+"""Durable dispatch of expense notifications.
+
+``add_expense_to_db`` writes one notification intent per recipient into the
+``outbox`` collection. ``OutboxDispatcher`` runs next to the app and, in a
+loop:
+
+1. claims up to ``batch_size`` due intents by pushing their ``lease_until``
+   forward and stamping them with a fresh lease token, so other dispatchers
+   skip them and a crashed dispatcher's claims become due again once the
+   lease runs out. Intents of a bulk import (``import_id``) are claimed
+   together with every other due intent of the same recipient and import,
+   even past ``batch_size``;
+2. merges the claimed intents per recipient into a single email, with one
+   summary line per bulk import;
+3. marks them ``delivered``, or pushes ``lease_until`` back with exponential
+   back-off, giving up (``failed``) after ``max_attempts``. These updates only
+   touch intents still carrying this claim's lease token, so a dispatcher
+   whose lease ran out cannot overwrite a newer claim.
+"""
+import asyncio
+import collections
+import datetime
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.config import env_flag, float_scale, id_factory
+from app.crud import get_emails
+from app.notification import get_transport
+from app.split import from_minor, to_minor
+
+logger = logging.getLogger(__name__)
+
+
+def format_import_digest(intents: List[dict]) -> str:
+    """One line for the intents of one recipient in one bulk import."""
+    paid = sum(to_minor(intent["amount"]) for intent in intents if intent["role"] == "payee")
+    owed = sum(to_minor(intent["amount"]) for intent in intents if intent["role"] != "payee")
+    line = f"{len(intents)} new expense(s) involving you were added."
+    if paid:
+        line += f" Amount paid = {float_scale(from_minor(paid))}."
+    if owed:
+        line += f" Total amount owed: {float_scale(from_minor(owed))}."
+    return line
+
+
+def format_notification(intents: List[dict]) -> str:
+    lines = []
+    imports: Dict[str, List[dict]] = collections.defaultdict(list)
+    for intent in intents:
+        if intent.get("import_id"):
+            imports[intent["import_id"]].append(intent)
+            continue
+        name = f" \"{intent['expense_name']}\"" if intent.get("expense_name") else ""
+        amount = float_scale(intent["amount"])
+        if intent["role"] == "payee":
+            lines.append(f"You created a new expense{name}. Amount paid = {amount}")
+        else:
+            lines.append(f"You have been added to a new expense{name}. Total amount owed: {amount}")
+    lines.extend(format_import_digest(digest) for digest in imports.values())
+    return "\n".join(lines)
+
+
+class OutboxDispatcher:
+
+    def __init__(self,
+                 db: AsyncIOMotorDatabase,
+                 batch_size: int = 500,
+                 lease: float = 60,
+                 poll_interval: float = 1,
+                 max_attempts: int = 5,
+                 backoff: float = 30):
+        self.db = db
+        self.batch_size = batch_size
+        self.lease = datetime.timedelta(seconds=lease)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, db: AsyncIOMotorDatabase) -> "OutboxDispatcher":
+        return cls(
+            db,
+            batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", 500)),
+            lease=float(os.environ.get("OUTBOX_LEASE_SECONDS", 60)),
+            poll_interval=float(os.environ.get("OUTBOX_POLL_SECONDS", 1)),
+            max_attempts=int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 5)),
+            backoff=float(os.environ.get("OUTBOX_RETRY_BACKOFF_SECONDS", 30)),
+        )
+
+    async def claim(self) -> Tuple[str, List[dict]]:
+        """Claim a batch of due intents; returns the lease token and the claimed intents."""
+        outbox = self.db["outbox"]
+        now = datetime.datetime.utcnow()
+        due = {"status": "pending", "lease_until": {"$lte": now}}
+        token = id_factory()
+        lease = {"$set": {"lease_until": now + self.lease, "lease_token": token}}
+        cursor = outbox.find(due, {"_id": 1, "recipient_id": 1, "import_id": 1}).sort("lease_until", 1)
+        docs = [doc async for doc in cursor.limit(self.batch_size)]
+        if not docs:
+            return token, []
+        await outbox.update_many({"_id": {"$in": [doc["_id"] for doc in docs]}, **due}, lease)
+        # Send each bulk import as one digest per recipient, however many batches it spans.
+        imports = {(doc["recipient_id"], doc["import_id"]) for doc in docs if doc.get("import_id")}
+        if imports:
+            await outbox.update_many(
+                {"$or": [{"recipient_id": user_id, "import_id": import_id} for user_id, import_id in imports], **due},
+                lease
+            )
+        return token, [doc async for doc in outbox.find({"lease_token": token})]
+
+    async def _retry(self, intents: List[dict], token: str, now: datetime.datetime):
+        outbox = self.db["outbox"]
+        by_attempts: Dict[int, List[str]] = collections.defaultdict(list)
+        for intent in intents:
+            by_attempts[intent["attempts"] + 1].append(intent["_id"])
+        for attempts, ids in by_attempts.items():
+            if attempts >= self.max_attempts:
+                update = {"$set": {"status": "failed", "attempts": attempts}}
+            else:
+                delay = datetime.timedelta(seconds=self.backoff * 2 ** (attempts - 1))
+                update = {"$set": {"attempts": attempts, "lease_until": now + delay}}
+            await outbox.update_many({"_id": {"$in": ids}, "lease_token": token}, update)
+
+    async def dispatch_once(self) -> int:
+        """Claim and send one batch; returns the number of intents claimed."""
+        token, intents = await self.claim()
+        if not intents:
+            return 0
+        by_recipient: Dict[str, List[dict]] = collections.defaultdict(list)
+        for intent in intents:
+            by_recipient[intent["recipient_id"]].append(intent)
+        user_email_map = await get_emails(list(by_recipient))
+
+        transport = get_transport()
+        recipients = [user_id for user_id in by_recipient if user_id in user_email_map]
+        results = await asyncio.gather(*(
+            transport.send(transport.build_message(
+                user_email_map[user_id],
+                "New Expense Added" if len(by_recipient[user_id]) == 1 else "New Expenses Added",
+                format_notification(by_recipient[user_id])
+            ))
+            for user_id in recipients
+        ))
+
+        now = datetime.datetime.utcnow()
+        delivered = [i["_id"] for user_id, sent in zip(recipients, results) if sent for i in by_recipient[user_id]]
+        failed = [i for user_id, sent in zip(recipients, results) if not sent for i in by_recipient[user_id]]
+        unknown = [i["_id"] for user_id in by_recipient if user_id not in user_email_map for i in by_recipient[user_id]]
+        outbox = self.db["outbox"]
+        if delivered:
+            await outbox.update_many(
+                {"_id": {"$in": delivered}, "lease_token": token},
+                {"$set": {"status": "delivered", "delivered_at": now}}
+            )
+        if unknown:
+            await outbox.update_many({"_id": {"$in": unknown}, "lease_token": token}, {"$set": {"status": "failed"}})
+        if failed:
+            await self._retry(failed, token, now)
+        return len(intents)
+
+    async def run(self):
+        while True:
+            try:
+                claimed = await self.dispatch_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                claimed = 0
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+_dispatcher: Optional[OutboxDispatcher] = None
+
+
+def start_outbox_dispatcher(db: AsyncIOMotorDatabase) -> Optional[OutboxDispatcher]:
+    global _dispatcher
+    if env_flag("OUTBOX_DISPATCHER", default=True):
+        _dispatcher = OutboxDispatcher.from_env(db)
+        _dispatcher.start()
+    return _dispatcher
+
+
+async def stop_outbox_dispatcher():
+    global _dispatcher
+    if _dispatcher is not None:
+        await _dispatcher.stop()
+        _dispatcher = None
@@ -0,0 +1,83 @@
+"""Conditional GETs for per-user reads, keyed on the user's ledger version.
+
+Every write that changes a user's balances or expense history bumps that
+user's version (see ``Storage.bump_ledger_versions``). The balance and
+history endpoints read the version first and send it as the ``ETag``; a
+client that already has it gets a 304 without the balances or expenses being
+read at all. Rendered bodies are also kept in ``ResponseCache``, an LRU
+capped at ``RESPONSE_CACHE_SIZE`` entries, keyed by the version, so repeat
+polls from other clients are served from memory.
+"""
+import collections
+import os
+from typing import Hashable, Optional, Tuple
+
+from fastapi import Request, Response
+from starlette import status
+
+# Clients may keep the body but must revalidate it on every use.
+CACHE_CONTROL = "private, no-cache"
+
+CachedResponse = Tuple[bytes, dict]
+
+
+class ResponseCache:
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[Hashable, CachedResponse]" = collections.OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: Hashable, body: bytes, headers: Optional[dict] = None):
+        if self.capacity <= 0:
+            return
+        self._entries[key] = (body, headers or {})
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+
+_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(capacity=int(os.environ.get("RESPONSE_CACHE_SIZE", 4096)))
+    return _cache
+
+
+def ledger_etag(user_id: str, version: int) -> str:
+    return f'"{user_id}.{version}"'
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 response if the client's ``If-None-Match`` already has ``etag``."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag, "Cache-Control": CACHE_CONTROL}
+        )
+    return None
+
+
+def cached_json(body: bytes, etag: str, headers: Optional[dict] = None) -> Response:
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers=dict(headers or {}, ETag=etag, **{"Cache-Control": CACHE_CONTROL})
+    )
@@ -0,0 +1,196 @@
+"""Per-user spending rollups, bucketed by month and by ISO week.
+
+Every write that adds, edits or deletes an expense ``$inc``-s the buckets of
+its members (see ``get_rollup_deltas``), so ``GET /users/analytics/{user_id}``
+reads one small document per period instead of the user's expenses. Each
+bucket holds:
+
+* ``count``: expenses the user was on,
+* ``spent``: the user's own share of them, also split by ``categories``,
+* ``paid``: what the user paid as the payee,
+* ``counterparties``: how much the user's balance with each counterparty
+  moved (positive: the user owes more).
+
+Categories and counterparty ids become field names under ``categories`` and
+``counterparties``, escaped by ``to_field_name`` so that a ``.`` or ``$`` in
+them cannot make an invalid or nested ``$inc`` path.
+
+Buckets can be rebuilt from ``expenses`` for data written before rollups
+existed, or after a crash between the expense and rollup writes:
+
+Usage:
+    python -m app.rollups backfill
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import logging
+import urllib.parse
+from typing import Dict, Iterable, List, Tuple
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne, UpdateOne
+
+from app.config import id_factory
+from app.database import DatabaseConnectionManager
+from app.models import DbExpense
+from app.storage.base import RollupDeltas
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ("month", "week")
+UNCATEGORIZED = "uncategorized"
+BACKFILL_BATCH_SIZE = 1000
+
+
+def period_start(period: str, date: datetime.datetime) -> datetime.datetime:
+    if period == "month":
+        return datetime.datetime(date.year, date.month, 1)
+    day = date.date() - datetime.timedelta(days=date.weekday())
+    return datetime.datetime(day.year, day.month, day.day)
+
+
+def shift_period(period: str, start: datetime.datetime, count: int) -> datetime.datetime:
+    """The start of the period ``count`` periods after (or before, if negative) the one at ``start``."""
+    if period == "month":
+        month = start.year * 12 + start.month - 1 + count
+        return datetime.datetime(month // 12, month % 12 + 1, 1)
+    return start + datetime.timedelta(weeks=count)
+
+
+def count_periods(period: str, start: datetime.datetime, end: datetime.datetime) -> int:
+    """How many periods start in ``[start, end)``, both being period starts."""
+    if period == "month":
+        return (end.year * 12 + end.month) - (start.year * 12 + start.month)
+    return (end - start).days // 7
+
+
+def to_field_name(key: str) -> str:
+    """``key`` as one field name: ``%``, ``.`` and ``$`` are percent-encoded, and ``""`` is ``"%"``."""
+    return key.replace("%", "%25").replace(".", "%2E").replace("$", "%24") or "%"
+
+
+def from_field_name(name: str) -> str:
+    return "" if name == "%" else urllib.parse.unquote(name)
+
+
+def get_rollup_deltas(expenses: Iterable[DbExpense], sign: int = 1) -> RollupDeltas:
+    """Bucket increments for ``expenses``; ``sign=-1`` takes them back out."""
+    deltas = collections.defaultdict(lambda: collections.defaultdict(float))
+    for expense in expenses:
+        category = to_field_name(expense.category or UNCATEGORIZED)
+        payee = to_field_name(expense.payee_id)
+        fields = collections.defaultdict(lambda: collections.defaultdict(float))
+        fields[expense.payee_id]["paid"] += expense.amount
+        for participant in expense.participants:
+            fields[participant.user_id]["spent"] += participant.amount
+            fields[participant.user_id][f"categories.{category}"] += participant.amount
+            if participant.user_id != expense.payee_id:
+                fields[participant.user_id][f"counterparties.{payee}"] += participant.amount
+                fields[expense.payee_id][f"counterparties.{to_field_name(participant.user_id)}"] -= participant.amount
+        for user_id, user_fields in fields.items():
+            user_fields["count"] += 1
+            for period in PERIODS:
+                bucket = deltas[(user_id, period, period_start(period, expense.date))]
+                for path, amount in user_fields.items():
+                    bucket[path] += sign * amount
+    return deltas
+
+
+def merge_rollup_deltas(*all_deltas: RollupDeltas) -> RollupDeltas:
+    merged = collections.defaultdict(lambda: collections.defaultdict(float))
+    for deltas in all_deltas:
+        for key, fields in deltas.items():
+            for path, amount in fields.items():
+                merged[key][path] += amount
+    return merged
+
+
+def expand_fields(fields: Dict[str, float]) -> dict:
+    """``{"categories.food": 1}`` -> ``{"categories": {"food": 1}}``."""
+    doc = {}
+    for path, amount in fields.items():
+        top, _, sub = path.partition(".")
+        if sub:
+            doc.setdefault(top, {})[sub] = amount
+        else:
+            doc[top] = amount
+    return doc
+
+
+def bucket_counterparties(bucket: dict) -> List[str]:
+    return [from_field_name(name) for name in bucket.get("counterparties", {})]
+
+
+def format_bucket(bucket: dict, user_name_map: Dict[str, str]) -> dict:
+    """The bucket with its field names turned back into categories and (named) counterparties."""
+    return {
+        "start": bucket["start"],
+        "count": int(bucket.get("count", 0)),
+        "spent": round(bucket.get("spent", 0.0), 2),
+        "paid": round(bucket.get("paid", 0.0), 2),
+        "categories": {
+            from_field_name(name): round(amount, 2)
+            for name, amount in bucket.get("categories", {}).items() if round(amount, 2)
+        },
+        "counterparties": {
+            user_name_map.get(from_field_name(name), from_field_name(name)): round(amount, 2)
+            for name, amount in bucket.get("counterparties", {}).items() if round(amount, 2)
+        }
+    }
+
+
+async def backfill_rollups(db: AsyncIOMotorDatabase) -> int:
+    """Recompute every bucket from ``expenses`` and drop the ones no expense backs.
+
+    Run this while writes are paused; an expense written during the scan may
+    be counted twice or not at all.
+    """
+    run_id = id_factory()
+    totals: Dict[Tuple[str, str, datetime.datetime], Dict[str, float]] = collections.defaultdict(
+        lambda: collections.defaultdict(float)
+    )
+    async for doc in db["expenses"].find({}):
+        for key, fields in get_rollup_deltas([DbExpense(**doc)]).items():
+            for path, amount in fields.items():
+                totals[key][path] += amount
+
+    updates: List[ReplaceOne] = []
+    for (user_id, period, start), fields in totals.items():
+        bucket = {"user_id": user_id, "period": period, "start": start}
+        updates.append(ReplaceOne(bucket, dict(bucket, backfill_run=run_id, **expand_fields(fields)), upsert=True))
+        if len(updates) >= BACKFILL_BATCH_SIZE:
+            await db["spending_rollups"].bulk_write(updates, ordered=False)
+            updates.clear()
+    if updates:
+        await db["spending_rollups"].bulk_write(updates, ordered=False)
+    await db["spending_rollups"].delete_many({"backfill_run": {"$ne": run_id}})
+
+    # Invalidate the cached analytics of everyone who has buckets.
+    users = {user_id for user_id, _, _ in totals}
+    if users:
+        await db["ledger_versions"].bulk_write(
+            [UpdateOne({"_id": user_id}, {"$inc": {"version": 1}}, upsert=True) for user_id in users],
+            ordered=False
+        )
+    logger.info("Backfilled %d rollup bucket(s) for %d user(s)", len(totals), len(users))
+    return len(totals)
+
+
+async def main():
+    db = DatabaseConnectionManager().get_db
+    try:
+        count = await backfill_rollups(db)
+        print(f"Backfilled {count} rollup bucket(s).")
+    finally:
+        DatabaseConnectionManager().close_conn()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Rebuild the spending rollups from the expenses.")
+    parser.add_argument("command", choices=["backfill"])
+    parser.parse_args()
+    asyncio.run(main())
@@ -1,34 +1,33 @@
-from typing import List
+from typing import List, Optional
 
-from fastapi import HTTPException, APIRouter, Depends, UploadFile, BackgroundTasks
-from motor.motor_asyncio import AsyncIOMotorDatabase
+import aiofiles.os
+import orjson
+from fastapi import HTTPException, APIRouter, Depends, UploadFile, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from starlette import status
 
-from app.config import float_scale
-from app.crud import add_expense_to_db, expense_adapter
-from app.database import get_db
-from app.file_io import store_files
-from app.notification import send_expense_notification
-from app.schema import ExpenseResponse, AddExpensePayload, Expense
+from app.bulk_import import (CSV_CONTENT_TYPES, NDJSON_CONTENT_TYPES, build_expenses, format_validation_error,
+                             iter_lines, iter_records, parse_payload)
+from app.config import id_factory
+from app.crud import (add_expense_to_db, add_expenses_to_db_bulk, check_group_expense, delete_expense_from_db,
+                      expense_adapter, get_debt_edges, get_expenses_of_user_cursor, encode_expense_cursor,
+                      update_expense_in_db)
+from app.file_io import iter_file, parse_range, receipt_path, sniff_content_type, store_files
+from app.offload import run_cpu
+from app.response_cache import cached_json, get_response_cache, ledger_etag, not_modified
+from app.schema import ExpenseResponse, AddExpensePayload, Expense, UpdateExpensePayload
 from app.simplify_expenses import simplify_balances
+from app.storage import Storage, get_read_storage, get_storage
 
 expense_router = APIRouter(prefix="/expenses")
 
 
 @expense_router.get("/{expense_id}", response_model=ExpenseResponse)
-async def get_expense(expense_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
+async def get_expense(expense_id: str, storage: Storage = Depends(get_storage)):
     try:
         # Retrieve expense by ID
-        query = {"_id": expense_id}
-        projection = {
-            "_id": 0,
-            "amount": 1,
-            "date": 1,
-            "name": 1,
-            "notes": 1,
-            "participants": 1
-        }
-        expense = await db["expenses"].find_one(query, projection)
+        expense = await storage.get_expense(expense_id)
         if expense is None:
             raise HTTPException(status_code=404, detail="Expense not found")
         return expense
@@ -38,8 +37,7 @@ async def get_expense(expense_id: str, db: AsyncIOMotorDatabase = Depends(get_db
 
 @expense_router.post("/")
 async def add_expense(payload: AddExpensePayload,
-                      background_tasks: BackgroundTasks,
-                      db: AsyncIOMotorDatabase = Depends(get_db)):
+                      storage: Storage = Depends(get_storage)):
     # out_file_paths = None
     # if images:
     #     out_file_paths = await store_files(images)   # On disk or cloud
@@ -50,62 +48,252 @@ async def add_expense(payload: AddExpensePayload,
         expense_type=payload.expense_type.upper(),
         name=payload.name,
         notes=payload.notes,
-        participants=payload.participants
+        participants=payload.participants,
+        group_id=payload.group_id,
+        category=payload.category
     )
+    await check_group_expense(storage, payload)
     expenses = await expense_adapter(payload)
-    background_tasks.add_task(send_expense_notification, expenses)
-    expense_id = await add_expense_to_db(db, expenses)
+    expense_id = await add_expense_to_db(storage, expenses)
     return {"expenseId": expense_id, "message": "Expense added successfully"}
 
 
+@expense_router.patch("/{expense_id}")
+async def update_expense(expense_id: str,
+                         payload: UpdateExpensePayload,
+                         storage: Storage = Depends(get_storage)):
+    """Replace the split of an expense.
+
+    ``version`` must be the expense's current version (from ``GET
+    /expenses/{expense_id}``), otherwise the edit is rejected with 409.
+    """
+    expense = await update_expense_in_db(storage, expense_id, payload)
+    return {"expenseId": expense.id, "version": expense.version, "message": "Expense updated successfully"}
+
+
+@expense_router.delete("/{expense_id}")
+async def delete_expense(expense_id: str,
+                         version: int = Query(ge=1),
+                         storage: Storage = Depends(get_storage)):
+    await delete_expense_from_db(storage, expense_id, version)
+    return {"expenseId": expense_id, "message": "Expense deleted successfully"}
+
+
+BULK_CHUNK_SIZE = 500
+
+
+@expense_router.post("/bulk")
+async def add_expenses_bulk(request: Request,
+                            notify: bool = False,
+                            storage: Storage = Depends(get_storage)):
+    """Import many expenses from an NDJSON or CSV body (see ``app.bulk_import``).
+
+    Rows are validated and written in chunks of ``BULK_CHUNK_SIZE``; rows that
+    fail are reported by row number and do not stop the rest of the import.
+    With ``notify=true`` notification intents go to the outbox tagged with
+    the import, and are released once the body is read, so every affected
+    user gets one digest email for the whole import.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type in NDJSON_CONTENT_TYPES:
+        fmt = "ndjson"
+    elif content_type in CSV_CONTENT_TYPES:
+        fmt = "csv"
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail="Expected an NDJSON or CSV body."
+        )
+
+    inserted = 0
+    errors = []
+    chunk_rows, chunk = [], []
+    import_id = id_factory() if notify else None
+
+    async def flush():
+        nonlocal inserted
+        rows, expenses = [], []
+        for row, expense in zip(chunk_rows, await build_expenses(storage, chunk)):
+            if isinstance(expense, str):
+                errors.append({"row": row, "error": expense})
+            else:
+                rows.append(row)
+                expenses.append(expense)
+        try:
+            write_errors = await add_expenses_to_db_bulk(storage, expenses, notify=notify, import_id=import_id)
+        except Exception as e:
+            write_errors = {index: f"Failed to add expense: {str(e)}" for index in range(len(expenses))}
+        for index, row in enumerate(rows):
+            if index in write_errors:
+                errors.append({"row": row, "error": write_errors[index]})
+            else:
+                inserted += 1
+        chunk_rows.clear()
+        chunk.clear()
+
+    async for row, record, error in iter_records(iter_lines(request.stream()), fmt):
+        if error is None:
+            try:
+                chunk.append(parse_payload(record))
+                chunk_rows.append(row)
+            except ValidationError as err:
+                error = format_validation_error(err)
+        if error is not None:
+            errors.append({"row": row, "error": error})
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await flush()
+    if chunk:
+        await flush()
+    if notify and inserted:
+        await storage.release_notifications(import_id)
+
+    errors.sort(key=lambda e: e["row"])
+    return {"inserted": inserted, "failed": len(errors), "errors": errors}
+
+
 @expense_router.patch("/upload_image/{expense_id}")
-async def upload_image(expense_id: str, files: List[UploadFile], db: AsyncIOMotorDatabase = Depends(get_db)):
-    try:
-        file_paths = await store_files(files)
-        db["expenses"].update_one({"_id": expense_id}, {"$set": {"images": file_paths}})
-    except Exception as err:
-        raise err
+async def upload_image(expense_id: str, files: List[UploadFile], storage: Storage = Depends(get_storage)):
+    if await storage.get_expense(expense_id) is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+    digests = list(dict.fromkeys(await store_files(files)))
+    if not await storage.set_expense_images(expense_id, digests):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Expense not found")
+    return {"images": digests}
+
+
+@expense_router.get("/images/{digest}")
+async def get_image(digest: str, request: Request):
+    """Serve a stored receipt by digest, with ETag and single-range support."""
+    path = receipt_path(digest)
+    if path is None or not await aiofiles.os.path.isfile(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        # Content addressed, so a digest always names the same bytes.
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    size = await aiofiles.os.path.getsize(path)
+    start, end, status_code = 0, size - 1, status.HTTP_200_OK
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and size and (if_range is None or if_range == etag):
+        byte_range = parse_range(range_header, size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+        start, end = byte_range
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file(path, start, end - start + 1),
+        status_code=status_code,
+        media_type=await sniff_content_type(path),
+        headers=headers
+    )
+
+
+MAX_PAGE_SIZE = 500
+
+
+def format_expense(expense: dict) -> dict:
+    """An ``ExpenseResponse`` dict built straight from a stored expense, money rounded to cents."""
+    return {
+        "amount": round(expense["amount"], 2),
+        "date": expense["date"],
+        "name": expense.get("name"),
+        "notes": expense.get("notes"),
+        "participants": [{"user_id": p["user_id"], "amount": round(p["amount"], 2)} for p in expense["participants"]],
+        "group_id": expense.get("group_id"),
+        "category": expense.get("category"),
+        "version": expense.get("version", 1)
+    }
+
+
+async def stream_expenses(cursor):
+    async for expense in cursor:
+        yield orjson.dumps(format_expense(expense)) + b"\n"
 
 
 @expense_router.get("/user/{user_id}", response_model=List[ExpenseResponse])
-async def get_expenses_of_user(user_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
+async def get_expenses_of_user(user_id: str,
+                               request: Request,
+                               limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_SIZE),
+                               cursor: Optional[str] = None,
+                               stream: bool = False,
+                               storage: Storage = Depends(get_read_storage)):
+    """Expenses of a user, newest first.
+
+    Pages hold ``limit`` expenses (50 by default) and the ``X-Next-Cursor``
+    header carries the cursor for the following page. With ``stream=true``
+    the history is sent as NDJSON straight from the database cursor, from
+    ``cursor`` onwards and unbounded unless ``limit`` is given.
+
+    Pages carry the user's ledger version as their ``ETag`` and are cached per
+    version (see ``app.response_cache``).
+    """
+    if stream:
+        db_cursor = get_expenses_of_user_cursor(storage, user_id, after=cursor, limit=limit)
+        return StreamingResponse(stream_expenses(db_cursor), media_type="application/x-ndjson")
+    # The version and the page are read in order, so a page is never cached under a newer version.
+    async with storage.causal_reads() as reads:
+        return await get_history_page(reads, user_id, request, limit or 50, cursor)
+
+
+async def get_history_page(storage: Storage, user_id: str, request: Request, limit: int, cursor: Optional[str]):
+    version = await storage.get_ledger_version(user_id)
+    etag = ledger_etag(user_id, version)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    cache = get_response_cache()
+    key = ("history", user_id, version, limit, cursor)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached_json(cached[0], etag, cached[1])
+    db_cursor = get_expenses_of_user_cursor(storage, user_id, after=cursor, limit=limit)
     try:
-        # Retrieve expense by ID
-        query = {"$or": [{"payee_id": user_id}, {"participants.user_id": user_id}]}
-        result = []
-        async for expense in db["expenses"].find(query):
-            result.append(expense)
-
-        for r in result:
-            r["amount"] = float_scale(r["amount"])
-            for p in r["participants"]:
-                p["amount"] = float_scale(p["amount"])
-
-        if result is None:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Expense not found"
-            )
-
-        return result
+        result = [expense async for expense in db_cursor]
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to fetch expense: {str(e)}"
         )
 
+    # Serialized here with orjson rather than validated item by item against
+    # the response_model, which stays for the OpenAPI schema.
+    headers = {"X-Next-Cursor": encode_expense_cursor(result[-1])} if len(result) == limit else {}
+    body = orjson.dumps([format_expense(r) for r in result])
+    cache.put(key, body, headers)
+    return cached_json(body, etag, headers)
+
 
-@expense_router.get("/simplify")
+@expense_router.post("/simplify", response_model=List[Expense])
 async def simplify_expense(expenses: List[Expense]):
     try:
-        simplified_balances = simplify_balances([(expense.borrower, expense.lender, expense.amount)
-                                                 for expense in expenses])
-        if not simplified_balances:
-            return {"Simplified Expense": "No transactions needed."}
-        else:
-            return {"Simplified Expense": " ".join(simplified_balances)}
+        edges = [(expense.borrower, expense.lender, expense.amount) for expense in expenses]
+        return await run_cpu(simplify_balances, edges, size=len(edges))
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to fetch expense: {str(e)}"
+            detail=f"Failed to simplify expenses: {str(e)}"
+        )
+
+
+@expense_router.get("/simplify/user/{user_id}", response_model=List[Expense])
+async def simplify_user_expenses(user_id: str, storage: Storage = Depends(get_read_storage)):
+    """Simplified settlement of the debts between a user and everyone they share a balance with."""
+    try:
+        edges = await get_debt_edges(storage, user_id)
+        return await run_cpu(simplify_balances, edges, size=len(edges))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to simplify expenses: {str(e)}"
         )
@@ -0,0 +1,123 @@
+from typing import List, Optional
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse
+from starlette import status
+
+from app.crud import encode_expense_cursor, get_expenses_of_group_cursor, get_group_user_balance
+from app.models import DbGroup
+from app.offload import run_cpu
+from app.response_cache import cached_json, get_response_cache, ledger_etag, not_modified
+from app.routes.expense import MAX_PAGE_SIZE, format_expense
+from app.schema import BalanceResponse, Expense, ExpenseResponse, GroupMembersPayload, GroupPayload, GroupResponse
+from app.simplify_expenses import simplify_balances
+from app.storage import Storage, get_causal_read_storage, get_read_storage, get_storage
+
+group_router = APIRouter(prefix="/groups")
+
+
+def format_group(group: dict) -> dict:
+    return {"id": group["_id"], "name": group["name"], "member_ids": group["member_ids"]}
+
+
+async def get_group_or_404(storage: Storage, group_id: str) -> dict:
+    group = await storage.get_group(group_id)
+    if group is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found")
+    return group
+
+
+async def check_users_exist(storage: Storage, user_ids: List[str]):
+    found = {user["_id"] for user in await storage.find_users(user_ids)}
+    missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found]
+    if missing:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown users: {', '.join(missing)}."
+        )
+
+
+@group_router.post("/")
+async def add_group(payload: GroupPayload, storage: Storage = Depends(get_storage)):
+    await check_users_exist(storage, payload.member_ids)
+    group = DbGroup(name=payload.name, member_ids=list(dict.fromkeys(payload.member_ids)))
+    group_id = await storage.add_group(group.dict(by_alias=True))
+    return {"group_created": str(group_id)}
+
+
+@group_router.get("/{group_id}", response_model=GroupResponse)
+async def get_group(group_id: str, storage: Storage = Depends(get_storage)):
+    return format_group(await get_group_or_404(storage, group_id))
+
+
+@group_router.post("/{group_id}/members", response_model=GroupResponse)
+async def add_group_members(group_id: str, payload: GroupMembersPayload, storage: Storage = Depends(get_storage)):
+    await check_users_exist(storage, payload.member_ids)
+    if not await storage.add_group_members(group_id, payload.member_ids):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found")
+    return format_group(await get_group_or_404(storage, group_id))
+
+
+@group_router.get("/{group_id}/balance/{user_id}", response_model=List[BalanceResponse])
+async def get_group_balances(group_id: str,
+                             user_id: str,
+                             request: Request,
+                             storage: Storage = Depends(get_causal_read_storage)):
+    """What ``user_id`` owes and is owed within the group.
+
+    Every expense of the group bumps the ledger version of its members, so the
+    user's version doubles as the ``ETag`` here.
+    """
+    version = await storage.get_ledger_version(user_id)
+    etag = ledger_etag(user_id, version)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    cache = get_response_cache()
+    key = ("group_balance", group_id, user_id, version)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached_json(cached[0], etag)
+    await get_group_or_404(storage, group_id)
+    body = orjson.dumps(await get_group_user_balance(storage, group_id, user_id))
+    cache.put(key, body)
+    return cached_json(body, etag)
+
+
+@group_router.get("/{group_id}/expenses", response_model=List[ExpenseResponse])
+async def get_group_expenses(group_id: str,
+                             user_id: Optional[str] = None,
+                             limit: int = Query(default=50, ge=1, le=MAX_PAGE_SIZE),
+                             cursor: Optional[str] = None,
+                             storage: Storage = Depends(get_read_storage)):
+    """Expenses of the group, or only those of ``user_id`` in it, newest first.
+
+    Paged like ``GET /expenses/user/{user_id}``, with the next cursor in
+    ``X-Next-Cursor``.
+    """
+    await get_group_or_404(storage, group_id)
+    db_cursor = get_expenses_of_group_cursor(storage, group_id, user_id=user_id, after=cursor, limit=limit)
+    try:
+        result = [expense async for expense in db_cursor]
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch expense: {str(e)}"
+        )
+    headers = {"X-Next-Cursor": encode_expense_cursor(result[-1])} if len(result) == limit else {}
+    return ORJSONResponse([format_expense(r) for r in result], headers=headers)
+
+
+@group_router.get("/{group_id}/simplify", response_model=List[Expense])
+async def simplify_group_expenses(group_id: str, storage: Storage = Depends(get_read_storage)):
+    """Simplified settlement of the debts inside the group, read from its own balances only."""
+    await get_group_or_404(storage, group_id)
+    try:
+        edges = await storage.get_group_debt_edges(group_id)
+        return await run_cpu(simplify_balances, edges, size=len(edges))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to simplify expenses: {str(e)}"
+        )
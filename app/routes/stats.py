@@ -0,0 +1,65 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from starlette import status
+
+from app.admission import get_admission_pools
+from app.database import DatabaseConnectionManager
+from app.leader import get_scheduler
+from app.loop_monitor import get_loop_monitor
+from app.metrics import REGISTRY, Gauge
+from app.response_cache import get_response_cache
+from app.user_cache import get_user_directory
+
+stats_router = APIRouter(prefix="/stats")
+metrics_router = APIRouter()
+
+DB_POOL = REGISTRY.register(Gauge("mongodb_pool", "MongoDB connection pool counters.", ["stat"]))
+USER_CACHE = REGISTRY.register(Gauge("user_cache", "User directory cache counters.", ["stat"]))
+RESPONSE_CACHE = REGISTRY.register(Gauge("response_cache", "Balance and history response cache counters.", ["stat"]))
+
+
+def collect_stats():
+    for stat, value in DatabaseConnectionManager().pool_stats.stats().items():
+        DB_POOL.set(value, stat=stat)
+    for stat, value in get_user_directory().stats().items():
+        USER_CACHE.set(value, stat=stat)
+    for stat, value in get_response_cache().stats().items():
+        RESPONSE_CACHE.set(value, stat=stat)
+
+
+REGISTRY.add_collector(collect_stats)
+
+
+@stats_router.get("/db")
+async def get_db_stats():
+    return {
+        "pool": DatabaseConnectionManager().pool_stats.stats(),
+        "user_cache": get_user_directory().stats(),
+        "response_cache": get_response_cache().stats()
+    }
+
+
+@stats_router.get("/scheduler")
+async def get_scheduler_stats():
+    scheduler = get_scheduler()
+    if scheduler is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Scheduler is not running")
+    return await scheduler.status()
+
+
+@stats_router.get("/loop")
+async def get_loop_stats():
+    monitor = get_loop_monitor()
+    if monitor is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Loop monitor is not running")
+    return monitor.stats()
+
+
+@stats_router.get("/admission")
+async def get_admission_stats():
+    return {name: pool.stats() for name, pool in get_admission_pools().items()}
+
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,35 +1,42 @@
-from typing import List
+import datetime
+from typing import List, Optional
 
+import orjson
 import pymongo
-from fastapi import Depends, APIRouter, HTTPException
-from motor.motor_asyncio import AsyncIOMotorDatabase
+from fastapi import Depends, APIRouter, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from starlette import status
 
-from app.crud import get_user_balance
-from app.database import get_db
+from app.crud import get_user_balance, get_username, get_users_balances
 from app.models import DbUser
-from app.schema import UserResponse, BalanceResponse
+from app.response_cache import cached_json, get_response_cache, ledger_etag, not_modified
+from app.rollups import PERIODS, bucket_counterparties, count_periods, format_bucket, period_start, shift_period
+from app.schema import UserResponse, BalanceResponse, BalancesPayload, SpendingBucket
+from app.storage import Storage, get_causal_read_storage, get_read_storage, get_storage
+from app.user_cache import get_user_directory
 
 user_router = APIRouter(prefix="/users")
 
 
+def format_user(user: dict) -> dict:
+    return {"_id": user["_id"], "name": user["name"], "email": user["email"], "phone": user["phone"]}
+
+
 @user_router.get("/", response_model=List[DbUser])
-async def get_users(db: AsyncIOMotorDatabase = Depends(get_db)):
+async def get_users(storage: Storage = Depends(get_storage)):
     try:
-        users = [user async for user in db["users"].find()]
+        users = await storage.get_users()
         if not users:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
-        return users
+        return ORJSONResponse([format_user(user) for user in users])
     except Exception as err:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 @user_router.get("/{user_id}", response_model=UserResponse)
-async def get_user(user_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
+async def get_user(user_id: str, storage: Storage = Depends(get_storage)):
     try:
-        query = {"_id": user_id}
-        projection = {"_id": 0}
-        user = await db["users"].find_one(query, projection)
+        user = await storage.get_user(user_id)
         if not user:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
     except:
@@ -38,11 +45,11 @@ async def get_user(user_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
 
 
 @user_router.post("/")
-async def add_user(payload: UserResponse, db: AsyncIOMotorDatabase = Depends(get_db)):
+async def add_user(payload: UserResponse, storage: Storage = Depends(get_storage)):
     try:
         user = DbUser(**payload.dict())
-        print(user.id)
-        user_db = await db["users"].insert_one(user.dict(by_alias=True))
+        user_id = await storage.add_user(user.dict(by_alias=True))
+        get_user_directory().put(user.dict(by_alias=True))
     except pymongo.errors.DuplicateKeyError:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
@@ -50,15 +57,99 @@ async def add_user(payload: UserResponse, db: AsyncIOMotorDatabase = Depends(get
         )
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    return {"user_created": str(user_db.inserted_id)}
+    return {"user_created": str(user_id)}
 
 
 @user_router.get("/balance/{user_id}", response_model=List[BalanceResponse])
-async def get_balances(user_id: str, db: AsyncIOMotorDatabase = Depends(get_db)):
+async def get_balances(user_id: str, request: Request, storage: Storage = Depends(get_causal_read_storage)):
+    version = await storage.get_ledger_version(user_id)
+    etag = ledger_etag(user_id, version)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    cache = get_response_cache()
+    key = ("balance", user_id, version)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached_json(cached[0], etag)
     try:
-        result = await get_user_balance(db, user_id)
+        result = await get_user_balance(storage, user_id)
         if not result:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
-    return result
+    body = orjson.dumps(result)
+    cache.put(key, body)
+    return cached_json(body, etag)
+
+
+@user_router.post("/balances")
+async def get_balances_batch(payload: BalancesPayload, storage: Storage = Depends(get_read_storage)):
+    """Balances of up to ``MAX_BALANCE_BATCH`` users in one call, streamed as NDJSON.
+
+    One line ``{"user_id", "balances"}`` per distinct requested id, in request
+    order; users without balances get an empty list.
+    """
+    user_ids = list(dict.fromkeys(payload.user_ids))
+    try:
+        balances = await get_users_balances(storage, user_ids)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to fetch balances: {str(e)}"
+        )
+
+    async def lines():
+        for user_id in user_ids:
+            yield orjson.dumps({"user_id": user_id, "balances": balances.get(user_id, [])}) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+DEFAULT_ANALYTICS_PERIODS = 12
+MAX_ANALYTICS_PERIODS = 260
+
+
+@user_router.get("/analytics/{user_id}", response_model=List[SpendingBucket])
+async def get_analytics(user_id: str,
+                        request: Request,
+                        period: str = Query(default="month", pattern=f"^({'|'.join(PERIODS)})$"),
+                        start: Optional[datetime.date] = None,
+                        end: Optional[datetime.date] = None,
+                        storage: Storage = Depends(get_causal_read_storage)):
+    """Spending of a user per month or ISO week, read from the rollup buckets (see ``app.rollups``).
+
+    Covers the periods containing ``start`` through ``end`` (by default the
+    last 12, up to today). Periods without expenses are left out.
+    """
+    last = period_start(period, datetime.datetime.combine(end or datetime.date.today(), datetime.time()))
+    if start is None:
+        first = shift_period(period, last, 1 - DEFAULT_ANALYTICS_PERIODS)
+    else:
+        first = period_start(period, datetime.datetime.combine(start, datetime.time()))
+    stop = shift_period(period, last, 1)
+    periods = count_periods(period, first, stop)
+    if periods <= 0 or periods > MAX_ANALYTICS_PERIODS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"start must not be after end, and the range may span at most {MAX_ANALYTICS_PERIODS} periods."
+        )
+
+    version = await storage.get_ledger_version(user_id)
+    etag = ledger_etag(user_id, version)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    cache = get_response_cache()
+    key = ("analytics", user_id, version, period, first, stop)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached_json(cached[0], etag)
+    # Buckets whose expenses were all deleted or moved away are kept at count 0.
+    buckets = [b for b in await storage.get_rollups(user_id, period, first, stop) if round(b.get("count", 0))]
+    user_name_map = await get_username(list({
+        counterparty_id for bucket in buckets for counterparty_id in bucket_counterparties(bucket)
+    }))
+    body = orjson.dumps([format_bucket(bucket, user_name_map) for bucket in buckets])
+    cache.put(key, body)
+    return cached_json(body, etag)
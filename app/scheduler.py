@@ -1,26 +1,102 @@
-import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, Dict, List, Tuple
 
-from app.crud import get_emails, get_user_balance
-from app.database import get_db
-from app.notification import send_email_async
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.config import float_scale
+from app.database import get_read_db
+from app.notification import DeliveryStats, get_transport
+from app.offload import run_cpu
+from app.split import from_minor
+from app.storage import get_read_storage
+from app.user_cache import get_user_directory
+
+logger = logging.getLogger(__name__)
+
+
+def format_summary(balances: List[dict], user_name_map: Dict[str, str]) -> str:
+    body = "Here is the summary of amounts owed:\n\n"
+    for b in sorted(balances, key=lambda row: row["amount_owed"]):
+        user = user_name_map.get(b["counterparty_id"], b["counterparty_id"])
+        if b["amount_owed"] > 0:
+            body += f"You owe {float_scale(b['amount_owed'])} to {user}\n"
+        elif b["amount_owed"] < 0:
+            body += f"{user} owes you {float_scale(-b['amount_owed'])}\n"
+    return body
+
+
+def format_summaries(user_balances: List[List[dict]], user_name_map: Dict[str, str]) -> List[str]:
+    return [format_summary(balances, user_name_map) for balances in user_balances]
+
+
+async def iter_user_balances(db: AsyncIOMotorDatabase) -> AsyncIterator[Tuple[str, List[dict]]]:
+    # One pass over the ledger in index order, so each user's rows arrive together.
+    query = {"amount_owed_minor": {"$ne": 0}}
+    projection = {"_id": 0, "user_id": 1, "counterparty_id": 1, "amount_owed_minor": 1}
+    cursor = db["balances"].find(query, projection).sort([("user_id", 1), ("counterparty_id", 1)])
+    current_user, rows = None, []
+    async for row in cursor:
+        if row["user_id"] != current_user:
+            if rows:
+                yield current_user, rows
+            current_user, rows = row["user_id"], []
+        rows.append({"counterparty_id": row["counterparty_id"], "amount_owed": from_minor(row["amount_owed_minor"])})
+    if rows:
+        yield current_user, rows
 
 
 async def send_weekly_summary():
     # Prepare email content
     subject = "Weekly Summary: Amounts Owed"
+    batch_size = int(os.environ.get("WEEKLY_SUMMARY_BATCH_SIZE", 500))
+    db = get_read_db()
+    storage = get_read_storage()
+    directory = get_user_directory()
+
+    started = time.perf_counter()
+    transport = get_transport()
+    delivery = DeliveryStats()
+    lookup_time = build_time = send_time = 0.0
+    users = 0
+    batch = []
+
+    async def flush():
+        nonlocal lookup_time, build_time, send_time, users
+        flush_started = time.perf_counter()
+        # Names and emails of just this batch's users and counterparties, in one $in lookup.
+        user_ids = [user_id for user_id, _ in batch]
+        user_ids += [b["counterparty_id"] for _, balances in batch for b in balances]
+        entries = await directory.lookup(storage, user_ids)
+        recipients = [(entries[user_id]["email"], balances) for user_id, balances in batch if user_id in entries]
+        build_started = time.perf_counter()
+        lookup_time += build_started - flush_started
+        # Only the names this batch needs travel to the offload pool.
+        names = {b["counterparty_id"]: entries.get(b["counterparty_id"], {}).get("name", b["counterparty_id"])
+                 for _, balances in recipients for b in balances}
+        bodies = await run_cpu(
+            format_summaries, [balances for _, balances in recipients], names,
+            size=sum(len(balances) for _, balances in recipients)
+        )
+        messages = [transport.build_message(email, subject, body) for (email, _), body in zip(recipients, bodies)]
+        build_time += time.perf_counter() - build_started
+        send_started = time.perf_counter()
+        delivery.add(await transport.send_many(messages))
+        send_time += time.perf_counter() - send_started
+        users += len(recipients)
+        batch.clear()
+
+    async for user_id, balances in iter_user_balances(db):
+        batch.append((user_id, balances))
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
 
-    user_email_map = await get_emails()
-    db = get_db()
-    tasks = []
-    for user_id, email in user_email_map.items():
-        body = "Here is the summary of amounts owed:\n\n"
-        user_balance = await get_user_balance(db, user_id)
-        for b in user_balance:
-            if b["amount_owed"] > 0:
-                body += f"You owe {b['amount_owed']} to {b['user']}\n"
-            elif b["amount_owed"] < 0:
-                body += f"{b['user']} owes you {b['amount_owed']}\n"
-            else:
-                continue
-        tasks.append(asyncio.create_task(send_email_async(email, subject, body)))
-    await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+    logger.info(
+        "Weekly summary for %d users (sent=%d failed=%d retried=%d): "
+        "lookup=%.2fs build=%.2fs send=%.2fs total=%.2fs",
+        users, delivery.sent, delivery.failed, delivery.retried,
+        lookup_time, build_time, send_time, time.perf_counter() - started
+    )
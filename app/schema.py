@@ -1,5 +1,5 @@
 import datetime
-from typing import Optional, TypeVar, List
+from typing import Dict, Optional, TypeVar, List
 
 from pydantic import BaseModel, Field, UUID4, EmailStr
 
@@ -20,6 +20,20 @@ class AddExpensePayload(BaseModel):
     name: Optional[str] = Field(max_length=128, default=None)
     notes: Optional[str] = Field(max_length=500, default=None)
     participants: List[Participant]
+    group_id: Optional[str] = None
+    category: Optional[str] = Field(max_length=64, pattern=r"^[\w\- ]+$", default=None)
+
+
+class UpdateExpensePayload(BaseModel):
+    """The new contents of an expense; ``version`` is the one the client last read."""
+    amount: float = Field(ge=0, le=1_00_00_000, description="Amount should be between 0 and 1,00,00,000.")
+    payee_id: str
+    expense_type: ExpenseSplitType
+    name: Optional[str] = Field(max_length=128, default=None)
+    notes: Optional[str] = Field(max_length=500, default=None)
+    participants: List[Participant]
+    category: Optional[str] = Field(max_length=64, pattern=r"^[\w\- ]+$", default=None)
+    version: int = Field(ge=1)
 
 
 class User(BaseModel):
@@ -33,6 +47,9 @@ class ExpenseResponse(BaseModel):
     name: Optional[str]
     notes: Optional[str]
     participants: List[User]
+    group_id: Optional[str] = None
+    category: Optional[str] = None
+    version: int = 1
 
 
 class UserResponse(BaseModel):
@@ -46,7 +63,38 @@ class BalanceResponse(BaseModel):
     amount_owed: Number
 
 
+MAX_BALANCE_BATCH = 5000
+
+
+class BalancesPayload(BaseModel):
+    user_ids: List[str] = Field(min_length=1, max_length=MAX_BALANCE_BATCH)
+
+
 class Expense(BaseModel):
     borrower: str
     lender: str
     amount: Number
+
+
+class GroupPayload(BaseModel):
+    name: str = Field(max_length=128)
+    member_ids: List[str] = Field(min_length=1, max_length=1000)
+
+
+class GroupMembersPayload(BaseModel):
+    member_ids: List[str] = Field(min_length=1, max_length=1000)
+
+
+class GroupResponse(BaseModel):
+    id: str
+    name: str
+    member_ids: List[str]
+
+
+class SpendingBucket(BaseModel):
+    start: datetime.datetime
+    count: int
+    spent: float
+    paid: float
+    categories: Dict[str, float]
+    counterparties: Dict[str, float]
@@ -1,74 +1,135 @@
-import collections
-import heapq
-
-
-def get_borrowers_and_lenders(expense: list):
-    borrowers = collections.defaultdict(int)
-    lenders = collections.defaultdict(int)
-    for borrower, lender, amount in expense:
-        if borrower in lenders:
-            lenders[borrower] -= amount
-        else:
-            borrowers[borrower] += amount
-        if lender in borrowers:
-            borrowers[lender] -= amount
-        else:
-            lenders[lender] += amount
-    return borrowers, lenders
-
-
-def simplify_balances(expense: list):
-    simplified_expenses = []
-    borrowers, lenders = get_borrowers_and_lenders(expense)
-    sorted_borrowers = [(-amount, borrower) for borrower, amount in borrowers.items()]
-    heapq.heapify(sorted_borrowers)
-
-    for lender, amount_lent in sorted(lenders.items(), key=lambda item: item[1], reverse=True):
-
-        while borrowers and amount_lent > 0:
-            amount_borrowed, borrower = heapq.heappop(sorted_borrowers)
-
-            # If borrower and lender are same, skip and get the next borrower
-            if borrower == lender:
-                amount_borrowed_, borrower_ = amount_borrowed, borrower
-                amount_borrowed, borrower = heapq.heappop(sorted_borrowers)
-                heapq.heappush(sorted_borrowers, (amount_borrowed_, borrower_))
-
-            amount_borrowed = -amount_borrowed
-            amount_transfered = min(amount_borrowed, amount_lent)
-            if amount_transfered > 0:
-                simplified_expenses.append(f"{borrower} sends {amount_transfered} to {lender}.")
-                updated_amount_borrowed = amount_borrowed - amount_transfered
-                updated_amount_lent = amount_lent - amount_transfered
-                amount_lent = updated_amount_lent
-                if updated_amount_borrowed > 0:
-                    heapq.heappush(sorted_borrowers, (-updated_amount_borrowed, borrower))
-    return simplified_expenses
-
-
-if __name__ == "__main__":
-
-    # Test Case 1
-    expense = [('A', 'B', 250), ('B', 'C', 200)]  # (borrower, lender, amount)
-    print("Test Case 1:", expense)
-    print(simplify_balances(expense))
-
-    # Test Case 2
-    expenses = [('A', 'B', 200), ('B', 'C', 200), ('C', 'A', 100)]
-    print("Test Case 2:", expenses)
-    print(simplify_balances(expenses))
-
-    # Test Case 3
-    expenses = [('A', 'B', 200), ('B', 'C', 200), ('C', 'A', 200)]
-    print("Test Case 3:", expenses)
-    print(simplify_balances(expenses))
-
-    # Test Case 4
-    expenses = [('A', 'B', 200), ('B', 'C', 100), ('A', 'C', 100)]
-    print("Test Case 4:", expenses)
-    print(simplify_balances(expenses))
-
-    # Test Case 5
-    expenses = [('A', 'B', 250), ('B', 'C', 100), ('A', 'C', 120), ('D', 'A', 75)]
-    print("Test Case 4:", expenses)
-    print(simplify_balances(expenses))
+"""Debt simplification.
+
+Edges are ``(borrower, lender, amount)`` triples. They are netted into one
+balance per person in integer cents, and the non-zero balances are settled
+with as few transfers as practical:
+
+* up to ``EXACT_SOLVER_LIMIT`` people with a non-zero balance, an exact
+  solver finds the minimum number of transfers by splitting them into as many
+  independent zero-sum groups as possible (each group of k people needs
+  k - 1 transfers);
+* above that, a vectorised greedy solver matches debtors and creditors in
+  order of size, which needs at most n - 1 transfers.
+"""
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from app.split import MINOR_UNITS, from_minor
+
+EXACT_SOLVER_LIMIT = 12
+
+
+def net_balances(expense: Iterable[Tuple[str, str, float]]) -> Tuple[List[str], np.ndarray]:
+    """Return the people involved and their net balance in cents (positive = is owed)."""
+    index: Dict[str, int] = {}
+    borrowers, lenders, amounts = [], [], []
+    for borrower, lender, amount in expense:
+        borrowers.append(index.setdefault(borrower, len(index)))
+        lenders.append(index.setdefault(lender, len(index)))
+        amounts.append(amount)
+    size = len(index)
+    cents = np.rint(np.array(amounts, dtype=np.float64) * MINOR_UNITS)
+    # bincount sums in float64, which is exact for totals below 2**53 cents.
+    net = (np.bincount(np.array(lenders, dtype=np.int64), weights=cents, minlength=size)
+           - np.bincount(np.array(borrowers, dtype=np.int64), weights=cents, minlength=size))
+    return list(index), np.rint(net).astype(np.int64)
+
+
+def settle_greedy(people: np.ndarray, net: np.ndarray) -> List[Tuple[int, int, int]]:
+    """Settle ``net`` (which must sum to zero) in at most n - 1 transfers.
+
+    Debtors and creditors are laid out, largest first, on two number lines of
+    cumulative amounts; every point where either line crosses a boundary
+    starts a new transfer between whoever covers that stretch on each line.
+    """
+    debtors = people[net < 0]
+    creditors = people[net > 0]
+    debts = -net[net < 0]
+    credits = net[net > 0]
+    debt_order = np.argsort(-debts, kind="stable")
+    credit_order = np.argsort(-credits, kind="stable")
+    debtors, debts = debtors[debt_order], debts[debt_order]
+    creditors, credits = creditors[credit_order], credits[credit_order]
+
+    debt_ends = np.cumsum(debts)
+    credit_ends = np.cumsum(credits)
+    ends = np.union1d(debt_ends, credit_ends)
+    starts = np.concatenate(([0], ends[:-1]))
+    from_idx = np.searchsorted(debt_ends, starts, side="right")
+    to_idx = np.searchsorted(credit_ends, starts, side="right")
+    return list(zip(debtors[from_idx].tolist(), creditors[to_idx].tolist(), (ends - starts).tolist()))
+
+
+def _zero_sum_groups(net: Sequence[int]) -> List[List[int]]:
+    """Partition ``net`` into the largest number of zero-sum groups (bitmask DP)."""
+    n = len(net)
+    full = (1 << n) - 1
+    sums = [0] * (full + 1)
+    best = [0] * (full + 1)
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + net[low.bit_length() - 1]
+        best[mask] = max(best[mask ^ (1 << i)] for i in range(n) if mask >> i & 1) + (sums[mask] == 0)
+
+    # Walk back along an optimal removal order; every zero-sum mask on the
+    # way closes one group.
+    groups = []
+    mask = boundary = full
+    while mask:
+        step = best[mask] - (sums[mask] == 0)
+        mask ^= next(1 << i for i in range(n) if mask >> i & 1 and best[mask ^ (1 << i)] == step)
+        if sums[mask] == 0:
+            groups.append([i for i in range(n) if (boundary ^ mask) >> i & 1])
+            boundary = mask
+    return groups
+
+
+def settle_exact(people: np.ndarray, net: np.ndarray) -> List[Tuple[int, int, int]]:
+    transfers = []
+    for group in _zero_sum_groups(net.tolist()):
+        transfers.extend(settle_greedy(people[group], net[group]))
+    return transfers
+
+
+def simplify_balances(expense: Iterable[Tuple[str, str, float]]) -> List[dict]:
+    """Simplify ``(borrower, lender, amount)`` edges into a list of transfers."""
+    names, net = net_balances(expense)
+    people = np.flatnonzero(net)
+    net = net[people]
+    if len(people) <= EXACT_SOLVER_LIMIT:
+        transfers = settle_exact(people, net)
+    else:
+        transfers = settle_greedy(people, net)
+    return [
+        {"borrower": names[borrower], "lender": names[lender], "amount": from_minor(amount)}
+        for borrower, lender, amount in transfers
+    ]
+
+
+if __name__ == "__main__":
+
+    # Test Case 1
+    expense = [('A', 'B', 250), ('B', 'C', 200)]  # (borrower, lender, amount)
+    print("Test Case 1:", expense)
+    print(simplify_balances(expense))
+
+    # Test Case 2
+    expenses = [('A', 'B', 200), ('B', 'C', 200), ('C', 'A', 100)]
+    print("Test Case 2:", expenses)
+    print(simplify_balances(expenses))
+
+    # Test Case 3
+    expenses = [('A', 'B', 200), ('B', 'C', 200), ('C', 'A', 200)]
+    print("Test Case 3:", expenses)
+    print(simplify_balances(expenses))
+
+    # Test Case 4
+    expenses = [('A', 'B', 200), ('B', 'C', 100), ('A', 'C', 100)]
+    print("Test Case 4:", expenses)
+    print(simplify_balances(expenses))
+
+    # Test Case 5
+    expenses = [('A', 'B', 250), ('B', 'C', 100), ('A', 'C', 120), ('D', 'A', 75)]
+    print("Test Case 4:", expenses)
+    print(simplify_balances(expenses))
@@ -0,0 +1,124 @@
+"""Integer minor-unit split engine.
+
+Amounts are converted to minor units (cents) and split with the
+largest-remainder method: everyone gets the floor of their exact share and
+the cents left over go to the largest fractional parts, ties broken by
+position. The shares therefore always add up to the total exactly.
+
+``allocate`` splits one amount; ``allocate_batch`` splits a whole matrix of
+expenses in one vectorised NumPy call, for bulk imports and ledger rebuilds.
+"""
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from app.config import ExpenseSplitType
+
+MINOR_UNITS = 100
+
+
+def to_minor(amount: float) -> int:
+    return int(round(amount * MINOR_UNITS))
+
+
+def from_minor(amount: int) -> float:
+    return amount / MINOR_UNITS
+
+
+def allocate(total: int, weights: Sequence[float]) -> List[int]:
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        # Nothing to split: a zero amount may have all-zero weights.
+        if total == 0 and weight_sum == 0:
+            return [0] * len(weights)
+        raise ValueError("Weights must add up to a positive number.")
+    exact = [total * w / weight_sum for w in weights]
+    shares = [int(x // 1) for x in exact]
+    shortfall = total - sum(shares)
+    by_remainder = sorted(range(len(weights)), key=lambda i: (-(exact[i] - shares[i]) if weights[i] else 1, i))
+    for i in by_remainder[:shortfall]:
+        shares[i] += 1
+    return shares
+
+
+def allocate_batch(totals: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Split ``totals[i]`` minor units over row ``weights[i]``.
+
+    ``weights`` has one row per expense, right-padded with zeros; zero-weight
+    cells always get nothing. Every row must have a positive weight sum,
+    except rows with a zero total, which get all zeros.
+    """
+    totals = np.asarray(totals, dtype=np.int64)
+    weights = np.asarray(weights, dtype=np.float64)
+    weight_sums = weights.sum(axis=1, keepdims=True)
+    empty = weight_sums[:, 0] <= 0
+    if np.any(empty & ((totals != 0) | (weight_sums[:, 0] < 0))):
+        raise ValueError("Weights must add up to a positive number.")
+    weight_sums[empty] = 1.0
+    exact = totals[:, None] * weights / weight_sums
+    shares = np.floor(exact).astype(np.int64)
+    remainders = np.where(weights > 0, exact - shares, -1.0)
+    shortfall = totals - shares.sum(axis=1)
+    order = np.argsort(-remainders, axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(order.shape[1]), order.shape), axis=1)
+    shares += ranks < shortfall[:, None]
+    return shares
+
+
+def split_weights(split_type: ExpenseSplitType, total: int, contributions: Sequence[Optional[float]]) -> List[float]:
+    """Turn the contributions of one expense into ``allocate`` weights.
+
+    A PERCENT split below 100% gets an extra weight for the unassigned part,
+    which is dropped after allocation. Raises ``ValueError`` for splits that
+    cannot be satisfied.
+    """
+    if split_type == ExpenseSplitType.EQUAL:
+        return [1.0] * len(contributions)
+    if any(c is None or c < 0 for c in contributions):
+        raise ValueError("Every participant needs a non-negative contribution.")
+    if split_type == ExpenseSplitType.EXACT:
+        if sum(to_minor(c) for c in contributions) != total:
+            raise ValueError("Contributions must add up to the total amount.")
+        return [to_minor(c) for c in contributions]
+    if split_type == ExpenseSplitType.PERCENT:
+        total_perc = sum(contributions)
+        if total_perc > 100:
+            raise ValueError("Percentages add up to more than 100.")
+        return list(contributions) + ([100 - total_perc] if total_perc < 100 else [])
+    if split_type == ExpenseSplitType.WEIGHT:
+        return list(contributions)
+    raise ValueError(f"Unknown split type {split_type}.")
+
+
+def split(split_type: ExpenseSplitType, total: int, contributions: Sequence[Optional[float]]) -> List[int]:
+    weights = split_weights(split_type, total, contributions)
+    return allocate(total, weights)[:len(contributions)]
+
+
+def split_batch(split_types: Sequence[ExpenseSplitType],
+                totals: Sequence[int],
+                contributions: Sequence[Sequence[Optional[float]]]) -> List[Optional[List[int]]]:
+    """Split many expenses at once; entries for invalid splits are ``None``."""
+    rows = []
+    for split_type, total, contribution in zip(split_types, totals, contributions):
+        try:
+            rows.append(split_weights(split_type, total, contribution))
+        except ValueError:
+            rows.append(None)
+    valid = [i for i, row in enumerate(rows) if row and (sum(row) > 0 or totals[i] == 0)]
+    result: List[Optional[List[int]]] = [None] * len(rows)
+    if not valid:
+        return result
+    lengths = np.array([len(rows[i]) for i in valid], dtype=np.int64)
+    mask = np.arange(lengths.max()) < lengths[:, None]
+    weights = np.zeros(mask.shape)
+    weights[mask] = np.fromiter((w for i in valid for w in rows[i]), dtype=np.float64, count=int(lengths.sum()))
+    shares = allocate_batch(np.array([totals[i] for i in valid]), weights)
+    # Flatten once and slice per row; per-row tolist() dominates otherwise.
+    flat = shares[mask].tolist()
+    offset = 0
+    for i, length in zip(valid, lengths.tolist()):
+        result[i] = flat[offset:offset + len(contributions[i])]
+        offset += length
+    return result
@@ -0,0 +1,54 @@
+"""Storage backends for users, expenses, the ledger and balances.
+
+``STORAGE_BACKEND`` picks the backend: ``mongo`` (the default) or ``memory``.
+Routes get theirs through ``Depends(get_storage)``, or ``get_read_storage``
+for reads that may go to a secondary; ``get_causal_read_storage`` keeps those
+reads in order for routes that cache by ledger version.
+"""
+import os
+from typing import AsyncIterator, Optional
+
+from app.database import get_db, get_read_db
+from app.storage.base import EXPENSE_FIELDS, Storage
+from app.storage.memory import MemoryStorage
+from app.storage.mongo import MotorStorage
+
+BACKENDS = ("mongo", "memory")
+
+_memory: Optional[MemoryStorage] = None
+
+
+def storage_backend() -> str:
+    backend = os.environ.get("STORAGE_BACKEND", "mongo").strip().lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}.")
+    return backend
+
+
+def get_storage() -> Storage:
+    global _memory
+    if storage_backend() == "memory":
+        if _memory is None:
+            _memory = MemoryStorage()
+        return _memory
+    return MotorStorage(get_db())
+
+
+def get_read_storage() -> Storage:
+    if storage_backend() == "memory":
+        return get_storage()
+    return MotorStorage(get_read_db())
+
+
+async def get_causal_read_storage() -> AsyncIterator[Storage]:
+    """``get_read_storage`` within ``Storage.causal_reads``; not for streamed responses,
+    since the session ends before the body is sent.
+    """
+    async with get_read_storage().causal_reads() as storage:
+        yield storage
+
+
+def reset_memory_storage():
+    """Drop everything held by the in-memory backend."""
+    global _memory
+    _memory = None
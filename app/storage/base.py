@@ -0,0 +1,189 @@
+import abc
+import contextlib
+import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+# Fields of an expense returned by history reads.
+EXPENSE_FIELDS = ("_id", "amount", "date", "name", "notes", "participants", "group_id", "category", "version")
+
+# Balances are kept in integer minor units (cents) so running totals never drift;
+# the read methods convert them back to amounts.
+BalanceDeltas = Dict[Tuple[str, str], int]
+# Keyed by (group_id, user_id, counterparty_id).
+GroupBalanceDeltas = Dict[Tuple[str, str, str], int]
+# Keyed by (user_id, period, period start); values map field paths such as
+# "spent" or "categories.food" to the amount to add.
+RollupDeltas = Dict[Tuple[str, str, datetime.datetime], Dict[str, float]]
+ExpenseKey = Tuple[datetime.datetime, str]
+
+
+class Storage(abc.ABC):
+    """Persistence for users, groups, expenses, the transaction ledger and balances.
+
+    Documents go in and come out as plain dicts shaped like the Mongo
+    documents (``_id`` keys included); callers may mutate what they get back.
+    Duplicate users raise ``pymongo.errors.DuplicateKeyError`` on every
+    backend.
+    """
+
+    @contextlib.asynccontextmanager
+    async def causal_reads(self) -> AsyncIterator["Storage"]:
+        """This storage, with every read seeing at least what the previous ones saw.
+
+        For reads of the ledger version followed by the data it versions, which
+        may otherwise hit different secondaries and cache a stale body under a
+        newer ``ETag``. Backends without replicas read consistently anyway.
+        """
+        yield self
+
+    # Users
+
+    @abc.abstractmethod
+    async def add_user(self, user: dict) -> str:
+        ...
+
+    @abc.abstractmethod
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def get_users(self) -> List[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def find_users(self, user_ids: List[str]) -> List[dict]:
+        """The users among ``user_ids`` that exist, in no particular order."""
+
+    # Groups
+
+    @abc.abstractmethod
+    async def add_group(self, group: dict) -> str:
+        ...
+
+    @abc.abstractmethod
+    async def get_group(self, group_id: str) -> Optional[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def add_group_members(self, group_id: str, user_ids: List[str]) -> bool:
+        """Add the users not in the group yet; returns whether the group exists."""
+
+    # Expenses
+
+    @abc.abstractmethod
+    async def get_expense(self, expense_id: str) -> Optional[dict]:
+        ...
+
+    @abc.abstractmethod
+    async def insert_expenses(self, expenses: List[dict]) -> Dict[int, str]:
+        """Insert what can be inserted; returns the errors keyed by position."""
+
+    @abc.abstractmethod
+    async def replace_expense(self, expense: dict, version: int) -> bool:
+        """Replace the stored expense if it is still at ``version``; returns whether it was.
+
+        Expenses stored without a version are at version 1.
+        """
+
+    @abc.abstractmethod
+    async def delete_expense(self, expense_id: str, version: int) -> bool:
+        """Delete the expense if it is still at ``version``; returns whether it was."""
+
+    @abc.abstractmethod
+    async def set_expense_images(self, expense_id: str, images: List[str]) -> bool:
+        """Returns whether the expense exists."""
+
+    @abc.abstractmethod
+    def find_expenses_of_user(self,
+                              user_id: str,
+                              after: Optional[ExpenseKey] = None,
+                              limit: Optional[int] = None) -> AsyncIterator[dict]:
+        """Expenses paid by or shared with ``user_id``, newest first by ``(date, _id)``.
+
+        Only ``EXPENSE_FIELDS`` are returned. ``after`` is the key of the last
+        expense of the previous page.
+        """
+
+    @abc.abstractmethod
+    def find_expenses_of_group(self,
+                               group_id: str,
+                               user_id: Optional[str] = None,
+                               after: Optional[ExpenseKey] = None,
+                               limit: Optional[int] = None) -> AsyncIterator[dict]:
+        """Expenses of a group, or only those of ``user_id`` in it, ordered and paged
+        like ``find_expenses_of_user``.
+        """
+
+    # Ledger
+
+    @abc.abstractmethod
+    async def insert_transactions(self, transactions: List[dict]):
+        ...
+
+    # Balances
+
+    @abc.abstractmethod
+    async def apply_balance_deltas(self, deltas: BalanceDeltas):
+        """Add each ``(user_id, counterparty_id)`` delta, in cents, to that running balance."""
+
+    @abc.abstractmethod
+    async def get_balances(self, user_id: str) -> List[dict]:
+        """``{"counterparty_id", "amount_owed"}`` rows of a user, by ascending amount."""
+
+    @abc.abstractmethod
+    async def get_balances_of_users(self, user_ids: List[str]) -> Dict[str, List[dict]]:
+        """``get_balances`` of many users in one read; users without balances are left out."""
+
+    @abc.abstractmethod
+    async def get_debt_edges(self, user_id: str) -> List[Tuple[str, str, float]]:
+        """Positive balances among ``user_id`` and everyone they share a balance with,
+        as ``(borrower, lender, amount)`` edges.
+        """
+
+    @abc.abstractmethod
+    async def apply_group_balance_deltas(self, deltas: GroupBalanceDeltas):
+        """Add each ``(group_id, user_id, counterparty_id)`` delta, in cents, to that group's running balance."""
+
+    @abc.abstractmethod
+    async def get_group_balances(self, group_id: str, user_id: str) -> List[dict]:
+        """Like ``get_balances``, counting only the expenses of ``group_id``."""
+
+    @abc.abstractmethod
+    async def get_group_debt_edges(self, group_id: str) -> List[Tuple[str, str, float]]:
+        """Positive balances between the members of ``group_id`` as ``(borrower, lender, amount)`` edges."""
+
+    # Spending rollups
+
+    @abc.abstractmethod
+    async def apply_rollup_deltas(self, deltas: RollupDeltas):
+        """Add the deltas to each bucket, creating the buckets that do not exist yet."""
+
+    @abc.abstractmethod
+    async def get_rollups(self,
+                          user_id: str,
+                          period: str,
+                          start: datetime.datetime,
+                          end: datetime.datetime) -> List[dict]:
+        """Buckets of a user starting in ``[start, end)``, oldest first, with nested
+        ``categories`` and ``counterparties``.
+        """
+
+    # Ledger versions
+
+    @abc.abstractmethod
+    async def bump_ledger_versions(self, user_ids: List[str]):
+        """Advance the version of every user whose balances or history just changed."""
+
+    @abc.abstractmethod
+    async def get_ledger_version(self, user_id: str) -> int:
+        """0 for a user that was never bumped."""
+
+    # Notifications
+
+    @abc.abstractmethod
+    async def enqueue_notifications(self, intents: List[dict]):
+        ...
+
+    @abc.abstractmethod
+    async def release_notifications(self, import_id: str):
+        """Make the held intents of a bulk import due now."""
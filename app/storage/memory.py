@@ -0,0 +1,265 @@
+"""In-process storage backend (``STORAGE_BACKEND=memory``).
+
+Everything lives in dicts in this process, indexed the way the Mongo indexes
+are: users by id and by each unique field, expenses by id plus one
+``(date, _id)``-sorted key list per user, per group and per (group, user) for
+the history reads, and balances as one dict of counterparties per user, and
+per (group, user) for group balances. The transaction log is kept compacted
+as it is written: one running total per (group, payer, payee), like the
+checkpoints of ``app.compaction``, so it grows with the pairs rather than
+with every write.
+All access happens on the event loop thread, so no locking is needed.
+
+Used by the benchmarks and tests, and as an embedded single-node mode for
+small deployments. Data is lost when the process exits, and notification
+intents are dropped: there is no outbox dispatcher in this mode (``main``
+warns about it on startup).
+"""
+import bisect
+import collections
+import copy
+import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+from app.split import from_minor
+from app.storage.base import EXPENSE_FIELDS, BalanceDeltas, ExpenseKey, GroupBalanceDeltas, RollupDeltas, Storage
+
+USER_UNIQUE_FIELDS = ("name", "email", "phone")
+
+
+class MemoryStorage(Storage):
+
+    def __init__(self):
+        self.users: Dict[str, dict] = {}
+        self.user_unique: Dict[str, Dict[object, str]] = {field: {} for field in USER_UNIQUE_FIELDS}
+        self.groups: Dict[str, dict] = {}
+        self.expenses: Dict[str, dict] = {}
+        self.expenses_by_user: Dict[str, List[ExpenseKey]] = collections.defaultdict(list)
+        self.expenses_by_group: Dict[str, List[ExpenseKey]] = collections.defaultdict(list)
+        self.expenses_by_group_user: Dict[Tuple[str, str], List[ExpenseKey]] = collections.defaultdict(list)
+        # (group_id, payer_id, payee_id) -> amount
+        self.transactions: Dict[Tuple[Optional[str], str, str], float] = collections.defaultdict(float)
+        # In cents, like the Mongo ledger.
+        self.balances: Dict[str, Dict[str, int]] = collections.defaultdict(dict)
+        self.group_balances: Dict[Tuple[str, str], Dict[str, int]] = collections.defaultdict(dict)
+        self.rollups: Dict[Tuple[str, str], Dict[datetime.datetime, dict]] = collections.defaultdict(dict)
+        self.ledger_versions: Dict[str, int] = collections.defaultdict(int)
+
+    async def add_user(self, user: dict) -> str:
+        if user["_id"] in self.users:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: users index: _id_ dup key: {user['_id']}")
+        for field in USER_UNIQUE_FIELDS:
+            if user[field] in self.user_unique[field]:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: users index: {field}_1 dup key: {user[field]}"
+                )
+        user = copy.deepcopy(user)
+        self.users[user["_id"]] = user
+        for field in USER_UNIQUE_FIELDS:
+            self.user_unique[field][user[field]] = user["_id"]
+        return user["_id"]
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        user = self.users.get(user_id)
+        return copy.deepcopy(user) if user is not None else None
+
+    async def get_users(self) -> List[dict]:
+        return copy.deepcopy(list(self.users.values()))
+
+    async def find_users(self, user_ids: List[str]) -> List[dict]:
+        return [copy.deepcopy(self.users[user_id]) for user_id in dict.fromkeys(user_ids) if user_id in self.users]
+
+    async def add_group(self, group: dict) -> str:
+        if group["_id"] in self.groups:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: groups index: _id_ dup key: {group['_id']}"
+            )
+        group = copy.deepcopy(group)
+        self.groups[group["_id"]] = group
+        return group["_id"]
+
+    async def get_group(self, group_id: str) -> Optional[dict]:
+        group = self.groups.get(group_id)
+        return copy.deepcopy(group) if group is not None else None
+
+    async def add_group_members(self, group_id: str, user_ids: List[str]) -> bool:
+        group = self.groups.get(group_id)
+        if group is None:
+            return False
+        group["member_ids"].extend(user_id for user_id in dict.fromkeys(user_ids) if user_id not in group["member_ids"])
+        return True
+
+    async def get_expense(self, expense_id: str) -> Optional[dict]:
+        expense = self.expenses.get(expense_id)
+        return copy.deepcopy(expense) if expense is not None else None
+
+    async def insert_expenses(self, expenses: List[dict]) -> Dict[int, str]:
+        errors = {}
+        for index, expense in enumerate(expenses):
+            if expense["_id"] in self.expenses:
+                errors[index] = f"E11000 duplicate key error collection: expenses index: _id_ dup key: {expense['_id']}"
+                continue
+            expense = copy.deepcopy(expense)
+            self.expenses[expense["_id"]] = expense
+            self._index_expense(expense)
+        return errors
+
+    async def replace_expense(self, expense: dict, version: int) -> bool:
+        stored = self.expenses.get(expense["_id"])
+        if stored is None or stored.get("version", 1) != version:
+            return False
+        self._unindex_expense(stored)
+        expense = copy.deepcopy(expense)
+        self.expenses[expense["_id"]] = expense
+        self._index_expense(expense)
+        return True
+
+    async def delete_expense(self, expense_id: str, version: int) -> bool:
+        stored = self.expenses.get(expense_id)
+        if stored is None or stored.get("version", 1) != version:
+            return False
+        self._unindex_expense(stored)
+        del self.expenses[expense_id]
+        return True
+
+    def _expense_index_lists(self, expense: dict) -> List[List[ExpenseKey]]:
+        members = {expense["payee_id"]} | {p["user_id"] for p in expense["participants"]}
+        lists = [self.expenses_by_user[user_id] for user_id in members]
+        group_id = expense.get("group_id")
+        if group_id is not None:
+            lists.append(self.expenses_by_group[group_id])
+            lists.extend(self.expenses_by_group_user[(group_id, user_id)] for user_id in members)
+        return lists
+
+    def _index_expense(self, expense: dict):
+        key = (expense["date"], expense["_id"])
+        for keys in self._expense_index_lists(expense):
+            bisect.insort(keys, key)
+
+    def _unindex_expense(self, expense: dict):
+        key = (expense["date"], expense["_id"])
+        for keys in self._expense_index_lists(expense):
+            index = bisect.bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+
+    async def set_expense_images(self, expense_id: str, images: List[str]) -> bool:
+        expense = self.expenses.get(expense_id)
+        if expense is None:
+            return False
+        expense["images"] = list(images)
+        return True
+
+    async def find_expenses_of_user(self,
+                                    user_id: str,
+                                    after: Optional[ExpenseKey] = None,
+                                    limit: Optional[int] = None) -> AsyncIterator[dict]:
+        async for expense in self._page(self.expenses_by_user.get(user_id, []), after, limit):
+            yield expense
+
+    async def find_expenses_of_group(self,
+                                     group_id: str,
+                                     user_id: Optional[str] = None,
+                                     after: Optional[ExpenseKey] = None,
+                                     limit: Optional[int] = None) -> AsyncIterator[dict]:
+        if user_id is None:
+            keys = self.expenses_by_group.get(group_id, [])
+        else:
+            keys = self.expenses_by_group_user.get((group_id, user_id), [])
+        async for expense in self._page(keys, after, limit):
+            yield expense
+
+    async def _page(self,
+                    keys: List[ExpenseKey],
+                    after: Optional[ExpenseKey],
+                    limit: Optional[int]) -> AsyncIterator[dict]:
+        end = len(keys) if after is None else bisect.bisect_left(keys, after)
+        start = 0 if limit is None else max(end - limit, 0)
+        for _, expense_id in reversed(keys[start:end]):
+            expense = self.expenses[expense_id]
+            yield {field: copy.deepcopy(expense[field]) for field in EXPENSE_FIELDS if field in expense}
+
+    async def insert_transactions(self, transactions: List[dict]):
+        for transaction in transactions:
+            key = (transaction.get("group_id"), transaction["payer_id"], transaction["payee_id"])
+            self.transactions[key] += transaction["amount"]
+
+    async def apply_balance_deltas(self, deltas: BalanceDeltas):
+        for (user_id, counterparty_id), amount in deltas.items():
+            row = self.balances[user_id]
+            row[counterparty_id] = row.get(counterparty_id, 0) + amount
+
+    async def get_balances(self, user_id: str) -> List[dict]:
+        row = self.balances.get(user_id, {})
+        return [
+            {"counterparty_id": counterparty_id, "amount_owed": from_minor(amount)}
+            for counterparty_id, amount in sorted(row.items(), key=lambda item: item[1])
+        ]
+
+    async def get_balances_of_users(self, user_ids: List[str]) -> Dict[str, List[dict]]:
+        return {user_id: await self.get_balances(user_id) for user_id in user_ids if self.balances.get(user_id)}
+
+    async def get_debt_edges(self, user_id: str) -> List[Tuple[str, str, float]]:
+        members = {user_id, *self.balances.get(user_id, {})}
+        return [
+            (member, counterparty_id, from_minor(amount))
+            for member in members
+            for counterparty_id, amount in self.balances.get(member, {}).items()
+            if counterparty_id in members and amount > 0
+        ]
+
+    async def apply_group_balance_deltas(self, deltas: GroupBalanceDeltas):
+        for (group_id, user_id, counterparty_id), amount in deltas.items():
+            row = self.group_balances[(group_id, user_id)]
+            row[counterparty_id] = row.get(counterparty_id, 0) + amount
+
+    async def get_group_balances(self, group_id: str, user_id: str) -> List[dict]:
+        row = self.group_balances.get((group_id, user_id), {})
+        return [
+            {"counterparty_id": counterparty_id, "amount_owed": from_minor(amount)}
+            for counterparty_id, amount in sorted(row.items(), key=lambda item: item[1])
+        ]
+
+    async def get_group_debt_edges(self, group_id: str) -> List[Tuple[str, str, float]]:
+        group = self.groups.get(group_id)
+        members = group["member_ids"] if group is not None else []
+        return [
+            (member, counterparty_id, from_minor(amount))
+            for member in members
+            for counterparty_id, amount in self.group_balances.get((group_id, member), {}).items()
+            if amount > 0
+        ]
+
+    async def apply_rollup_deltas(self, deltas: RollupDeltas):
+        for (user_id, period, start), fields in deltas.items():
+            bucket = self.rollups[(user_id, period)].setdefault(start, {"start": start})
+            for path, amount in fields.items():
+                top, _, sub = path.partition(".")
+                if sub:
+                    values = bucket.setdefault(top, {})
+                    values[sub] = values.get(sub, 0) + amount
+                else:
+                    bucket[top] = bucket.get(top, 0) + amount
+
+    async def get_rollups(self,
+                          user_id: str,
+                          period: str,
+                          start: datetime.datetime,
+                          end: datetime.datetime) -> List[dict]:
+        buckets = self.rollups.get((user_id, period), {})
+        return [copy.deepcopy(buckets[key]) for key in sorted(buckets) if start <= key < end]
+
+    async def bump_ledger_versions(self, user_ids: List[str]):
+        for user_id in user_ids:
+            self.ledger_versions[user_id] += 1
+
+    async def get_ledger_version(self, user_id: str) -> int:
+        return self.ledger_versions.get(user_id, 0)
+
+    async def enqueue_notifications(self, intents: List[dict]):
+        pass
+
+    async def release_notifications(self, import_id: str):
+        pass
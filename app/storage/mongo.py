@@ -0,0 +1,239 @@
+import contextlib
+import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClientSession, AsyncIOMotorDatabase
+from pymongo import ReadPreference, UpdateOne
+from pymongo.read_concern import ReadConcern
+from pymongo.errors import BulkWriteError
+
+from app.split import from_minor
+from app.storage.base import EXPENSE_FIELDS, BalanceDeltas, ExpenseKey, GroupBalanceDeltas, RollupDeltas, Storage
+
+EXPENSE_PROJECTION = {field: 1 for field in EXPENSE_FIELDS}
+
+
+def version_filter(expense_id: str, version: int) -> dict:
+    # A missing version is version 1; {"$in": [1, None]} matches both.
+    return {"_id": expense_id, "version": {"$in": [1, None]} if version == 1 else version}
+
+
+def balance_row(row: dict) -> dict:
+    return {"counterparty_id": row["counterparty_id"], "amount_owed": from_minor(row["amount_owed_minor"])}
+
+
+class MotorStorage(Storage):
+    """The MongoDB backend; see the indexes created in ``main.lifespan``.
+
+    Reads go through ``session`` when one is given (see ``causal_reads``).
+    """
+
+    def __init__(self, db: AsyncIOMotorDatabase, session: Optional[AsyncIOMotorClientSession] = None):
+        self.db = db
+        self.session = session
+
+    @contextlib.asynccontextmanager
+    async def causal_reads(self) -> AsyncIterator[Storage]:
+        if self.session is not None or self.db.read_preference == ReadPreference.PRIMARY:
+            yield self
+            return
+        # Each read in the session waits until its secondary has caught up with the
+        # previous one; majority reads keep that order across failovers.
+        async with await self.db.client.start_session(causal_consistency=True) as session:
+            yield MotorStorage(self.db.with_options(read_concern=ReadConcern("majority")), session=session)
+
+    async def add_user(self, user: dict) -> str:
+        result = await self.db["users"].insert_one(user)
+        return result.inserted_id
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        return await self.db["users"].find_one({"_id": user_id}, session=self.session)
+
+    async def get_users(self) -> List[dict]:
+        return [user async for user in self.db["users"].find(session=self.session)]
+
+    async def find_users(self, user_ids: List[str]) -> List[dict]:
+        return [user async for user in self.db["users"].find({"_id": {"$in": user_ids}}, session=self.session)]
+
+    async def add_group(self, group: dict) -> str:
+        result = await self.db["groups"].insert_one(group)
+        return result.inserted_id
+
+    async def get_group(self, group_id: str) -> Optional[dict]:
+        return await self.db["groups"].find_one({"_id": group_id}, session=self.session)
+
+    async def add_group_members(self, group_id: str, user_ids: List[str]) -> bool:
+        result = await self.db["groups"].update_one(
+            {"_id": group_id},
+            {"$addToSet": {"member_ids": {"$each": user_ids}}}
+        )
+        return result.matched_count > 0
+
+    async def get_expense(self, expense_id: str) -> Optional[dict]:
+        return await self.db["expenses"].find_one({"_id": expense_id}, session=self.session)
+
+    async def insert_expenses(self, expenses: List[dict]) -> Dict[int, str]:
+        errors = {}
+        try:
+            await self.db["expenses"].insert_many(expenses, ordered=False)
+        except BulkWriteError as err:
+            for write_error in err.details["writeErrors"]:
+                errors[write_error["index"]] = write_error["errmsg"]
+        return errors
+
+    async def replace_expense(self, expense: dict, version: int) -> bool:
+        result = await self.db["expenses"].replace_one(version_filter(expense["_id"], version), expense)
+        return result.matched_count > 0
+
+    async def delete_expense(self, expense_id: str, version: int) -> bool:
+        result = await self.db["expenses"].delete_one(version_filter(expense_id, version))
+        return result.deleted_count > 0
+
+    async def set_expense_images(self, expense_id: str, images: List[str]) -> bool:
+        result = await self.db["expenses"].update_one({"_id": expense_id}, {"$set": {"images": images}})
+        return result.matched_count > 0
+
+    def find_expenses_of_user(self,
+                              user_id: str,
+                              after: Optional[ExpenseKey] = None,
+                              limit: Optional[int] = None) -> AsyncIterator[dict]:
+        # Served by the (payee_id|participants.user_id, date, _id) indexes.
+        query = {"$or": [{"payee_id": user_id}, {"participants.user_id": user_id}]}
+        return self._find_expenses(query, after, limit)
+
+    def find_expenses_of_group(self,
+                               group_id: str,
+                               user_id: Optional[str] = None,
+                               after: Optional[ExpenseKey] = None,
+                               limit: Optional[int] = None) -> AsyncIterator[dict]:
+        # Served by the group_id-prefixed expense indexes, so only the group's partition is read.
+        query = {"group_id": group_id}
+        if user_id is not None:
+            query["$or"] = [{"payee_id": user_id}, {"participants.user_id": user_id}]
+        return self._find_expenses(query, after, limit)
+
+    def _find_expenses(self, query: dict, after: Optional[ExpenseKey], limit: Optional[int]) -> AsyncIterator[dict]:
+        if after is not None:
+            date, expense_id = after
+            query = {"$and": [query, {"$or": [
+                {"date": {"$lt": date}},
+                {"date": date, "_id": {"$lt": expense_id}}
+            ]}]}
+        cursor = self.db["expenses"].find(query, EXPENSE_PROJECTION, session=self.session)
+        cursor = cursor.sort([("date", -1), ("_id", -1)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    async def insert_transactions(self, transactions: List[dict]):
+        if transactions:
+            await self.db["transactions"].insert_many(transactions, ordered=False)
+
+    async def apply_balance_deltas(self, deltas: BalanceDeltas):
+        updates = [
+            UpdateOne(
+                {"user_id": user_id, "counterparty_id": counterparty_id},
+                {"$inc": {"amount_owed_minor": amount}},
+                upsert=True
+            )
+            for (user_id, counterparty_id), amount in deltas.items()
+        ]
+        if updates:
+            await self.db["balances"].bulk_write(updates, ordered=False)
+
+    async def get_balances(self, user_id: str) -> List[dict]:
+        projection = {"_id": 0, "counterparty_id": 1, "amount_owed_minor": 1}
+        cursor = self.db["balances"].find(
+            {"user_id": user_id}, projection, session=self.session
+        ).sort("amount_owed_minor", 1)
+        return [balance_row(row) async for row in cursor]
+
+    async def get_balances_of_users(self, user_ids: List[str]) -> Dict[str, List[dict]]:
+        # One $in over the (user_id, counterparty_id) index; each user's rows are sorted here.
+        projection = {"_id": 0, "user_id": 1, "counterparty_id": 1, "amount_owed_minor": 1}
+        result = {}
+        async for row in self.db["balances"].find({"user_id": {"$in": user_ids}}, projection, session=self.session):
+            result.setdefault(row["user_id"], []).append(balance_row(row))
+        for rows in result.values():
+            rows.sort(key=lambda row: row["amount_owed"])
+        return result
+
+    async def get_debt_edges(self, user_id: str) -> List[Tuple[str, str, float]]:
+        counterparties = await self.db["balances"].distinct(
+            "counterparty_id", {"user_id": user_id}, session=self.session
+        )
+        members = [user_id] + counterparties
+        query = {"user_id": {"$in": members}, "counterparty_id": {"$in": members}, "amount_owed_minor": {"$gt": 0}}
+        projection = {"_id": 0, "user_id": 1, "counterparty_id": 1, "amount_owed_minor": 1}
+        return [
+            (row["user_id"], row["counterparty_id"], from_minor(row["amount_owed_minor"]))
+            async for row in self.db["balances"].find(query, projection, session=self.session)
+        ]
+
+    async def apply_group_balance_deltas(self, deltas: GroupBalanceDeltas):
+        updates = [
+            UpdateOne(
+                {"group_id": group_id, "user_id": user_id, "counterparty_id": counterparty_id},
+                {"$inc": {"amount_owed_minor": amount}},
+                upsert=True
+            )
+            for (group_id, user_id, counterparty_id), amount in deltas.items()
+        ]
+        if updates:
+            await self.db["group_balances"].bulk_write(updates, ordered=False)
+
+    async def get_group_balances(self, group_id: str, user_id: str) -> List[dict]:
+        projection = {"_id": 0, "counterparty_id": 1, "amount_owed_minor": 1}
+        cursor = self.db["group_balances"].find(
+            {"group_id": group_id, "user_id": user_id}, projection, session=self.session
+        ).sort("amount_owed_minor", 1)
+        return [balance_row(row) async for row in cursor]
+
+    async def get_group_debt_edges(self, group_id: str) -> List[Tuple[str, str, float]]:
+        query = {"group_id": group_id, "amount_owed_minor": {"$gt": 0}}
+        projection = {"_id": 0, "user_id": 1, "counterparty_id": 1, "amount_owed_minor": 1}
+        return [
+            (row["user_id"], row["counterparty_id"], from_minor(row["amount_owed_minor"]))
+            async for row in self.db["group_balances"].find(query, projection, session=self.session)
+        ]
+
+    async def apply_rollup_deltas(self, deltas: RollupDeltas):
+        updates = [
+            UpdateOne(
+                {"user_id": user_id, "period": period, "start": start},
+                {"$inc": dict(fields)},
+                upsert=True
+            )
+            for (user_id, period, start), fields in deltas.items()
+        ]
+        if updates:
+            await self.db["spending_rollups"].bulk_write(updates, ordered=False)
+
+    async def get_rollups(self,
+                          user_id: str,
+                          period: str,
+                          start: datetime.datetime,
+                          end: datetime.datetime) -> List[dict]:
+        query = {"user_id": user_id, "period": period, "start": {"$gte": start, "$lt": end}}
+        projection = {"_id": 0, "user_id": 0, "period": 0, "backfill_run": 0}
+        cursor = self.db["spending_rollups"].find(query, projection, session=self.session).sort("start", 1)
+        return [row async for row in cursor]
+
+    async def bump_ledger_versions(self, user_ids: List[str]):
+        updates = [UpdateOne({"_id": user_id}, {"$inc": {"version": 1}}, upsert=True) for user_id in user_ids]
+        if updates:
+            await self.db["ledger_versions"].bulk_write(updates, ordered=False)
+
+    async def get_ledger_version(self, user_id: str) -> int:
+        doc = await self.db["ledger_versions"].find_one({"_id": user_id}, session=self.session)
+        return doc["version"] if doc is not None else 0
+
+    async def enqueue_notifications(self, intents: List[dict]):
+        if intents:
+            await self.db["outbox"].insert_many(intents, ordered=False)
+
+    async def release_notifications(self, import_id: str):
+        await self.db["outbox"].update_many(
+            {"import_id": import_id, "status": "pending"},
+            {"$set": {"lease_until": datetime.datetime.utcnow()}}
+        )
@@ -0,0 +1,66 @@
+"""Process-wide cache of user names and emails.
+
+Balance reads, expense notifications and the weekly summary all need to map
+user ids to names or emails. ``UserDirectory`` keeps the most recently used
+entries in memory (LRU, capped at ``USER_CACHE_SIZE``) and fetches all misses
+of a lookup with a single ``$in`` query.
+"""
+import collections
+import os
+from typing import Dict, Iterable, Optional
+
+from app.storage import Storage
+
+
+class UserDirectory:
+
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries: "collections.OrderedDict[str, dict]" = collections.OrderedDict()
+
+    def put(self, user: dict):
+        self._entries[user["_id"]] = {"name": user["name"], "email": user["email"]}
+        self._entries.move_to_end(user["_id"])
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_ids: Optional[Iterable[str]] = None):
+        if user_ids is None:
+            self._entries.clear()
+            return
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+
+    async def lookup(self, storage: Storage, user_ids: Iterable[str]) -> Dict[str, dict]:
+        """Return ``{user_id: {"name", "email"}}`` for the ids that exist."""
+        found = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            entry = self._entries.get(user_id)
+            if entry is None:
+                missing.append(user_id)
+            else:
+                self._entries.move_to_end(user_id)
+                found[user_id] = entry
+        self.hits += len(found)
+        self.misses += len(missing)
+        if missing:
+            for doc in await storage.find_users(missing):
+                self.put(doc)
+                found[doc["_id"]] = self._entries[doc["_id"]]
+        return found
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+
+_directory: Optional[UserDirectory] = None
+
+
+def get_user_directory() -> UserDirectory:
+    global _directory
+    if _directory is None:
+        _directory = UserDirectory(capacity=int(os.environ.get("USER_CACHE_SIZE", 10_000)))
+    return _directory
@@ -0,0 +1,109 @@
+"""Group commit for concurrent expense writes.
+
+With ``WRITE_COALESCING`` enabled, ``add_expense_to_db`` hands its expense to
+the ``WriteCoalescer`` instead of writing it directly. Expenses submitted
+within ``WRITE_COALESCE_WINDOW_MS`` of each other (or until
+``WRITE_COALESCE_MAX_DOCS`` expense and transaction documents are pending) are
+written together through ``add_expenses_to_db_bulk``, one bulk write per
+collection, and every caller gets back its own expense id or error.
+
+A caller that is cancelled after submitting does not withdraw its expense;
+it is still written with the rest of the batch.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app.config import env_flag
+from app.models import DbExpense
+from app.storage import Storage
+
+
+class CoalescedWriteError(Exception):
+    pass
+
+
+BulkWriter = Callable[[Storage, List[DbExpense]], Awaitable[Dict[int, str]]]
+
+
+class WriteCoalescer:
+
+    def __init__(self, storage: Storage, write: BulkWriter, window: float = 0.002, max_docs: int = 256):
+        self.storage = storage
+        self.write = write
+        self.window = window
+        self.max_docs = max_docs
+        self._pending: List[Tuple[DbExpense, asyncio.Future]] = []
+        self._pending_docs = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: Set[asyncio.Task] = set()
+
+    async def submit(self, expense: DbExpense) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((expense, future))
+        # One expense document plus a mirrored pair of transactions per participant.
+        self._pending_docs += 1 + 2 * len(expense.participants)
+        if self._pending_docs >= self.max_docs:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_docs = self._pending, [], 0
+        task = asyncio.create_task(self._write(batch))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: List[Tuple[DbExpense, asyncio.Future]]):
+        try:
+            errors = await self.write(self.storage, [expense for expense, _ in batch])
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        for index, (expense, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in errors:
+                future.set_exception(CoalescedWriteError(errors[index]))
+            else:
+                future.set_result(expense.id)
+
+    async def close(self):
+        self._flush()
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+
+_coalescer: Optional[WriteCoalescer] = None
+
+
+def start_write_coalescer(storage: Storage, write: BulkWriter) -> Optional[WriteCoalescer]:
+    global _coalescer
+    if env_flag("WRITE_COALESCING"):
+        _coalescer = WriteCoalescer(
+            storage,
+            write,
+            window=float(os.environ.get("WRITE_COALESCE_WINDOW_MS", 2)) / 1000,
+            max_docs=int(os.environ.get("WRITE_COALESCE_MAX_DOCS", 256))
+        )
+    return _coalescer
+
+
+def get_write_coalescer() -> Optional[WriteCoalescer]:
+    return _coalescer
+
+
+async def stop_write_coalescer():
+    global _coalescer
+    if _coalescer is not None:
+        await _coalescer.close()
+        _coalescer = None
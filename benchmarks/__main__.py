@@ -0,0 +1,56 @@
+"""Run the benchmark suites, save the results as JSON and check for regressions.
+
+Usage:
+    python -m benchmarks [--suite micro|serialization|split_engine|simplify_engine|routes|all]
+                         [--out results.json]
+                         [--baseline baseline.json] [--tolerance 0.2] [--concurrency 8]
+
+Results go to ``benchmarks/results/<timestamp>.json`` unless ``--out`` is
+given. With ``--baseline`` the run exits with status 1 when any case's p99
+grew, or its throughput dropped, by more than the tolerance.
+"""
+import argparse
+import asyncio
+import sys
+
+from benchmarks import micro, routes, serialization, simplify_engine, split_engine
+from benchmarks.harness import compare, load_results, print_results, save_results
+
+SUITES = ["micro", "serialization", "split_engine", "simplify_engine", "routes"]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--suite", choices=SUITES + ["all"], default="all")
+    parser.add_argument("--out")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    results = {}
+    if args.suite in ("micro", "all"):
+        results.update(micro.run())
+    if args.suite in ("serialization", "all"):
+        results.update(serialization.run())
+    if args.suite in ("split_engine", "all"):
+        results.update(split_engine.run())
+    if args.suite in ("simplify_engine", "all"):
+        results.update(simplify_engine.run())
+    if args.suite in ("routes", "all"):
+        results.update(asyncio.run(routes.run(concurrency=args.concurrency)))
+    print_results(results)
+    path = save_results(results, args.out, suite=args.suite, concurrency=args.concurrency)
+    print(f"Saved results to {path}")
+
+    if args.baseline:
+        regressions = compare(results, load_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""Seeded synthetic users, expenses, transactions and balances.
+
+Documents are built with the same code paths as the API (``expense_adapter``,
+``get_transaction_docs``, ``get_balance_deltas``) and written through the
+storage interface, so a seeded backend looks like one filled through
+``POST /expenses/``. The same seed always produces the
+same data.
+"""
+import datetime
+import random
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+from app.config import ExpenseSplitType
+from app.crud import expense_adapter, get_balance_deltas, get_transaction_docs
+from app.models import DbExpense, DbUser
+from app.schema import AddExpensePayload, Participant
+from app.storage import Storage
+
+
+@dataclass
+class Dataset:
+    users: List[DbUser] = field(default_factory=list)
+    expenses: List[DbExpense] = field(default_factory=list)
+
+    @property
+    def user_ids(self) -> List[str]:
+        return [user.id for user in self.users]
+
+
+def seeded_id(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def make_payload(rng: random.Random, user_ids: List[str], max_participants: int = 8) -> AddExpensePayload:
+    split_type = rng.choice(list(ExpenseSplitType))
+    members = rng.sample(user_ids, rng.randint(2, min(max_participants, len(user_ids))))
+    amount = round(rng.uniform(1, 5_000), 2)
+    if split_type == ExpenseSplitType.EQUAL:
+        contributions = [None] * len(members)
+    elif split_type == ExpenseSplitType.WEIGHT:
+        contributions = [rng.randint(1, 5) for _ in members]
+    else:
+        # Whole cents (EXACT) or whole percent (PERCENT), so the parts add up exactly.
+        total = round(amount * 100) if split_type == ExpenseSplitType.EXACT else 100
+        cuts = sorted(rng.sample(range(1, total), len(members) - 1))
+        parts = [b - a for a, b in zip([0] + cuts, cuts + [total])]
+        contributions = [p / 100 for p in parts] if split_type == ExpenseSplitType.EXACT else parts
+    return AddExpensePayload(
+        amount=amount,
+        payee_id=members[0],
+        expense_type=split_type,
+        name=f"expense-{rng.randrange(10 ** 6)}",
+        participants=[Participant(user_id=u, contribution=c) for u, c in zip(members, contributions)]
+    )
+
+
+def make_edges(participants: int, edges_per_participant: int = 5, seed: int = 42) -> List[Tuple[str, str, float]]:
+    """Random ``(borrower, lender, amount)`` debts among ``participants`` people, for the simplifiers."""
+    rng = random.Random(seed)
+    edges = []
+    for _ in range(participants * edges_per_participant):
+        borrower, lender = rng.sample(range(participants), 2)
+        edges.append((f"user-{borrower}", f"user-{lender}", round(rng.uniform(1, 500), 2)))
+    return edges
+
+
+def make_users(rng: random.Random, count: int) -> List[DbUser]:
+    users = []
+    for i in range(count):
+        user = DbUser(name=f"user-{i}", email=f"user-{i}@example.com", phone=9_000_000_000 + i)
+        user.id = seeded_id(rng)
+        users.append(user)
+    return users
+
+
+async def make_dataset(num_users: int = 200, num_expenses: int = 2000, seed: int = 42) -> Dataset:
+    rng = random.Random(seed)
+    dataset = Dataset(users=make_users(rng, num_users))
+    start = datetime.datetime(2024, 1, 1)
+    for i in range(num_expenses):
+        payload = make_payload(rng, dataset.user_ids)
+        expense = await expense_adapter(payload)
+        expense.id = seeded_id(rng)
+        expense.date = start + datetime.timedelta(minutes=i)
+        dataset.expenses.append(expense)
+    return dataset
+
+
+async def seed_database(storage: Storage, dataset: Dataset):
+    """Write ``dataset`` into an empty ``storage``."""
+    for user in dataset.users:
+        await storage.add_user(user.dict(by_alias=True))
+    await storage.insert_expenses([expense.dict(by_alias=True) for expense in dataset.expenses])
+    await storage.insert_transactions([doc for expense in dataset.expenses for doc in get_transaction_docs(expense)])
+    await storage.apply_balance_deltas(get_balance_deltas(dataset.expenses))
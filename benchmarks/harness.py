@@ -0,0 +1,133 @@
+"""Timing, result files and regression checks shared by the benchmark suites.
+
+A result file is JSON of the form::
+
+    {"meta": {...}, "results": {"<case>": {"runs", "mean_s", "p50_s", "p99_s", "throughput", ...}}}
+
+``compare`` flags a case whose p99 grew, or whose throughput dropped, by more
+than the tolerance against a baseline file.
+"""
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    rank = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def summarize(samples: List[float], items_per_run: int = 1, elapsed: Optional[float] = None) -> dict:
+    """Summarize per-run durations; ``throughput`` is items per second of wall time."""
+    elapsed = sum(samples) if elapsed is None else elapsed
+    return {
+        "runs": len(samples),
+        "items_per_run": items_per_run,
+        "mean_s": sum(samples) / len(samples) if samples else 0.0,
+        "p50_s": percentile(samples, 50),
+        "p99_s": percentile(samples, 99),
+        "max_s": max(samples, default=0.0),
+        "throughput": len(samples) * items_per_run / elapsed if elapsed else 0.0,
+    }
+
+
+def measure(func: Callable[[], object], runs: int = 20, warmup: int = 2, items_per_run: int = 1) -> dict:
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples, items_per_run)
+
+
+async def measure_async(func: Callable[[], Awaitable[object]],
+                        runs: int = 200,
+                        concurrency: int = 1,
+                        warmup: int = 5) -> dict:
+    """Run ``func`` ``runs`` times with up to ``concurrency`` calls in flight."""
+    for _ in range(warmup):
+        await func()
+    samples = []
+    remaining = runs
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            await func()
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return dict(summarize(samples, elapsed=time.perf_counter() - started), concurrency=concurrency)
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results: Dict[str, dict], path: Optional[str] = None, **meta) -> str:
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"{stamp}.json")
+    document = {
+        "meta": dict(
+            meta,
+            revision=_git_revision(),
+            python=platform.python_version(),
+            machine=platform.machine(),
+            created=datetime.datetime.utcnow().isoformat()
+        ),
+        "results": results
+    }
+    with open(path, "w") as out_file:
+        json.dump(document, out_file, indent=2, sort_keys=True)
+    return path
+
+
+def load_results(path: str) -> Dict[str, dict]:
+    with open(path) as in_file:
+        return json.load(in_file)["results"]
+
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict], tolerance: float = 0.2) -> List[str]:
+    """Return a description of every regression beyond ``tolerance`` (0.2 = 20%)."""
+    regressions = []
+    for case, result in sorted(current.items()):
+        before = baseline.get(case)
+        if before is None:
+            continue
+        if before["p99_s"] and result["p99_s"] > before["p99_s"] * (1 + tolerance):
+            regressions.append(
+                f"{case}: p99 {before['p99_s'] * 1000:.2f} ms -> {result['p99_s'] * 1000:.2f} ms"
+            )
+        if before["throughput"] and result["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{case}: throughput {before['throughput']:.1f}/s -> {result['throughput']:.1f}/s"
+            )
+    return regressions
+
+
+def print_results(results: Dict[str, dict]):
+    for case, result in results.items():
+        print(f"{case:<48} p50 {result['p50_s'] * 1000:9.3f} ms | p99 {result['p99_s'] * 1000:9.3f} ms | "
+              f"{result['throughput']:12.1f}/s")
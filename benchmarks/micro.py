@@ -0,0 +1,68 @@
+"""Micro-benchmarks of the split functions in ``app.crud`` and of ``simplify_balances``.
+
+Usage:
+    python -m benchmarks.micro [size ...]
+"""
+import random
+import sys
+from typing import Dict, List
+
+from app.crud import (get_participants_batch, get_participants_by_splitting_amount_by_percentage,
+                      get_participants_by_splitting_amount_by_weight, get_participants_by_splitting_amount_equally,
+                      get_participants_by_splitting_amount_exactly)
+from app.schema import Participant
+from app.simplify_expenses import simplify_balances
+from benchmarks.datagen import make_edges, make_payload
+from benchmarks.harness import measure, print_results
+
+SPLIT_SIZES = [10, 100, 1_000]
+SIMPLIFY_SIZES = [100, 1_000, 10_000]
+BATCH_SIZES = [100, 1_000, 10_000]
+
+
+def split_cases(participants: int, seed: int = 42) -> Dict[str, tuple]:
+    rng = random.Random(seed)
+    user_ids = [f"user-{i}" for i in range(participants)]
+    amount = round(rng.uniform(1, 10_000), 2)
+    exact = [round(amount / participants, 2)] * participants
+    exact[-1] = round(amount - sum(exact[:-1]), 2)
+    percent = [round(100 / participants, 2)] * participants
+    percent[-1] = round(100 - sum(percent[:-1]), 2)
+    return {
+        "equal": (get_participants_by_splitting_amount_equally, [None] * participants),
+        "exact": (get_participants_by_splitting_amount_exactly, exact),
+        "percent": (get_participants_by_splitting_amount_by_percentage, percent),
+        "weight": (get_participants_by_splitting_amount_by_weight, [rng.randint(1, 5) for _ in user_ids]),
+    }, amount, user_ids
+
+
+def run(split_sizes: List[int] = SPLIT_SIZES,
+        simplify_sizes: List[int] = SIMPLIFY_SIZES,
+        batch_sizes: List[int] = BATCH_SIZES) -> Dict[str, dict]:
+    results = {}
+    for size in split_sizes:
+        cases, amount, user_ids = split_cases(size)
+        for name, (func, contributions) in cases.items():
+            participants = [Participant(user_id=u, contribution=c) for u, c in zip(user_ids, contributions)]
+            results[f"split.{name}[{size}]"] = measure(lambda: func(amount, participants), runs=50)
+
+    rng = random.Random(42)
+    user_ids = [f"user-{i}" for i in range(200)]
+    for size in batch_sizes:
+        payloads = [make_payload(rng, user_ids) for _ in range(size)]
+        results[f"split.batch[{size}]"] = measure(lambda: get_participants_batch(payloads), runs=10, items_per_run=size)
+
+    for size in simplify_sizes:
+        edges = make_edges(size)
+        results[f"simplify[{size}]"] = measure(
+            lambda: simplify_balances(edges), runs=10 if size < 10_000 else 3, items_per_run=len(edges)
+        )
+    return results
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]]
+    if sizes:
+        print_results(run(sizes, sizes, sizes))
+    else:
+        print_results(run())
@@ -0,0 +1,85 @@
+"""End-to-end route benchmarks driving ``main.app`` through an in-process ASGI client.
+
+With ``BENCH_DB_URI`` set the routes run against that mongod; the benchmark
+database (``BENCH_DB_NAME``, default ``expense_tracker_bench``) is dropped and
+reseeded on every run, so never point it at real data, and the outbox
+dispatcher is disabled so no email is sent. Otherwise they run against the
+in-memory storage backend, which takes the database out of the numbers.
+
+Usage:
+    python -m benchmarks.routes [concurrency]
+"""
+import contextlib
+import os
+import random
+import sys
+from typing import Dict
+
+import httpx
+
+from app.database import DatabaseConnectionManager
+from app.storage import get_storage, reset_memory_storage
+from benchmarks.datagen import make_dataset, make_payload, seed_database
+from benchmarks.harness import measure_async, print_results
+
+
+@contextlib.asynccontextmanager
+async def bench_app():
+    uri = os.environ.get("BENCH_DB_URI")
+    if uri:
+        os.environ["STORAGE_BACKEND"] = "mongo"
+        os.environ["OUTBOX_DISPATCHER"] = "0"
+        os.environ["DB_URI"] = uri
+        os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "expense_tracker_bench")
+        manager = DatabaseConnectionManager()
+        manager.close_conn()
+        await manager.get_db.client.drop_database(os.environ["DB_NAME"])
+    else:
+        os.environ["STORAGE_BACKEND"] = "memory"
+        reset_memory_storage()
+
+    from main import app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            yield client, get_storage()
+
+
+async def run(concurrency: int = 8,
+              runs: int = 200,
+              num_users: int = 200,
+              num_expenses: int = 2000,
+              seed: int = 42) -> Dict[str, dict]:
+    rng = random.Random(seed)
+    dataset = await make_dataset(num_users, num_expenses, seed)
+    user_ids = dataset.user_ids
+    results = {}
+
+    async with bench_app() as (client, storage):
+        await seed_database(storage, dataset)
+
+        async def get(path: str):
+            response = await client.get(path.format(user_id=rng.choice(user_ids)))
+            response.raise_for_status()
+
+        async def add_expense():
+            payload = make_payload(rng, user_ids)
+            response = await client.post("/expenses/", content=payload.model_dump_json())
+            response.raise_for_status()
+
+        cases = {
+            "GET /users/balance/{user_id}": lambda: get("/users/balance/{user_id}"),
+            "GET /expenses/user/{user_id}": lambda: get("/expenses/user/{user_id}?limit=50"),
+            "GET /expenses/user/{user_id}?stream": lambda: get("/expenses/user/{user_id}?stream=true&limit=500"),
+            "GET /expenses/simplify/user/{user_id}": lambda: get("/expenses/simplify/user/{user_id}"),
+            "POST /expenses/": add_expense,
+        }
+        for name, func in cases.items():
+            results[f"route.{name}"] = await measure_async(func, runs=runs, concurrency=concurrency)
+    return results
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    print_results(asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 8)))
@@ -0,0 +1,81 @@
+"""Compare the orjson list responses with the response_model path they replaced.
+
+The legacy path formats amounts with ``float_scale``, then validates and
+serializes every item against the response model and encodes the result with
+``json``, as FastAPI does for a returned list. Its timings include copying the
+input, which it formats in place.
+
+Usage:
+    python -m benchmarks.serialization [num_items ...]
+"""
+import asyncio
+import json
+import sys
+from typing import Dict, List
+
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter
+
+from app.config import float_scale
+from app.models import DbUser
+from app.routes.expense import format_expense
+from app.routes.user import format_user
+from app.schema import ExpenseResponse
+from benchmarks.datagen import make_dataset
+from benchmarks.harness import measure, print_results
+
+SIZES = [1_000, 10_000]
+
+
+def legacy_expenses(expenses: List[dict], adapter: TypeAdapter) -> bytes:
+    for expense in expenses:
+        expense["amount"] = float_scale(expense["amount"])
+        for p in expense["participants"]:
+            p["amount"] = float_scale(p["amount"])
+    items = adapter.dump_python(adapter.validate_python(expenses), mode="json")
+    return json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def legacy_users(users: List[dict], adapter: TypeAdapter) -> bytes:
+    items = adapter.dump_python(adapter.validate_python(users), mode="json", by_alias=True)
+    return json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def run(sizes: List[int] = SIZES) -> Dict[str, dict]:
+    expense_adapter = TypeAdapter(List[ExpenseResponse])
+    user_adapter = TypeAdapter(List[DbUser])
+    results = {}
+    for size in sizes:
+        dataset = asyncio.run(make_dataset(num_users=size, num_expenses=size))
+        expenses = [e.dict(by_alias=True) for e in dataset.expenses]
+        users = [u.dict(by_alias=True) for u in dataset.users]
+
+        def fresh_expenses():
+            # The legacy path formats in place, so every run gets its own copies.
+            return [dict(e, participants=[dict(p) for p in e["participants"]]) for e in expenses]
+
+        legacy = legacy_expenses(fresh_expenses(), expense_adapter)
+        fast = ORJSONResponse([format_expense(e) for e in expenses]).body
+        assert json.loads(legacy) == json.loads(fast), "expense output differs"
+        assert json.loads(legacy_users(users, user_adapter)) == json.loads(
+            ORJSONResponse([format_user(u) for u in users]).body
+        ), "user output differs"
+
+        runs = 10
+        results[f"serialize.expenses.legacy[{size}]"] = measure(
+            lambda: legacy_expenses(fresh_expenses(), expense_adapter), runs=runs, items_per_run=size
+        )
+        results[f"serialize.expenses.orjson[{size}]"] = measure(
+            lambda: ORJSONResponse([format_expense(e) for e in expenses]).body, runs=runs, items_per_run=size
+        )
+        results[f"serialize.users.legacy[{size}]"] = measure(
+            lambda: legacy_users(users, user_adapter), runs=runs, items_per_run=size
+        )
+        results[f"serialize.users.orjson[{size}]"] = measure(
+            lambda: ORJSONResponse([format_user(u) for u in users]).body, runs=runs, items_per_run=size
+        )
+    return results
+
+
+if __name__ == "__main__":
+    print_results(run([int(arg) for arg in sys.argv[1:]] or SIZES))
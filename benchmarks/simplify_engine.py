@@ -0,0 +1,81 @@
+"""Compare the heap-based simplifier this engine replaced with ``app.simplify_expenses``.
+
+The legacy netting is order dependent and does not conserve balances on
+larger graphs, so its transfer counts (kept next to the timings as
+``transfers``) are not comparable; only the timings are.
+
+Usage:
+    python -m benchmarks.simplify_engine [num_participants ...]
+"""
+import collections
+import heapq
+import sys
+from typing import Dict, List
+
+from app.simplify_expenses import simplify_balances
+from benchmarks.datagen import make_edges
+from benchmarks.harness import measure, print_results
+
+SIZES = [1_000, 10_000, 50_000]
+
+
+def legacy_get_borrowers_and_lenders(expense: list):
+    borrowers = collections.defaultdict(int)
+    lenders = collections.defaultdict(int)
+    for borrower, lender, amount in expense:
+        if borrower in lenders:
+            lenders[borrower] -= amount
+        else:
+            borrowers[borrower] += amount
+        if lender in borrowers:
+            borrowers[lender] -= amount
+        else:
+            lenders[lender] += amount
+    return borrowers, lenders
+
+
+def legacy_simplify_balances(expense: list):
+    # As before, except that running out of borrowers ends the loop instead of
+    # raising IndexError, which the old code did on most random graphs.
+    simplified_expenses = []
+    borrowers, lenders = legacy_get_borrowers_and_lenders(expense)
+    sorted_borrowers = [(-amount, borrower) for borrower, amount in borrowers.items()]
+    heapq.heapify(sorted_borrowers)
+    for lender, amount_lent in sorted(lenders.items(), key=lambda item: item[1], reverse=True):
+        while sorted_borrowers and amount_lent > 0:
+            amount_borrowed, borrower = heapq.heappop(sorted_borrowers)
+            if borrower == lender:
+                if not sorted_borrowers:
+                    heapq.heappush(sorted_borrowers, (amount_borrowed, borrower))
+                    break
+                amount_borrowed_, borrower_ = amount_borrowed, borrower
+                amount_borrowed, borrower = heapq.heappop(sorted_borrowers)
+                heapq.heappush(sorted_borrowers, (amount_borrowed_, borrower_))
+            amount_borrowed = -amount_borrowed
+            amount_transfered = min(amount_borrowed, amount_lent)
+            if amount_transfered > 0:
+                simplified_expenses.append(f"{borrower} sends {amount_transfered} to {lender}.")
+                amount_lent -= amount_transfered
+                if amount_borrowed - amount_transfered > 0:
+                    heapq.heappush(sorted_borrowers, (-(amount_borrowed - amount_transfered), borrower))
+    return simplified_expenses
+
+
+def run(sizes: List[int] = SIZES) -> Dict[str, dict]:
+    results = {}
+    for size in sizes:
+        edges = make_edges(size)
+        runs = 10 if size < 50_000 else 3
+        results[f"simplify_engine.legacy[{size}]"] = dict(
+            measure(lambda: legacy_simplify_balances(edges), runs=runs, warmup=1, items_per_run=len(edges)),
+            transfers=len(legacy_simplify_balances(edges))
+        )
+        results[f"simplify_engine.engine[{size}]"] = dict(
+            measure(lambda: simplify_balances(edges), runs=runs, warmup=1, items_per_run=len(edges)),
+            transfers=len(simplify_balances(edges))
+        )
+    return results
+
+
+if __name__ == "__main__":
+    print_results(run([int(arg) for arg in sys.argv[1:]] or SIZES))
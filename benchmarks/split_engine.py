@@ -0,0 +1,76 @@
+"""Compare the float split functions this engine replaced with ``app.split``.
+
+Usage:
+    python -m benchmarks.split_engine [num_expenses ...]
+"""
+import random
+import sys
+from typing import Dict, List
+
+from app.config import ExpenseSplitType
+from app.split import split, split_batch, to_minor
+from benchmarks.harness import measure, print_results
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def legacy_split_amount(total_amount: float, num_people: int) -> List[float]:
+    equal_share = total_amount / num_people
+    remainder = total_amount - (equal_share * num_people)
+    amounts = [round(equal_share, 2) for _ in range(num_people)]
+    for i in range(int(remainder * 100)):
+        amounts[i % num_people] += 0.01
+    return amounts
+
+
+def legacy_split_by_weight(total_amount: float, weights: List[float]) -> List[float]:
+    total_weight = sum(weights)
+    return [total_amount * w / total_weight for w in weights]
+
+
+def make_expenses(count: int, seed: int = 42):
+    rng = random.Random(seed)
+    expenses = []
+    for _ in range(count):
+        split_type = rng.choice([ExpenseSplitType.EQUAL, ExpenseSplitType.WEIGHT])
+        size = rng.randint(2, 12)
+        weights = [None] * size if split_type == ExpenseSplitType.EQUAL else [rng.randint(1, 5) for _ in range(size)]
+        expenses.append((split_type, round(rng.uniform(1, 10_000), 2), weights))
+    return expenses
+
+
+def legacy_split_all(expenses: list):
+    for split_type, amount, weights in expenses:
+        if split_type == ExpenseSplitType.EQUAL:
+            legacy_split_amount(amount, len(weights))
+        else:
+            legacy_split_by_weight(amount, weights)
+
+
+def split_all(expenses: list):
+    for split_type, amount, weights in expenses:
+        split(split_type, to_minor(amount), weights)
+
+
+def run(sizes: List[int] = SIZES) -> Dict[str, dict]:
+    results = {}
+    for size in sizes:
+        expenses = make_expenses(size)
+        split_types = [e[0] for e in expenses]
+        totals = [to_minor(e[1]) for e in expenses]
+        weights = [e[2] for e in expenses]
+        runs = 10 if size < 100_000 else 3
+        results[f"split_engine.legacy[{size}]"] = measure(
+            lambda: legacy_split_all(expenses), runs=runs, warmup=1, items_per_run=size
+        )
+        results[f"split_engine.cents[{size}]"] = measure(
+            lambda: split_all(expenses), runs=runs, warmup=1, items_per_run=size
+        )
+        results[f"split_engine.cents_batch[{size}]"] = measure(
+            lambda: split_batch(split_types, totals, weights), runs=runs, warmup=1, items_per_run=size
+        )
+    return results
+
+
+if __name__ == "__main__":
+    print_results(run([int(arg) for arg in sys.argv[1:]] or SIZES))
@@ -1,21 +1,51 @@
+import datetime
+import logging
 from contextlib import asynccontextmanager
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
 from fastapi import FastAPI
 import uvicorn
 
+from app.admission import AdmissionMiddleware
+from app.compaction import run_transactions_compaction
+from app.crud import add_expenses_to_db_bulk
 from app.database import DatabaseConnectionManager
+from app.leader import create_scheduler, stop_scheduler
+from app.ledger import migrate_ledger
+from app.loop_monitor import start_loop_monitor, stop_loop_monitor
+from app.metrics import MetricsMiddleware
+from app.notification import close_transport
+from app.offload import start_offload, stop_offload
+from app.outbox import start_outbox_dispatcher, stop_outbox_dispatcher
 from app.routes.expense import expense_router
+from app.routes.group import group_router
+from app.routes.stats import metrics_router, stats_router
 from app.routes.user import user_router
 from app.scheduler import send_weekly_summary
+from app.storage import get_storage, storage_backend
+from app.write_coalescer import start_write_coalescer, stop_write_coalescer
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    start_loop_monitor()
+    await start_offload()
+    if storage_backend() == "memory":
+        # Embedded mode: no indexes, outbox dispatch or scheduled jobs, which all need MongoDB.
+        logger.warning("STORAGE_BACKEND=memory: expense notifications are not sent and scheduled jobs do not run")
+        start_write_coalescer(get_storage(), add_expenses_to_db_bulk)
+        yield
+        await stop_write_coalescer()
+        stop_offload()
+        await stop_loop_monitor()
+        return
+
     # Load the db
+    DatabaseConnectionManager().connect()
     db = DatabaseConnectionManager().get_db
     users_col = db.get_collection("users")
     await users_col.create_index({"name": 1}, unique=True)
@@ -24,23 +54,70 @@ async def lifespan(app: FastAPI):
     transactions_col = db.get_collection("transactions")
     await transactions_col.create_index({"payee_id": 1})
     await transactions_col.create_index({"payer_id": 1})
-    print("Indexes created!")
+    await transactions_col.create_index({"date": 1})
+    await transactions_col.create_index({"compaction_run": 1}, sparse=True)
+    await transactions_col.create_index({"group_id": 1, "payer_id": 1})
+    await transactions_col.create_index({"group_id": 1, "payee_id": 1})
+    # Checkpoints are kept per group since groups were added; drop the older per-pair index.
+    if "payer_id_1_payee_id_1" in await transactions_col.index_information():
+        await transactions_col.drop_index("payer_id_1_payee_id_1")
+    await transactions_col.create_index(
+        {"group_id": 1, "payer_id": 1, "payee_id": 1},
+        unique=True,
+        partialFilterExpression={"checkpoint": True}
+    )
+    expenses_col = db.get_collection("expenses")
+    await expenses_col.create_index({"payee_id": 1, "date": -1, "_id": -1})
+    await expenses_col.create_index({"participants.user_id": 1, "date": -1, "_id": -1})
+    await expenses_col.create_index({"group_id": 1, "date": -1, "_id": -1})
+    await expenses_col.create_index({"group_id": 1, "payee_id": 1, "date": -1, "_id": -1})
+    await expenses_col.create_index({"group_id": 1, "participants.user_id": 1, "date": -1, "_id": -1})
+    balances_col = db.get_collection("balances")
+    await balances_col.create_index({"user_id": 1, "counterparty_id": 1}, unique=True)
+    group_balances_col = db.get_collection("group_balances")
+    await group_balances_col.create_index({"group_id": 1, "user_id": 1, "counterparty_id": 1}, unique=True)
+    rollups_col = db.get_collection("spending_rollups")
+    await rollups_col.create_index({"user_id": 1, "period": 1, "start": 1}, unique=True)
+    outbox_col = db.get_collection("outbox")
+    await outbox_col.create_index({"status": 1, "lease_until": 1})
+    await outbox_col.create_index({"lease_token": 1})
+    await outbox_col.create_index({"import_id": 1, "recipient_id": 1})
+    await outbox_col.create_index({"delivered_at": 1}, expireAfterSeconds=7 * 24 * 3600)
+    logger.info("Indexes created")
+    # Ledgers from before balances were kept in cents (or before they existed) are rebuilt once.
+    if await migrate_ledger(db) is not None:
+        logger.info("Ledgers rebuilt from transactions")
+    start_write_coalescer(get_storage(), add_expenses_to_db_bulk)
+    start_outbox_dispatcher(db)
+
+    # Every worker runs the scheduler, but only the lease holder runs jobs
+    scheduler = create_scheduler(db)
+    scheduler.add_job(send_weekly_summary, datetime.timedelta(weeks=1))  # Run weekly
+    scheduler.add_job(run_transactions_compaction, datetime.timedelta(days=1))  # Run daily
+    await scheduler.start()
 
     yield
 
     # Clean up the connections and release the resources
+    await stop_scheduler()
+    await stop_write_coalescer()
+    await stop_outbox_dispatcher()
+    await close_transport()
+    stop_offload()
+    await stop_loop_monitor()
     DatabaseConnectionManager().close_conn()
 
 
 app = FastAPI(lifespan=lifespan)
+# Added first so it runs inside MetricsMiddleware, which then also records the rejections.
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(user_router)
 app.include_router(expense_router)
-
-# Configure scheduler
-scheduler = AsyncIOScheduler()
-scheduler.add_job(send_weekly_summary, "interval", weeks=1)  # Run weekly
-scheduler.start()
+app.include_router(group_router)
+app.include_router(stats_router)
+app.include_router(metrics_router)
 
 if __name__ == "__main__":
     uvicorn.run(app=app, host="127.0.0.1", port=8000)
@@ -0,0 +1,157 @@
+"""Leader election for scheduled jobs (``app.leader``).
+
+``test_single_runner_across_processes`` starts several worker processes
+against one MongoDB and needs ``TEST_DB_URI``; it is skipped without it.
+``test_single_runner_in_process`` runs the same checks on several schedulers
+in one process over mongomock-motor, when that is installed.
+"""
+import asyncio
+import datetime
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.leader import LeaderScheduler  # noqa: E402
+
+WORKERS = 3
+TTL = 1.5
+POLL = 0.1
+EVERY = datetime.timedelta(seconds=0.5)
+
+
+def make_scheduler(db) -> LeaderScheduler:
+    scheduler = LeaderScheduler(db, ttl=TTL, poll_interval=POLL)
+
+    async def tick():
+        # The claim just moved next_due one period past the slot this run is for.
+        job = await db["job_runs"].find_one({"_id": "tick"})
+        await db["ticks"].insert_one({
+            "owner": scheduler.lock.owner,
+            "slot": job["next_due"] - EVERY,
+            "at": datetime.datetime.utcnow()
+        })
+
+    scheduler.add_job(tick, EVERY)
+    return scheduler
+
+
+def check_ticks(ticks):
+    """Exactly one run per claimed slot."""
+    assert ticks, "no job ran"
+    slots = [tick["slot"] for tick in ticks]
+    assert len(set(slots)) == len(slots)
+
+
+async def wait_for(predicate, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await predicate():
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+# Multiple processes
+
+async def run_worker(uri: str, db_name: str):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    scheduler = make_scheduler(AsyncIOMotorClient(uri)[db_name])
+    await scheduler.start()
+    await asyncio.Event().wait()
+
+
+@pytest.mark.skipif(not os.environ.get("TEST_DB_URI"), reason="needs a MongoDB at TEST_DB_URI")
+def test_single_runner_across_processes():
+    from motor.motor_asyncio import AsyncIOMotorClient
+    uri = os.environ["TEST_DB_URI"]
+    db_name = f"leader_test_{uuid.uuid4().hex[:8]}"
+    workers = [
+        subprocess.Popen([sys.executable, __file__, uri, db_name], cwd=ROOT)
+        for _ in range(WORKERS)
+    ]
+
+    async def scenario():
+        client = AsyncIOMotorClient(uri)
+        db = client[db_name]
+        try:
+            # First run is one period after the schedule is first seen.
+            await asyncio.sleep(TTL + 8 * EVERY.total_seconds())
+            ticks = [tick async for tick in db["ticks"].find()]
+            check_ticks(ticks)
+            owners = {tick["owner"] for tick in ticks}
+            assert len(owners) == 1
+            leader = owners.pop()
+
+            # Kill the leader without letting it release the lease.
+            leader_pid = int(leader.split(":")[1])
+            os.kill(leader_pid, signal.SIGKILL)
+            killed_at = datetime.datetime.utcnow()
+
+            async def taken_over():
+                return await db["ticks"].count_documents(
+                    {"owner": {"$ne": leader}, "at": {"$gt": killed_at}}
+                ) >= 3
+
+            assert await wait_for(taken_over, timeout=TTL * 2 + 10 * EVERY.total_seconds())
+            check_ticks([tick async for tick in db["ticks"].find()])
+        finally:
+            await client.drop_database(db_name)
+            client.close()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+            worker.wait()
+
+
+# One process, several schedulers
+
+def test_single_runner_in_process():
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+
+    async def scenario():
+        db = mongomock_motor.AsyncMongoMockClient()["leader_test"]
+        schedulers = [make_scheduler(db) for _ in range(WORKERS)]
+        for scheduler in schedulers:
+            await scheduler.start()
+        try:
+            await asyncio.sleep(TTL + 8 * EVERY.total_seconds())
+            ticks = [tick async for tick in db["ticks"].find()]
+            check_ticks(ticks)
+            owners = {tick["owner"] for tick in ticks}
+            assert len(owners) == 1
+            leader = next(s for s in schedulers if s.lock.owner in owners)
+
+            # A crash: timers and heartbeat stop, the lease is left to expire.
+            leader.scheduler.shutdown(wait=False)
+            leader._heartbeat.cancel()
+            killed_at = datetime.datetime.utcnow()
+
+            async def taken_over():
+                return await db["ticks"].count_documents(
+                    {"owner": {"$ne": leader.lock.owner}, "at": {"$gt": killed_at}}
+                ) >= 3
+
+            assert await wait_for(taken_over, timeout=TTL * 2 + 10 * EVERY.total_seconds())
+            check_ticks([tick async for tick in db["ticks"].find()])
+        finally:
+            for scheduler in schedulers:
+                if scheduler.scheduler.running:
+                    await scheduler.stop()
+
+    asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,137 @@
+"""Pooled SMTP delivery (``app.notification.MailTransport``) against a local aiosmtpd server.
+
+Skipped when aiosmtpd is not installed.
+"""
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app.notification import DeliveryStats, MailTransport  # noqa: E402
+
+controller_module = pytest.importorskip("aiosmtpd.controller")
+
+
+class Handler:
+    """Accepts mail after ``delay`` seconds, answering the first ``failures`` messages with ``failure``."""
+
+    def __init__(self, delay: float = 0.0, failures: int = 0, failure: str = "451 Try again later"):
+        self.delay = delay
+        self.failures = failures
+        self.failure = failure
+        self.delivered = []
+        self.peers = set()
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        with self._lock:
+            self.peers.add(session.peer)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            with self._lock:
+                if self.failures:
+                    self.failures -= 1
+                    return self.failure
+                self.delivered.append(envelope.rcpt_tos)
+            return "250 Message accepted for delivery"
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def smtp_server():
+    servers = []
+
+    def start(handler: Handler) -> int:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        controller = controller_module.Controller(handler, hostname="127.0.0.1", port=port)
+        controller.start()
+        servers.append(controller)
+        return port
+
+    yield start
+    for controller in servers:
+        controller.stop()
+
+
+def make_transport(port: int, **kwargs) -> MailTransport:
+    kwargs.setdefault("backoff", 0.01)
+    return MailTransport("127.0.0.1", port, sender="app@example.com", start_tls=False, timeout=5, **kwargs)
+
+
+def send_all(transport: MailTransport, count: int) -> DeliveryStats:
+    async def scenario():
+        try:
+            messages = [transport.build_message(f"user{i}@example.com", "Subject", "Body") for i in range(count)]
+            return await transport.send_many(messages)
+        finally:
+            await transport.close()
+
+    return asyncio.run(scenario())
+
+
+def test_sessions_are_reused(smtp_server):
+    handler = Handler()
+    transport = make_transport(smtp_server(handler), pool_size=1)
+    stats = send_all(transport, 10)
+    assert stats == DeliveryStats(sent=10)
+    assert len(handler.delivered) == 10
+    assert len(handler.peers) == 1
+
+
+def test_sessions_are_recycled(smtp_server):
+    handler = Handler()
+    transport = make_transport(smtp_server(handler), pool_size=1, messages_per_session=3)
+    assert send_all(transport, 7) == DeliveryStats(sent=7)
+    assert len(handler.peers) == 3
+
+
+def test_sessions_are_capped(smtp_server):
+    handler = Handler(delay=0.05)
+    transport = make_transport(smtp_server(handler), pool_size=2, max_concurrency=8)
+    assert send_all(transport, 12) == DeliveryStats(sent=12)
+    assert handler.max_active == 2
+    assert len(handler.peers) == 2
+
+
+def test_messages_in_flight_are_capped(smtp_server):
+    handler = Handler(delay=0.05)
+    transport = make_transport(smtp_server(handler), pool_size=8, max_concurrency=3)
+    assert send_all(transport, 12) == DeliveryStats(sent=12)
+    assert handler.max_active == 3
+    assert len(handler.peers) <= 3
+
+
+def test_transient_failures_are_retried(smtp_server):
+    handler = Handler(failures=2)
+    transport = make_transport(smtp_server(handler), pool_size=1, max_retries=3)
+    assert send_all(transport, 1) == DeliveryStats(sent=1, retried=2)
+    assert len(handler.delivered) == 1
+    assert transport.stats == DeliveryStats(sent=1, retried=2)
+
+
+def test_retries_give_up(smtp_server):
+    handler = Handler(failures=10)
+    transport = make_transport(smtp_server(handler), pool_size=1, max_retries=2)
+    assert send_all(transport, 1) == DeliveryStats(failed=1, retried=2)
+    assert not handler.delivered
+
+
+def test_permanent_failures_are_not_retried(smtp_server):
+    handler = Handler(failures=1, failure="550 Mailbox unavailable")
+    transport = make_transport(smtp_server(handler), pool_size=1)
+    assert send_all(transport, 2) == DeliveryStats(sent=1, failed=1)
+    assert transport.stats == DeliveryStats(sent=1, failed=1)